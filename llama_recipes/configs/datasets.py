@@ -10,6 +10,7 @@ class samsum_dataset:
     train_split: str = "train"
     test_split: str = "validation"
     input_length: int = 2048
+    num_proc: int = None
 
 
 @dataclass
@@ -51,5 +52,8 @@ class completion:
     validation_data_path: str = None
     pack_sequences: bool = True
     wrap_packed_sequences: bool = False
+    best_fit_packing: bool = False
     chunk_size: int = 2048
     max_seq_length: int = 4096
+    num_proc: int = None  # tokenization processes, defaults to the cpu count for large datasets
+    max_samples: int = None  # only use the first max_samples training observations, e.g. for a dry run
@@ -13,5 +13,7 @@ class fsdp_config:
     sharding_strategy: ShardingStrategy = ShardingStrategy.FULL_SHARD
     checkpoint_type: StateDictType = StateDictType.SHARDED_STATE_DICT  # alternatively can use SHARDED_STATE_DICT save one file per rank, and can resize the world-size.
     fsdp_activation_checkpointing: bool = True
+    activation_checkpointing_layers: int = None  # checkpoint only this many decoder layers, spread evenly; None checkpoints all of them
     pure_bf16: bool = False
     optimizer: str = "AdamW"
+    anyprecision_fused: bool = False  # update each parameter in one torch.compile'd kernel instead of foreach ops
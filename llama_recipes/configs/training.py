@@ -12,6 +12,14 @@ class train_config:
     num_epochs: int = 3
     num_workers_dataloader: int = 1
     gradient_accumulation_steps: int = 1
+    # with FSDP, pick the largest micro-batch and fewest activation checkpointed layers estimated to fit in
+    # gpu_memory_fraction of each GPU, accumulating gradients to keep batch_size_training *
+    # gradient_accumulation_steps samples per optimizer step
+    auto_batch_size: bool = False
+    gpu_memory_fraction: float = 0.9
+    # with FSDP, only reduce gradients on the last micro-batch of each accumulation step. Ranks hold unsharded
+    # gradients in between, so by default this is only done for PEFT, where they are small
+    no_sync_gradient_accumulation: bool = None
     lr: float = 1e-4
     weight_decay: float = 0.0
     gamma: float = 0.85
@@ -33,13 +41,65 @@ class train_config:
     )
     dist_checkpoint_folder: str = "fine-tuned"  # will be used if using FSDP
     save_optimizer: bool = False  # will be used if using FSDP
+    # write checkpoints from a background thread; training only stalls to copy state to host memory
+    async_checkpointing: bool = False
+    # with async_checkpointing, saving waits while this many checkpoints are still being written
+    max_checkpoints_in_flight: int = 1
+    # save PEFT adapters by gathering only the adapter weights, rather than the whole model as save_pretrained does
+    adapter_only_checkpoint: bool = False
+    # every this many optimizer steps, save the weights, optimizer, scheduler, RNG and data position to a new
+    # step-N directory in training_state_dir, keeping the latest max_training_states. None disables it
+    save_state_every_n_steps: int = None
+    # relative to the working directory; give each run its own, as train.py does, so that resuming can't pick up
+    # the state of an unrelated run
+    training_state_dir: str = "training_state"
+    max_training_states: int = 2
+    # resume from the latest training state in training_state_dir, if there is one
+    resume_from_training_state: bool = False
     data_path: str = None
     num_validation_samples: int = 100
     validation_data_path: str = None
     validation_prompt: str = None
+    # completions of validation_prompt are this long; it may also be a list of prompts, generated as one batch
+    validation_max_new_tokens: int = 50
+    # with run_validation, also evaluate every this many optimizer steps (without generating); None only
+    # evaluates at the end of each epoch
+    eval_every_n_steps: int = None
+    # evaluate on at most this many validation samples, the same ones every time; None uses all of them
+    eval_samples: int = None
     wrap_packed_sequences: bool = False
     pack_sequences: bool = True
+    # pack whole samples with best-fit-decreasing, and keep attention and positions within each sample
+    best_fit_packing: bool = False
     chunk_size: int = 2048
+    # without packing, batch samples of similar length together to cut padding
+    group_by_length: bool = False
+    # with group_by_length, fill batches up to this many (padded) tokens instead of batch_size_training samples
+    max_tokens_per_batch: int = None
+    # metrics, memory timelines and dry run reports are written here rather than to output_dir, which only holds
+    # the model
+    diagnostics_dir: str = "training_diagnostics"
+    # training metrics are reported every this many steps, and written to metrics_file (in diagnostics_dir,
+    # unless it's absolute) as JSON lines
+    log_every_n_steps: int = 10
+    metrics_file: str = "training_metrics.jsonl"
+    # peak TFLOPS of one GPU for the MFU estimate, looked up from the device name if not set
+    peak_tflops: float = None
+    # memory is sampled this often (seconds) while training; each epoch's timeline is written next to
+    # memory_timeline_file (in diagnostics_dir, unless it's absolute), as CSV for a .csv name and as a Chrome trace
+    # otherwise. None disables the export
+    memory_sample_interval: float = 0.1
+    memory_timeline_file: str = "memory_timeline.json"
+    # profile this many optimizer steps on the first dry_run_samples samples of data_path instead of training,
+    # and write their throughput and the projected length of the full run (and its cost, at gpu_hourly_cost
+    # per GPU hour) to dry_run_file (in diagnostics_dir, unless it's absolute)
+    dry_run_steps: int = None
+    dry_run_samples: int = 1000
+    dry_run_file: str = "dry_run.json"
+    gpu_hourly_cost: float = None
+    # preprocessed datasets are cached here, keyed on a hash of the data, tokenizer and config; None disables
+    dataset_cache_dir: str = "dataset_cache"
+    preprocessing_num_workers: int = None
 
     # optim: Optional[str] = field(
     #     default="paged_adamw_32bit",
@@ -1,6 +1,6 @@
-from .utils import Concatenator
-import json
-from datasets import Dataset
+from .utils import Concatenator, get_num_proc, pack_best_fit
+import os
+from datasets import Dataset, load_from_disk
 
 
 def load_data(
@@ -13,16 +13,17 @@ def load_data(
     validation_data_path = dataset_config.validation_data_path
 
     def _load_data(path):
-        data = []
-        with open(path, "r") as file:
-            for line in file:
-                data.append(json.loads(line))
-
-        dataset = Dataset.from_dict(
-            {key: [item[key] for item in data] for key in data[0]},
-        )
-
-        return dataset
+        # everything ends up as an on-disk Arrow table that is memory-mapped, not held in memory,
+        # so RSS stays flat no matter how big the training data is
+        if os.path.isdir(path):
+            # a dataset saved with Dataset.save_to_disk
+            return load_from_disk(path)
+        if path.endswith(".parquet"):
+            return Dataset.from_parquet(path)
+        if path.endswith(".arrow"):
+            return Dataset.from_file(path)
+        # JSONL is parsed in blocks and streamed into the Arrow cache
+        return Dataset.from_json(path)
 
     if not validation_data_path:
         dataset = _load_data(data_path)
@@ -32,16 +33,15 @@ def load_data(
                 f"Selecting observations 0 through {len(dataset)-num_validation_samples} from data for training..."
             )
             end_index = len(dataset) - num_validation_samples
-            indices = list(range(end_index))
-            dataset = dataset.select(indices)
+            # a contiguous range is a zero-copy slice of the table, no indices mapping needed
+            dataset = dataset.select(range(end_index))
 
         elif run_validation and split == "val":
             print(
                 f"Selecting observations {len(dataset)-num_validation_samples} through {len(dataset)} from data for validation..."
             )
             start_index = len(dataset) - num_validation_samples
-            indices = list(range(start_index, len(dataset)))
-            dataset = dataset.select(indices)
+            dataset = dataset.select(range(start_index, len(dataset)))
     else:
         if split == "train":
             dataset = _load_data(data_path)
@@ -60,14 +60,19 @@ def format_data(dataset, tokenizer, config=None):
             "text": sample["prompt"] + "\n" + sample["completion"] + tokenizer.eos_token
         }
 
+    num_proc = get_num_proc(config, dataset)
     # Assume - all "text" or all "prompt/completion"
     if "text" in dataset[0]:
         dataset = dataset.map(
-            apply_text_template, remove_columns=list(dataset.features)
+            apply_text_template,
+            remove_columns=list(dataset.features),
+            num_proc=num_proc,
         )
     elif "prompt" in dataset[0] and "completion" in dataset[0]:
         dataset = dataset.map(
-            apply_prompt_template, remove_columns=list(dataset.features)
+            apply_prompt_template,
+            remove_columns=list(dataset.features),
+            num_proc=num_proc,
         )
     else:
         raise Exception(
@@ -84,21 +89,30 @@ def tokenize_data(dataset, tokenizer, config=None):
     except:
         max_length = tokenizer.model_max_length
 
+    num_proc = get_num_proc(config, dataset)
     dataset = dataset.map(
         lambda sample: tokenizer(
             sample["text"], max_length=max_length, truncation=True
         ),
         batched=True,
         remove_columns=list(dataset.features),
-    ).map(lambda sample: {"labels": sample["input_ids"]}, batched=True)
-
-    if config.pack_sequences:
-        dataset = dataset.map(
-            Concatenator(
-                chunk_size=config.chunk_size,
-                wrap_packed_sequences=config.wrap_packed_sequences,
-            ),
-            batched=True,
+        num_proc=num_proc,
+    ).map(lambda sample: {"labels": sample["input_ids"]}, batched=True, num_proc=num_proc)
+
+    if config.pack_sequences and getattr(config, "best_fit_packing", False):
+        dataset = pack_best_fit(dataset, config.chunk_size)
+    # packing carries a residual from batch to batch, so it stays in one process
+    elif config.pack_sequences:
+        dataset = (
+            dataset.with_format("arrow")
+            .map(
+                Concatenator(
+                    chunk_size=config.chunk_size,
+                    wrap_packed_sequences=config.wrap_packed_sequences,
+                ),
+                batched=True,
+            )
+            .with_format(None)
         )
 
     return dataset
@@ -106,6 +120,10 @@ def tokenize_data(dataset, tokenizer, config=None):
 
 def get_completion_dataset(config: str, tokenizer, split: str = "train"):
     dataset = load_data(config, split)
+    max_samples = getattr(config, "max_samples", None)
+    if split == "train" and max_samples and max_samples < len(dataset):
+        print(f"Using the first {max_samples} of {len(dataset)} training observations...")
+        dataset = dataset.select(range(max_samples))
     dataset = format_data(dataset, tokenizer, config)
     dataset = tokenize_data(dataset, tokenizer, config)
 
@@ -4,7 +4,7 @@
 # For dataset details visit: https://huggingface.co/datasets/samsum
 
 import datasets
-from .utils import Concatenator
+from .utils import Concatenator, get_num_proc
 
 
 def get_preprocessed_samsum(dataset_config, tokenizer, split):
@@ -23,11 +23,22 @@ def get_preprocessed_samsum(dataset_config, tokenizer, split):
             )
         }
 
-    dataset = dataset.map(apply_prompt_template, remove_columns=list(dataset.features))
-
+    num_proc = get_num_proc(dataset_config, dataset)
     dataset = dataset.map(
-        lambda sample: tokenizer(sample["text"]),
-        batched=True,
+        apply_prompt_template,
         remove_columns=list(dataset.features),
-    ).map(Concatenator(), batched=True)
+        num_proc=num_proc,
+    )
+
+    dataset = (
+        dataset.map(
+            lambda sample: tokenizer(sample["text"]),
+            batched=True,
+            remove_columns=list(dataset.features),
+            num_proc=num_proc,
+        )
+        .with_format("arrow")
+        .map(Concatenator(), batched=True)
+        .with_format(None)
+    )
     return dataset
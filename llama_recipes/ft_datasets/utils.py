@@ -1,17 +1,85 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates.
 # This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
 
+import bisect
+import os
+
+import datasets
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 from tqdm import tqdm
-from itertools import chain
 from torch.utils.data import Dataset
 
 
+# below this many samples per process, spawning tokenization workers costs more than it saves
+MIN_SAMPLES_PER_PROC = 10_000
+
+
+def get_num_proc(dataset_config, dataset):
+    """number of processes to tokenize dataset with, None to stay in-process"""
+    num_proc = getattr(dataset_config, "num_proc", None) or len(os.sched_getaffinity(0))
+    num_proc = min(num_proc, len(dataset) // MIN_SAMPLES_PER_PROC)
+    return num_proc if num_proc > 1 else None
+
+
+def to_token_table(batch) -> pa.Table:
+    """a batch of token lists (dict of lists, or an Arrow table when the dataset has arrow format) as a table"""
+    if isinstance(batch, pa.Table):
+        return batch
+    return pa.table({k: pa.array(v) for k, v in dict(batch).items()})
+
+
+def flatten_tokens(table: pa.Table):
+    """
+    Flat token arrays for every column of `table`, plus the offsets of each sample into them.
+    Zero-copy where Arrow allows it; every column is expected to have the same per-sample lengths.
+    """
+    columns = {}
+    offsets = None
+    for name in table.column_names:
+        column = table.column(name).combine_chunks()
+        if offsets is None:
+            offsets = column.offsets.to_numpy()
+            offsets = offsets - offsets[0]
+        columns[name] = column.flatten().to_numpy(zero_copy_only=False)
+    return columns, offsets
+
+
+def chunks_to_table(columns, bounds) -> pa.Table:
+    """builds a table with one row per [bounds[i], bounds[i + 1]) slice of the flat token arrays"""
+    offsets = pa.array(bounds - bounds[0], type=pa.int32())
+    return pa.table(
+        {
+            k: pa.ListArray.from_arrays(offsets, pa.array(v[bounds[0] : bounds[-1]]))
+            for k, v in columns.items()
+        }
+    )
+
+
 class Concatenator(object):
+    """
+    Packs batches of tokenized samples into chunks, carrying the tail of each batch over to the next one.
+
+    Works on flat token arrays and sample offsets rather than Python lists, so packing cost doesn't grow
+    with the number of tokens. Map it over a dataset with `.with_format("arrow")` to skip the conversion
+    from and to Python lists entirely; it returns an Arrow table, which `datasets` accepts either way.
+    """
+
     def __init__(self, chunk_size=2048, wrap_packed_sequences=False):
         self.chunk_size = chunk_size
-        self.residual = {"input_ids": [], "attention_mask": []}
+        self.residual = {}
         self.wrap_packed_sequences = wrap_packed_sequences
 
+    def _prepend_residual(self, batch):
+        columns, offsets = flatten_tokens(to_token_table(batch))
+        residual_length = len(next(iter(self.residual.values()), []))
+        if residual_length:
+            # the residual behaves like one more sample at the start of the batch
+            columns = {k: np.concatenate([self.residual[k], v]) for k, v in columns.items()}
+            offsets = np.concatenate([[0], offsets + residual_length])
+        return columns, offsets
+
     def _wrap_concat(self, batch):
         """
         When we pack samples into a single sequence, it's possible that the final
@@ -20,32 +88,15 @@ class Concatenator(object):
         This breaks the sample into two parts and may introduce samples that violate prompt formats.
         However, it allows us to strictly enforce chunk size.
         """
-        concatenated_samples = {
-            k: v + list(chain(*batch[k])) for k, v in self.residual.items()
-        }
-
-        total_length = len(concatenated_samples[list(concatenated_samples.keys())[0]])
-
-        if total_length >= self.chunk_size:
-            chunk_num = total_length // self.chunk_size
-            result = {
-                k: [
-                    v[i : i + self.chunk_size]
-                    for i in range(0, chunk_num * self.chunk_size, self.chunk_size)
-                ]
-                for k, v in concatenated_samples.items()
-            }
-            self.residual = {
-                k: v[(chunk_num * self.chunk_size) :]
-                for k, v in concatenated_samples.items()
-            }
-        else:
-            result = concatenated_samples
-            self.residual = {k: [] for k in concatenated_samples.keys()}
+        columns, offsets = self._prepend_residual(batch)
+        total_length = int(offsets[-1])
 
-        # result["labels"] = result["input_ids"].copy()
-
-        return result
+        # anything short of a full chunk waits for the next batch
+        bounds = np.arange(
+            0, total_length // self.chunk_size * self.chunk_size + 1, self.chunk_size
+        )
+        self.residual = {k: v[bounds[-1] :].copy() for k, v in columns.items()}
+        return chunks_to_table(columns, bounds)
 
     def _concat(self, batch):
         """
@@ -55,77 +106,180 @@ class Concatenator(object):
         sequences with variable lengths, e.g. some that are below `chunk_size`,
         but it allows us to pack sequences while strictly respecting formatting.
         """
+        columns, offsets = self._prepend_residual(batch)
+        num_samples = len(offsets) - 1
+
+        # each chunk takes as many whole samples as fit, and at least one
+        sample_bounds = [0]
+        start = 0
+        while True:
+            end = np.searchsorted(offsets, offsets[start] + self.chunk_size, side="right") - 1
+            end = max(end, start + 1)
+            if end >= num_samples:
+                break
+            sample_bounds.append(end)
+            start = end
 
-        # Initialize current sequences from residual or empty if none exists
-        keys = batch.keys()
-        current_sequences = {key: self.residual.get(key, []) for key in keys}
+        # the last, possibly partial, chunk is kept back for the next batch
+        bounds = offsets[sample_bounds]
+        self.residual = {k: v[bounds[-1] :].copy() for k, v in columns.items()}
+        return chunks_to_table(columns, bounds)
 
-        # # We'll store packed sequences in results
-        results = {key: [] for key in keys}
+    def __call__(self, batch):
+        if self.wrap_packed_sequences:
+            return self._wrap_concat(batch)
+        else:
+            return self._concat(batch)
 
-        # len_of_new_seq = len(batch[list(batch.keys())[0]])
-        # len_of_current_seq = len(current_sequences[list(current_sequences.keys())[0]])
 
-        num_samples = len(batch[next(iter(keys))])
+# packed sequences built at a time; bounds the tokens in memory to this many chunks and keeps list offsets in int32
+PACKED_SEQUENCES_PER_TABLE = 1_000
+# samples whose lengths are read at a time
+SAMPLES_PER_SLICE = 100_000
 
-        for idx in range(num_samples):
-            # Check if adding next sample will exceed the chunk size for any key
-            len_current_sequences = len(current_sequences[list(keys)[0]])
-            len_batch_sequence = len(batch[list(keys)[0]][idx])
 
-            will_exceed = len_current_sequences + len_batch_sequence > self.chunk_size
+def best_fit_decreasing(lengths, capacity):
+    """
+    Assigns samples to bins of `capacity` tokens, longest first, each into the fullest bin it still fits in.
+    Samples longer than `capacity` get a bin of their own. Returns the bins as lists of sample indices.
+    """
+    bins = []
+    # distinct amounts of room left in open bins, sorted, and the bins with each amount
+    rooms = []
+    bins_by_room = {}
+    for idx in np.argsort(-np.asarray(lengths), kind="stable").tolist():
+        length = int(lengths[idx])
+        i = bisect.bisect_left(rooms, length)
+        if i == len(rooms):
+            bin_id = len(bins)
+            bins.append([idx])
+            room = capacity - length
+        else:
+            room = rooms[i]
+            bin_id = bins_by_room[room].pop()
+            if not bins_by_room[room]:
+                del bins_by_room[room]
+                del rooms[i]
+            bins[bin_id].append(idx)
+            room -= length
+        if room > 0:
+            if room not in bins_by_room:
+                bins_by_room[room] = []
+                bisect.insort(rooms, room)
+            bins_by_room[room].append(bin_id)
+    return bins
 
-            if will_exceed:
-                if len_current_sequences > 0:
-                    for key in keys:
-                        results[key].append(current_sequences[key])
-                        current_sequences[key] = []
 
-                # After appending to results, extend current_sequences with the sample for all keys
-                for key in keys:
-                    current_sequences[key].extend(batch[key][idx])
-            else:
-                for key in keys:
-                    current_sequences[key].extend(batch[key][idx])
+def gather_packed(table: pa.Table, bin_sizes) -> pa.Table:
+    """
+    a table of packed sequences from a table of samples in packing order, the first bin_sizes[0] of them making up
+    the first sequence and so on
+    """
+    packed, doc_starts = flatten_tokens(table)
+    doc_lengths = np.diff(doc_starts)
+    total_length = int(doc_starts[-1])
 
-        # Store unappended sequences as residual
-        self.residual = current_sequences
+    packed["position_ids"] = (
+        np.arange(total_length) - np.repeat(doc_starts[:-1], doc_lengths)
+    ).astype(np.int32)
+    bin_starts = np.concatenate([[0], np.cumsum(bin_sizes, dtype=np.int64)])
+    doc_ids = np.arange(len(doc_lengths)) - np.repeat(bin_starts[:-1], bin_sizes) + 1
+    # document indices can run past what the tokenized mask's (often int8) dtype holds
+    packed["attention_mask"] = (
+        np.repeat(doc_ids, doc_lengths).astype(np.int32) * packed["attention_mask"]
+    ).astype(np.int32)
+    if "labels" in packed:
+        # flattened columns can be read-only views of the table
+        packed["labels"] = packed["labels"].copy()
+        packed["labels"][doc_starts[:-1]] = -100
+    return chunks_to_table(packed, doc_starts[bin_starts])
 
-        # results["labels"] = results["input_ids"].copy()
 
-        return results
+def pack_best_fit(dataset, chunk_size, seed=0):
+    """
+    Packs whole samples of a tokenized dataset into sequences of up to `chunk_size` tokens with best-fit-decreasing,
+    which leaves far less padding than filling sequences in order.
 
-    def __call__(self, batch):
-        if self.wrap_packed_sequences:
-            return self._wrap_concat(batch)
-        else:
-            return self._concat(batch)
+    Each packed sequence gets `position_ids` that restart at every document, labels that don't ask the model to
+    predict one document from the previous one, and an `attention_mask` holding the 1-based document index of each
+    token (0 for padding). See utils.packing_utils for the collator and the block-diagonal attention that use them.
+    """
+    dataset = dataset.with_format("arrow")
+    # only the lengths are read up front; tokens are taken from the memory-mapped table a slice of bins at a time
+    lengths = [np.zeros(0, dtype=np.int64)]
+    for i in range(0, len(dataset), SAMPLES_PER_SLICE):
+        column = dataset[i : i + SAMPLES_PER_SLICE].column("input_ids")
+        lengths.append(pc.list_value_length(column).to_numpy().astype(np.int64))
+    lengths = np.concatenate(lengths)
+    bins = best_fit_decreasing(lengths, chunk_size)
+    # keep documents in dataset order within a sequence, and don't serve sequences longest first
+    bins = [sorted(b) for b in bins]
+    np.random.default_rng(seed).shuffle(bins)
+
+    efficiency = lengths.sum() / (len(bins) * chunk_size) if bins else 0
+    print(
+        f"--> Packed {len(lengths)} samples into {len(bins)} sequences of up to {chunk_size} tokens, "
+        f"packing efficiency {efficiency:.1%}"
+    )
+
+    def packed_tables():
+        for i in range(0, max(len(bins), 1), PACKED_SEQUENCES_PER_TABLE):
+            bin_slice = bins[i : i + PACKED_SEQUENCES_PER_TABLE]
+            rows = [idx for b in bin_slice for idx in b]
+            yield gather_packed(dataset[rows], [len(b) for b in bin_slice])
+
+    tables = packed_tables()
+    if not dataset.cache_files:
+        return datasets.Dataset(pa.concat_tables(tables))
+
+    # like .map, write next to the dataset's cache files and memory-map the result
+    path = os.path.join(
+        os.path.dirname(dataset.cache_files[0]["filename"]),
+        f"packed-{dataset._fingerprint}-{chunk_size}-{seed}.arrow",
+    )
+    writer = None
+    for table in tables:
+        if writer is None:
+            writer = pa.ipc.new_stream(path, table.schema)
+        writer.write_table(table)
+    writer.close()
+    return datasets.Dataset.from_file(path)
 
 
 class ConcatDataset(Dataset):
+    """
+    Streams samples of `dataset` into fixed-size chunks. Tokens are kept in one flat array per key and
+    chunks are sliced out of it on access.
+    """
+
     def __init__(self, dataset, chunk_size=4096):
         self.dataset = dataset
         self.chunk_size = chunk_size
 
-        self.samples = []
-
-        buffer = {
+        buffers = {
             "input_ids": [],
             "attention_mask": [],
             "labels": [],
         }
-
         for sample in tqdm(self.dataset, desc="Preprocessing dataset"):
-            buffer = {k: v + sample[k] for k, v in buffer.items()}
+            for k, v in buffers.items():
+                v.append(np.asarray(sample[k], dtype=np.int32))
 
-            while len(next(iter(buffer.values()))) > self.chunk_size:
-                self.samples.append(
-                    {k: v[: self.chunk_size] for k, v in buffer.items()}
-                )
-                buffer = {k: v[self.chunk_size :] for k, v in buffer.items()}
+        self.tokens = {
+            k: np.concatenate(v) if v else np.zeros(0, dtype=np.int32)
+            for k, v in buffers.items()
+        }
+        total_length = len(self.tokens["input_ids"])
+        # a buffer that is exactly full is only emitted once more tokens arrive, so the tail is dropped
+        self.num_chunks = max(total_length - 1, 0) // self.chunk_size
 
     def __getitem__(self, idx):
-        return self.samples[idx]
+        if not 0 <= idx < self.num_chunks:
+            raise IndexError(idx)
+        start = idx * self.chunk_size
+        return {
+            k: v[start : start + self.chunk_size].tolist() for k, v in self.tokens.items()
+        }
 
     def __len__(self):
-        return len(self.samples)
+        return self.num_chunks
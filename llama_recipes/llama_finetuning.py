@@ -8,6 +8,7 @@ import torch
 # Unused imports removed
 from utils import fsdp_auto_wrap_policy
 from transformers import (
+    LlamaConfig,
     LlamaForCausalLM,
     LlamaTokenizer,
     AutoModelForCausalLM,
@@ -19,6 +20,7 @@ import torch.distributed as dist
 from utils.train_utils import (
     train,
     freeze_transformer_layers,
+    get_device,
     setup,
     setup_environ_flags,
     print_model_size,
@@ -26,6 +28,17 @@ from utils.train_utils import (
 )
 
 from utils.dataset_utils import get_preprocessed_dataset
+from utils.dry_run_utils import dry_run
+from utils.plan_utils import plan_batch_size
+from utils.packing_utils import (
+    DataCollatorForPackedSequences,
+    enable_document_attention,
+)
+from utils.sampler_utils import (
+    LengthGroupedBatchSampler,
+    ResumableBatchSampler,
+    get_lengths,
+)
 
 from utils.config_utils import (
     update_config,
@@ -40,10 +53,12 @@ from peft import (
 from torch.distributed.fsdp import (
     FullyShardedDataParallel as FSDP,
 )
-from torch.utils.data import DistributedSampler
+from torch.utils.data import BatchSampler, DistributedSampler, SequentialSampler
+from ft_datasets.completion_dataset import load_data
+from model_checkpointing import load_training_state
 import policies
 from policies import AnyPrecisionAdamW
-from configs import fsdp_config, train_config
+from configs import fsdp_config, lora_config, train_config
 import torch.optim as optim
 from torch.optim.lr_scheduler import StepLR
 import torch
@@ -88,6 +103,8 @@ def main(**kwargs):
     #########################################################
     # PREPARE TRAIN AND VALIDATION DATA --------------------
     #########################################################
+    # a dry run only profiles a few steps, on a sample of the training data, without validation
+    run_validation = train_config.run_validation and not train_config.dry_run_steps
     dataset_config = generate_dataset_config(train_config, kwargs)
     update_config(
         dataset_config,
@@ -98,7 +115,12 @@ def main(**kwargs):
             "run_validation": train_config.run_validation,
             "pack_sequences": train_config.pack_sequences,
             "wrap_packed_sequences": train_config.wrap_packed_sequences,
+            "best_fit_packing": train_config.best_fit_packing,
             "chunk_size": train_config.chunk_size,
+            "num_proc": train_config.preprocessing_num_workers,
+            "max_samples": train_config.dry_run_samples
+            if train_config.dry_run_steps
+            else None,
         },
     )
 
@@ -107,22 +129,59 @@ def main(**kwargs):
         tokenizer,
         dataset_config,
         split="train",
+        cache_dir=train_config.dataset_cache_dir,
     )
 
     if not train_config.enable_fsdp or rank == 0:
         print(f"--> Training Set Length = {len(dataset_train)}")
 
-    if train_config.run_validation:
+    if run_validation:
         dataset_val = get_preprocessed_dataset(
             tokenizer,
             dataset_config,
             split="val",
+            cache_dir=train_config.dataset_cache_dir,
         )
         if not train_config.enable_fsdp or rank == 0:
             print(f"--> Validation Set Length = {len(dataset_val)}")
     else:
         dataset_val = None
 
+    #########################################################
+    # PLAN BATCH SIZE AND ACTIVATION CHECKPOINTING ---------
+    #########################################################
+    if train_config.auto_batch_size and train_config.enable_fsdp:
+        lora_kwargs = {}
+        if train_config.use_peft and train_config.peft_method == "lora":
+            lora_kwargs = dict(
+                lora_r=kwargs.get("lora_rank", lora_config.r),
+                lora_target_modules=lora_config.target_modules,
+                lora_dropout=kwargs.get("lora_dropout", lora_config.lora_dropout),
+            )
+        plan = plan_batch_size(
+            LlamaConfig.from_pretrained(train_config.model_name),
+            seq_len=train_config.chunk_size
+            if train_config.pack_sequences
+            else int(get_lengths(dataset_train).max()),
+            global_batch_size=train_config.batch_size_training
+            * train_config.gradient_accumulation_steps,
+            budget_bytes=torch.cuda.get_device_properties(local_rank).total_memory
+            * train_config.gpu_memory_fraction,
+            world_size=world_size,
+            dtype_bytes=2 if fsdp_config.pure_bf16 else 4,
+            **lora_kwargs,
+        )
+        train_config.batch_size_training = plan.batch_size
+        train_config.gradient_accumulation_steps = plan.gradient_accumulation_steps
+        fsdp_config.fsdp_activation_checkpointing = plan.checkpointed_layers > 0
+        fsdp_config.activation_checkpointing_layers = plan.checkpointed_layers
+        if rank == 0:
+            print(
+                f"--> Planned micro-batch size {plan.batch_size} with {plan.gradient_accumulation_steps} "
+                f"gradient accumulation steps and {plan.checkpointed_layers} checkpointed layers, "
+                f"estimated at {plan.estimated_bytes / 2**30:.1f} of {plan.budget_bytes / 2**30:.1f} GB"
+            )
+
     train_sampler = None
     val_sampler = None
     if train_config.enable_fsdp:
@@ -132,7 +191,7 @@ def main(**kwargs):
             num_replicas=dist.get_world_size(),
             shuffle=True,
         )
-        if train_config.run_validation:
+        if run_validation:
             val_sampler = DistributedSampler(
                 dataset_val,
                 rank=dist.get_rank(),
@@ -140,21 +199,42 @@ def main(**kwargs):
             )
 
     # Create DataLoaders for the training and validation dataset
-    data_collator = DataCollatorForTokenClassification(
-        tokenizer=tokenizer, padding="longest"
-    )
+    best_fit_packing = train_config.pack_sequences and train_config.best_fit_packing
+    if best_fit_packing:
+        data_collator = DataCollatorForPackedSequences(
+            tokenizer=tokenizer, padding="longest"
+        )
+    else:
+        data_collator = DataCollatorForTokenClassification(
+            tokenizer=tokenizer, padding="longest"
+        )
 
+    group_by_length = train_config.group_by_length and not train_config.pack_sequences
+    if group_by_length and train_config.peft_method != "qlora":
+        train_batch_sampler = LengthGroupedBatchSampler(
+            get_lengths(dataset_train),
+            batch_size=train_config.batch_size_training,
+            max_tokens=train_config.max_tokens_per_batch,
+            num_replicas=dist.get_world_size() if train_config.enable_fsdp else 1,
+            rank=dist.get_rank() if train_config.enable_fsdp else 0,
+            seed=train_config.seed,
+        )
+    else:
+        train_batch_sampler = BatchSampler(
+            train_sampler if train_sampler else SequentialSampler(dataset_train),
+            batch_size=train_config.batch_size_training,
+            drop_last=True,
+        )
+    # resuming skips the batches already trained on without loading them
     train_dataloader = torch.utils.data.DataLoader(
         dataset_train,
-        batch_size=train_config.batch_size_training,
+        batch_sampler=ResumableBatchSampler(train_batch_sampler),
         num_workers=train_config.num_workers_dataloader,
         pin_memory=True,
-        sampler=train_sampler if train_sampler else None,
-        drop_last=True,
         collate_fn=data_collator,
     )
 
-    if train_config.run_validation:
+    if run_validation:
         eval_dataloader = torch.utils.data.DataLoader(
             dataset_val,
             batch_size=train_config.val_batch_size,
@@ -235,6 +315,10 @@ def main(**kwargs):
     # We added a special token for padding, so we need to resize the token embeddings
     model.resize_token_embeddings(model.config.vocab_size + 1)
 
+    # Packed documents only attend within themselves
+    if best_fit_packing:
+        enable_document_attention(model)
+
     print_model_size(model, train_config, rank if train_config.enable_fsdp else 0)
 
     # Prepare the model for int8 training if quantization is enabled
@@ -266,7 +350,9 @@ def main(**kwargs):
             limit_all_gathers=True,
         )
         if fsdp_config.fsdp_activation_checkpointing:
-            policies.apply_fsdp_checkpointing(model)
+            policies.apply_fsdp_checkpointing(
+                model, fsdp_config.activation_checkpointing_layers
+            )
 
     # Note: When we use QLoRA, we load directly to devices with `automap`, so we don't need to move to cuda here.
     elif (
@@ -274,7 +360,7 @@ def main(**kwargs):
         and not train_config.enable_fsdp
         and not train_config.peft_method == "qlora"
     ):
-        model.to("cuda")
+        model.to(get_device(train_config))
 
     # Initialize the optimizer and learning rate scheduler
     if not train_config.peft_method == "qlora":
@@ -285,6 +371,7 @@ def main(**kwargs):
                 momentum_dtype=torch.bfloat16,
                 variance_dtype=torch.bfloat16,
                 use_kahan_summation=False,
+                fused=fsdp_config.anyprecision_fused,
             )
         else:
             optimizer = optim.AdamW(
@@ -295,9 +382,38 @@ def main(**kwargs):
 
     gradient_accumulation_steps = train_config.gradient_accumulation_steps
 
+    if train_config.dry_run_steps and not train_config.peft_method == "qlora":
+        data_fraction = 1.0
+        if dataset_config.dataset == "completion":
+            num_samples = len(load_data(dataset_config, "train"))
+            data_fraction = min(train_config.dry_run_samples, num_samples) / num_samples
+        return dry_run(
+            model,
+            train_dataloader,
+            optimizer,
+            gradient_accumulation_steps,
+            train_config,
+            get_device(train_config, local_rank if train_config.enable_fsdp else None),
+            data_fraction=data_fraction,
+            world_size=world_size if train_config.enable_fsdp else 1,
+            rank=rank if train_config.enable_fsdp else 0,
+            no_sync=train_config.enable_fsdp
+            and (
+                train_config.use_peft
+                if train_config.no_sync_gradient_accumulation is None
+                else train_config.no_sync_gradient_accumulation
+            ),
+        )
+
     if not train_config.peft_method == "qlora":
         scheduler = StepLR(optimizer, step_size=1, gamma=train_config.gamma)
 
+        training_state = None
+        if train_config.resume_from_training_state:
+            training_state = load_training_state(
+                model, optimizer, rank if train_config.enable_fsdp else 0, train_config
+            )
+
         # Start the training process
         results = train(
             model,
@@ -311,6 +427,7 @@ def main(**kwargs):
             fsdp_config if train_config.enable_fsdp else None,
             local_rank if train_config.enable_fsdp else None,
             rank if train_config.enable_fsdp else None,
+            training_state=training_state,
         )
         if not train_config.enable_fsdp or rank == 0:
             [print(f"Key: {k}, Value: {v}") for k, v in results.items()]
@@ -334,6 +451,7 @@ def main(**kwargs):
             num_train_epochs=train_config.num_epochs,
             gradient_checkpointing=True,
             do_eval=True,
+            group_by_length=group_by_length,
         )
 
         trainer = Trainer(
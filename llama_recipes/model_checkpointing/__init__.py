@@ -9,4 +9,16 @@ from .checkpoint_handler import (
     save_model_and_optimizer_sharded,
     load_model_sharded,
     load_sharded_model_single_gpu,
+    get_trainable_names,
+    get_trainable_state_dict,
+    save_peft_adapter,
+)
+from .async_writer import (
+    AsyncCheckpointWriter,
+    snapshot_state_dict,
+)
+from .training_state import (
+    latest_training_state,
+    load_training_state,
+    save_training_state,
 )
@@ -0,0 +1,100 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
+
+import collections
+import copy
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import torch.distributed as dist
+from torch.distributed._shard.sharded_tensor import Shard, ShardedTensor
+from torch.distributed.remote_device import _remote_device
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes checkpoints on a background thread, so training only stalls while state is copied to host memory.
+
+    `submit` queues a write and only blocks while `max_in_flight` earlier writes are still running, which bounds
+    the host memory held by snapshots. Writes run one at a time, in order; an exception in one is raised by the
+    following `submit`, `wait` or `close`.
+
+    Sharded checkpoints run collectives while they're written, which mustn't interleave with training's NCCL
+    collectives, so with `distributed` they go through a gloo group of their own, created here on all ranks.
+    """
+
+    def __init__(self, max_in_flight: int = 1, distributed: bool = False):
+        self.max_in_flight = max_in_flight
+        self.process_group = dist.new_group(backend="gloo") if distributed else None
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="checkpoint-writer"
+        )
+        self.pending = collections.deque()
+
+    def submit(self, fn, *args, **kwargs):
+        """runs fn(*args, **kwargs) on the writer thread, once the writes before it are done"""
+        while len(self.pending) >= self.max_in_flight:
+            self.pending.popleft().result()
+        self.pending.append(self.executor.submit(fn, *args, **kwargs))
+
+    def wait(self) -> None:
+        """blocks until every queued write is on disk"""
+        while self.pending:
+            self.pending.popleft().result()
+
+    def close(self) -> None:
+        self.wait()
+        self.executor.shutdown()
+
+
+def _cpu_sharded_tensor(sharded_tensor, process_group):
+    local_shards = [
+        Shard(snapshot_tensor(shard.tensor), copy.deepcopy(shard.metadata))
+        for shard in sharded_tensor.local_shards()
+    ]
+    metadata = copy.deepcopy(sharded_tensor.metadata())
+    for shard_metadata in metadata.shards_metadata:
+        shard_metadata.placement = _remote_device(
+            f"rank:{shard_metadata.placement.rank()}/cpu"
+        )
+    for shard in local_shards:
+        shard.metadata.placement = _remote_device(
+            f"rank:{shard.metadata.placement.rank()}/cpu"
+        )
+    return ShardedTensor._init_from_local_shards_and_global_metadata(
+        local_shards, metadata, process_group=process_group
+    )
+
+
+def snapshot_tensor(tensor):
+    """a host copy of tensor; from cuda, into pinned memory without waiting for the copy"""
+    if tensor.is_cuda:
+        host = torch.empty_like(tensor, device="cpu", pin_memory=True)
+        host.copy_(tensor, non_blocking=True)
+        return host
+    return tensor.detach().clone()
+
+
+def snapshot_state_dict(state, process_group=None):
+    """
+    Copies nested dicts and lists of tensors and ShardedTensors to host memory, so training can carry on updating
+    the originals. Returns the copy and a cuda event (or None) to synchronize on before reading it.
+    """
+
+    def snapshot(value):
+        if isinstance(value, ShardedTensor):
+            return _cpu_sharded_tensor(value, process_group)
+        if isinstance(value, torch.Tensor):
+            return snapshot_tensor(value)
+        if isinstance(value, dict):
+            return type(value)((k, snapshot(v)) for k, v in value.items())
+        if isinstance(value, (list, tuple)):
+            return type(value)(snapshot(v) for v in value)
+        return copy.deepcopy(value)
+
+    host_state = snapshot(state)
+    copied = None
+    if torch.cuda.is_available():
+        copied = torch.cuda.Event()
+        copied.record()
+    return host_state, copied
@@ -21,9 +21,12 @@ from torch.distributed.checkpoint.default_planner import (
 
 
 from torch.distributed.fsdp.fully_sharded_data_parallel import StateDictType
+from torch.distributed.fsdp._common_utils import FSDP_WRAPPED_MODULE, clean_tensor_name
 import torch.distributed._shard.checkpoint as dist_cp
 import torch.distributed as dist
 
+from .async_writer import snapshot_state_dict
+
 
 def get_date_of_run():
     """create date and time for file save uniqueness
@@ -77,8 +80,24 @@ def load_model_sharded(model, rank, cfg):
         print(f"Sharded state checkpoint loaded from {load_dir}")
 
 
-def save_model_and_optimizer_sharded(model, rank, cfg, optim=None):
-    """save model and optimizer via sharded_state_dict to save_dir"""
+def _save_sharded(state_dict, copied, save_dir, process_group, rank, t0):
+    if copied is not None:
+        copied.synchronize()
+    dist_cp.save_state_dict(
+        state_dict=state_dict,
+        storage_writer=dist_cp.FileSystemWriter(save_dir),
+        planner=DefaultSavePlanner(),
+        process_group=process_group,
+    )
+    t1 = time.perf_counter()
+    if rank == 0:
+        print(f"Sharded state checkpoint saved to {save_dir}")
+        print(f"Checkpoint Time = {t1-t0:.4f}\n")
+
+
+def save_model_and_optimizer_sharded(model, rank, cfg, optim=None, writer=None):
+    """save model and optimizer via sharded_state_dict to save_dir
+    with an AsyncCheckpointWriter, only the copy to host memory blocks, and the writer saves it"""
 
     folder_name = (
         cfg.dist_checkpoint_root_folder
@@ -102,6 +121,23 @@ def save_model_and_optimizer_sharded(model, rank, cfg, optim=None):
         if optim is not None:
             state_dict["optim"] = FSDP.optim_state_dict(model, optim)
 
+        if writer is not None:
+            state_dict, copied = snapshot_state_dict(state_dict, writer.process_group)
+            writer.submit(
+                _save_sharded,
+                state_dict,
+                copied,
+                save_dir,
+                writer.process_group,
+                rank,
+                t0,
+            )
+            if rank == 0:
+                print(
+                    f"--> sharded state snapshot taken in {time.perf_counter()-t0:.4f}s, saving in the background"
+                )
+            return
+
         dist_cp.save_state_dict(
             state_dict=state_dict,
             storage_writer=distributed_writer,
@@ -120,8 +156,10 @@ def save_model_checkpoint(
     rank,
     cfg,
     epoch=1,
+    writer=None,
 ):
-    """saving model via rank0 cpu streaming and full_state_dict"""
+    """saving model via rank0 cpu streaming and full_state_dict
+    with an AsyncCheckpointWriter, the writer saves it while training goes on"""
 
     with FSDP.state_dict_type(
         model, StateDictType.FULL_STATE_DICT, fullstate_save_policy
@@ -145,10 +183,17 @@ def save_model_checkpoint(
         save_name = cfg.model_name + "-" + str(epoch) + ".pt"
         save_full_path = str(save_dir) + "/" + save_name
 
-        # save model
-        torch.save(cpu_state, save_full_path)
+        # save model; cpu_state is a copy already, offloaded by FSDP
+        message = f"model checkpoint saved for epoch {epoch} at {save_full_path}\n"
+        if writer is not None:
+            writer.submit(_save_to_disk, cpu_state, save_full_path, message)
+        else:
+            _save_to_disk(cpu_state, save_full_path, message)
 
-        print(f"model checkpoint saved for epoch {epoch} at {save_full_path}\n")
+
+def _save_to_disk(state, path, message):
+    torch.save(state, path)
+    print(message)
 
 
 def load_model_checkpoint(model, rank, cfg):
@@ -176,8 +221,9 @@ def load_model_checkpoint(model, rank, cfg):
     print("model checkpoint loaded to rank0 cpu")
 
 
-def save_optimizer_checkpoint(model, optimizer, rank, cfg, epoch=1):
-    """save optimizer state via full state dict"""
+def save_optimizer_checkpoint(model, optimizer, rank, cfg, epoch=1, writer=None):
+    """save optimizer state via full state dict
+    with an AsyncCheckpointWriter, the writer saves it while training goes on"""
 
     print(f"--> optim state call on rank {rank}\n")
 
@@ -203,9 +249,96 @@ def save_optimizer_checkpoint(model, optimizer, rank, cfg, epoch=1):
 
         print("--> saving optimizer state...")
 
-        torch.save(optim_state, opt_save_full_path)
+        # the gathered state is a copy, except for the step counts
+        optim_state["state"] = {
+            key: {
+                name: value.clone() if torch.is_tensor(value) and value.dim() == 0 else value
+                for name, value in param_state.items()
+            }
+            for key, param_state in optim_state["state"].items()
+        }
+        message = f"--> saved {opt_save_full_path} to disk"
+        if writer is not None:
+            writer.submit(_save_to_disk, optim_state, opt_save_full_path, message)
+        else:
+            _save_to_disk(optim_state, opt_save_full_path, message)
+
+
+def get_trainable_state_dict(model):
+    """
+    The trainable parameters of model, e.g. a PEFT adapter, by their model.state_dict() names.
+    Under FSDP, only the units holding trainable parameters are gathered, to rank 0's cpu, instead of the whole
+    model as model.state_dict() does; other ranks get back placeholders. Must be called on all ranks.
+    """
+    if not isinstance(model, FSDP):
+        return {
+            name: param.detach()
+            for name, param in model.named_parameters()
+            if param.requires_grad
+        }
+
+    state_dict = {}
+    for unit_name, unit in model.named_modules():
+        if not isinstance(unit, FSDP):
+            continue
+        # with the default use_orig_params=False, a unit's own parameters are its flat parameters
+        if not any(p.requires_grad for p in unit.module.parameters(recurse=False)):
+            continue
+        with FSDP.summon_full_params(
+            unit, recurse=False, writeback=False, rank0_only=True, offload_to_cpu=True
+        ):
+            for name, param in unit.module.named_parameters():
+                # skip the flat parameters of this unit and of units nested in it
+                if FSDP_WRAPPED_MODULE in name or "_flat_param" in name:
+                    continue
+                if param.requires_grad:
+                    full_name = f"{unit_name}.{name}" if unit_name else name
+                    state_dict[clean_tensor_name(full_name)] = param.detach().clone()
+    return state_dict
+
+
+def get_trainable_names(model):
+    """
+    The model.state_dict() names of model's trainable parameters. Under FSDP they come from the flat parameters'
+    original names, without gathering anything.
+    """
+    if not isinstance(model, FSDP):
+        return {name for name, param in model.named_parameters() if param.requires_grad}
+
+    names = set()
+    for unit_name, unit in model.named_modules():
+        if not isinstance(unit, FSDP):
+            continue
+        for flat_param in unit.module.parameters(recurse=False):
+            if flat_param.requires_grad and hasattr(flat_param, "_fqns"):
+                names.update(
+                    clean_tensor_name(f"{unit_name}.{fqn}" if unit_name else fqn)
+                    for fqn in flat_param._fqns
+                )
+    return names
+
+
+def save_peft_adapter(model, output_dir, rank, writer=None):
+    """
+    Saves only the PEFT adapter of model, as model.save_pretrained(output_dir) would, without gathering the
+    frozen base model. With an AsyncCheckpointWriter, the adapter is copied to host memory and written by the
+    writer while training goes on.
+    """
+    peft_model = model.module if isinstance(model, FSDP) else model
+    state_dict = get_trainable_state_dict(model)
+    if rank != 0:
+        return
+    state_dict, copied = snapshot_state_dict(state_dict)
+    if writer is not None:
+        writer.submit(_save_peft_adapter, peft_model, state_dict, copied, output_dir)
+    else:
+        _save_peft_adapter(peft_model, state_dict, copied, output_dir)
+
 
-        print(f"--> saved {opt_save_full_path} to disk")
+def _save_peft_adapter(peft_model, state_dict, copied, output_dir):
+    if copied is not None:
+        copied.synchronize()
+    peft_model.save_pretrained(output_dir, state_dict=state_dict)
 
 
 def load_optimizer_checkpoint(model, optimizer_checkpoint_path, rank):
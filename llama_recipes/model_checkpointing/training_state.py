@@ -0,0 +1,149 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
+
+import shutil
+from pathlib import Path
+
+import torch
+import torch.distributed._shard.checkpoint as dist_cp
+from torch.distributed.checkpoint.default_planner import DefaultSavePlanner
+from torch.distributed.checkpoint.optimizer import load_sharded_optimizer_state_dict
+from torch.distributed.fsdp import FullyShardedDataParallel as FSDP, StateDictType
+
+from .async_writer import snapshot_state_dict
+from .checkpoint_handler import get_trainable_names
+
+
+def latest_training_state(root):
+    """the newest complete step-N directory in root, or None"""
+    root = Path(root)
+    if not root.is_dir():
+        return None
+    steps = [
+        path
+        for path in root.iterdir()
+        if path.is_dir() and path.name.startswith("step-") and path.name[5:].isdigit()
+    ]
+    return max(steps, key=lambda path: int(path.name[5:]), default=None)
+
+
+def _get_state(model, optimizer, cfg):
+    # frozen base weights don't change, so only adapters are saved with peft
+    names = get_trainable_names(model) if cfg.use_peft else None
+    if cfg.enable_fsdp:
+        with FSDP.state_dict_type(model, StateDictType.SHARDED_STATE_DICT):
+            model_state = model.state_dict()
+            if names is not None:
+                model_state = {k: v for k, v in model_state.items() if k in names}
+            return {"model": model_state, "optim": FSDP.optim_state_dict(model, optimizer)}
+    model_state = model.state_dict()
+    if names is not None:
+        model_state = {k: v for k, v in model_state.items() if k in names}
+    return {"model": model_state, "optim": optimizer.state_dict()}
+
+
+def save_training_state(model, optimizer, trainer_state, rank, cfg, writer=None):
+    """
+    Saves what's needed to resume training from this step to cfg.training_state_dir/step-N: model weights (only the
+    trainable ones with peft), optimizer state and each rank's trainer_state (data position, scheduler, RNG, ...).
+    The directory only gets its name once every rank's files are written, and all but the newest
+    cfg.max_training_states are then removed. Must be called on all ranks.
+    """
+    num_steps = trainer_state["optimizer_steps"]
+    root = Path.cwd() / cfg.training_state_dir
+    state = _get_state(model, optimizer, cfg)
+    process_group = None
+    copied = None
+    if writer is not None:
+        process_group = writer.process_group
+        state, copied = snapshot_state_dict(state, process_group)
+        trainer_state, _ = snapshot_state_dict(trainer_state)
+    args = (state, trainer_state, copied, root, num_steps, rank, cfg, process_group)
+    if writer is not None:
+        writer.submit(_write_training_state, *args)
+    else:
+        _write_training_state(*args)
+
+
+def _write_training_state(
+    state, trainer_state, copied, root, num_steps, rank, cfg, process_group
+):
+    if copied is not None:
+        copied.synchronize()
+    tmp_dir = root / f"step-{num_steps}.tmp"
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    torch.save(trainer_state, tmp_dir / f"trainer_state-rank{rank}.pt")
+    if cfg.enable_fsdp:
+        # returns on rank 0 once every rank has written its files, trainer state included
+        dist_cp.save_state_dict(
+            state_dict=state,
+            storage_writer=dist_cp.FileSystemWriter(tmp_dir),
+            planner=DefaultSavePlanner(),
+            process_group=process_group,
+        )
+    else:
+        torch.save(state, tmp_dir / "state.pt")
+    if rank != 0:
+        return
+
+    save_dir = root / f"step-{num_steps}"
+    if save_dir.exists():
+        shutil.rmtree(save_dir)
+    tmp_dir.rename(save_dir)
+    print(f"--> training state saved to {save_dir}")
+    saved = sorted(
+        (path for path in root.glob("step-*") if path.name[5:].isdigit()),
+        key=lambda path: int(path.name[5:]),
+    )
+    for path in saved[: -cfg.max_training_states]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def load_training_state(model, optimizer, rank, cfg):
+    """
+    Loads the latest training state in cfg.training_state_dir into model and optimizer, which must be set up as
+    when it was saved. Returns this rank's trainer state, or None if there's nothing to resume from.
+    """
+    path = latest_training_state(Path.cwd() / cfg.training_state_dir)
+    if path is None:
+        if rank == 0:
+            print(f"--> no training state in {cfg.training_state_dir}, starting from scratch")
+        return None
+
+    names = get_trainable_names(model) if cfg.use_peft else None
+    if cfg.enable_fsdp:
+        reader = dist_cp.FileSystemReader(path)
+        with FSDP.state_dict_type(model, StateDictType.SHARDED_STATE_DICT):
+            model_state = model.state_dict()
+            saved_state = {
+                k: v for k, v in model_state.items() if names is None or k in names
+            }
+            dist_cp.load_state_dict(
+                state_dict={"model": saved_state}, storage_reader=reader
+            )
+            model_state.update(saved_state)
+            model.load_state_dict(model_state)
+            optim_state = load_sharded_optimizer_state_dict(
+                model_state_dict=saved_state,
+                optimizer_key="optim",
+                storage_reader=reader,
+            )
+            optimizer.load_state_dict(
+                FSDP.optim_state_dict_to_load(
+                    model=model, optim=optimizer, optim_state_dict=optim_state["optim"]
+                )
+            )
+    else:
+        state = torch.load(path / "state.pt", map_location="cpu", weights_only=False)
+        model.load_state_dict(state["model"], strict=names is None)
+        optimizer.load_state_dict(state["optim"])
+
+    trainer_state = torch.load(
+        path / f"trainer_state-rank{rank}.pt", weights_only=False
+    )
+    if rank == 0:
+        print(
+            f"--> resuming from {path}: epoch {trainer_state['epoch']}, "
+            f"step {trainer_state['step']}"
+        )
+    return trainer_state
@@ -18,12 +18,25 @@ non_reentrant_wrapper = partial(
 check_fn = lambda submodule: isinstance(submodule, LlamaDecoderLayer)
 
 
-def apply_fsdp_checkpointing(model):
-    """apply activation checkpointing to model
+def checkpointed_layer_indices(num_layers, num_checkpointed):
+    """indices of num_checkpointed of num_layers layers, spread evenly (every other layer for half of them)"""
+    return [i * num_layers // num_checkpointed for i in range(num_checkpointed)]
+
+
+def apply_fsdp_checkpointing(model, num_layers=None):
+    """apply activation checkpointing to model, or only to num_layers of its decoder layers
     returns None as model is updated directly
     """
-    print("--> applying fsdp activation checkpointing...")
+    layers = [m for m in model.modules() if isinstance(m, LlamaDecoderLayer)]
+    if num_layers is not None:
+        layers = [
+            layers[i] for i in checkpointed_layer_indices(len(layers), num_layers)
+        ]
+    print(f"--> applying fsdp activation checkpointing to {len(layers)} layers...")
 
+    checkpointed = {id(layer) for layer in layers}
     apply_activation_checkpointing(
-        model, checkpoint_wrapper_fn=non_reentrant_wrapper, check_fn=check_fn
+        model,
+        checkpoint_wrapper_fn=non_reentrant_wrapper,
+        check_fn=lambda submodule: id(submodule) in checkpointed,
     )
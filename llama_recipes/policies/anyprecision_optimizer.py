@@ -9,9 +9,14 @@
 # the weight updates. This allows full training in BFloat16 (equal or
 # better than FP32 results in many cases) due to high precision weight upates.
 
+from collections import defaultdict
+
 import torch
 from torch.optim.optimizer import Optimizer
 
+# Kahan summation copies parameters into a scratch buffer of at least this many elements, a chunk at a time
+KAHAN_SCRATCH_NUMEL = 2**25
+
 
 class AnyPrecisionAdamW(Optimizer):
     def __init__(
@@ -25,6 +30,8 @@ class AnyPrecisionAdamW(Optimizer):
         momentum_dtype=torch.bfloat16,
         variance_dtype=torch.bfloat16,
         compensation_buffer_dtype=torch.bfloat16,
+        foreach=None,
+        fused=False,
     ):
         """
         Args:
@@ -44,6 +51,11 @@ class AnyPrecisionAdamW(Optimizer):
                 variance_dtype = dtype for uncentered variance (default: BFloat16)
                 compensation_buffer_dtype  = dtype for Kahan summation
                                              buffer (default: BFloat16)
+                foreach = update all parameters of a device and dtype together
+                          with torch._foreach_* kernels, rather than one at a
+                          time (default: None, on when all parameters are on cuda)
+                fused = update each parameter in a single torch.compile'd kernel
+                        (default: False)
 
                 # Usage
                 This optimizer implements optimizer states, and Kahan summation
@@ -65,9 +77,27 @@ class AnyPrecisionAdamW(Optimizer):
             momentum_dtype=momentum_dtype,
             variance_dtype=variance_dtype,
             compensation_buffer_dtype=compensation_buffer_dtype,
+            foreach=foreach,
+            fused=fused,
         )
 
         super().__init__(params, defaults)
+        self.kahan_scratch = {}
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.kahan_scratch = {}
+        for group in self.param_groups:
+            group.setdefault("foreach", None)
+            group.setdefault("fused", False)
+
+    def get_kahan_scratch(self, device, dtype, numel):
+        """a flat buffer of at least numel elements, reused across steps instead of cloning parameters"""
+        scratch = self.kahan_scratch.get((device, dtype))
+        if scratch is None or scratch.numel() < numel:
+            scratch = torch.empty(numel, device=device, dtype=dtype)
+            self.kahan_scratch[(device, dtype)] = scratch
+        return scratch
 
     @torch.no_grad()
     def step(self, closure=None):
@@ -83,16 +113,7 @@ class AnyPrecisionAdamW(Optimizer):
                 closure()
 
         for group in self.param_groups:
-            beta1, beta2 = group["betas"]
-            lr = group["lr"]
-            weight_decay = group["weight_decay"]
-            eps = group["eps"]
-            use_kahan_summation = group["use_kahan_summation"]
-
-            momentum_dtype = group["momentum_dtype"]
-            variance_dtype = group["variance_dtype"]
-            compensation_buffer_dtype = group["compensation_buffer_dtype"]
-
+            params = []
             for p in group["params"]:
                 if p.grad is None:
                     continue
@@ -111,67 +132,229 @@ class AnyPrecisionAdamW(Optimizer):
                     # momentum - EMA of gradient values
                     state["exp_avg"] = torch.zeros_like(
                         p,
-                        dtype=momentum_dtype,
+                        dtype=group["momentum_dtype"],
                     )
 
                     # variance uncentered - EMA of squared gradient values
                     state["exp_avg_sq"] = torch.zeros_like(
                         p,
-                        dtype=variance_dtype,
+                        dtype=group["variance_dtype"],
                     )
 
                     # optional Kahan summation - accumulated error tracker
-                    if use_kahan_summation:
+                    if group["use_kahan_summation"]:
                         state["compensation"] = torch.zeros_like(
                             p,
-                            dtype=compensation_buffer_dtype,
+                            dtype=group["compensation_buffer_dtype"],
                         )
 
-                # main processing -------------------------
-
                 # update the steps for each param group update
                 state["step"] += 1
-                step = state["step"]
-
-                exp_avg = state["exp_avg"]
-                exp_avg_sq = state["exp_avg_sq"]
-
-                grad = p.grad
-
-                # weight decay, AdamW style
-                if weight_decay:
-                    p.data.mul_(1 - lr * weight_decay)
-
-                # update momentum
-                exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
-
-                # update uncentered variance
-                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
-
-                # adjust using bias1
-                bias_correction1 = 1 - beta1**step
-
-                step_size = lr / bias_correction1
-
-                # adjust using bias2
-                denom_correction = (1 - beta2**step) ** 0.5  # avoids math import
-
-                centered_variance = (exp_avg_sq.sqrt() / denom_correction).add_(
-                    eps, alpha=1
+                params.append(p)
+
+            if not params:
+                continue
+            foreach = group["foreach"]
+            if foreach is None:
+                foreach = all(p.is_cuda for p in params)
+            if group["fused"]:
+                self._fused_step(group, params)
+            elif foreach:
+                self._multi_tensor_step(group, params)
+            else:
+                self._single_tensor_step(group, params)
+
+    def _single_tensor_step(self, group, params):
+        beta1, beta2 = group["betas"]
+        lr = group["lr"]
+        weight_decay = group["weight_decay"]
+        eps = group["eps"]
+        use_kahan_summation = group["use_kahan_summation"]
+
+        for p in params:
+            state = self.state[p]
+            step = state["step"]
+
+            exp_avg = state["exp_avg"]
+            exp_avg_sq = state["exp_avg_sq"]
+
+            grad = p.grad
+
+            # weight decay, AdamW style
+            if weight_decay:
+                p.data.mul_(1 - lr * weight_decay)
+
+            # update momentum
+            exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+
+            # update uncentered variance
+            exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+
+            # adjust using bias1
+            bias_correction1 = 1 - beta1**step
+
+            step_size = lr / bias_correction1
+
+            # adjust using bias2
+            denom_correction = (1 - beta2**step) ** 0.5  # avoids math import
+
+            centered_variance = (exp_avg_sq.sqrt() / denom_correction).add_(
+                eps, alpha=1
+            )
+
+            # lr update to compensation
+            if use_kahan_summation:
+                compensation = state["compensation"]
+
+                compensation.addcdiv_(exp_avg, centered_variance, value=-step_size)
+
+                # update weights with compensation (Kahan summation)
+                # save error back to compensation for next iteration
+                temp_buffer = self.get_kahan_scratch(p.device, p.dtype, p.numel())
+                temp_buffer = temp_buffer[: p.numel()].view_as(p).copy_(p)
+                p.data.add_(compensation)
+                compensation.add_(temp_buffer.sub_(p.data))
+
+            else:
+                # usual AdamW updates
+                p.data.addcdiv_(exp_avg, centered_variance, value=-step_size)
+
+    def _multi_tensor_step(self, group, params):
+        """the same update as _single_tensor_step, a few kernels per device and dtype rather than per parameter"""
+        beta1, beta2 = group["betas"]
+        lr = group["lr"]
+        weight_decay = group["weight_decay"]
+        eps = group["eps"]
+        use_kahan_summation = group["use_kahan_summation"]
+
+        grouped = defaultdict(list)
+        for p in params:
+            grouped[(p.device, p.dtype)].append(p)
+
+        for (device, dtype), group_params in grouped.items():
+            states = [self.state[p] for p in group_params]
+            grads = [p.grad for p in group_params]
+            exp_avgs = [state["exp_avg"] for state in states]
+            exp_avg_sqs = [state["exp_avg_sq"] for state in states]
+            # per parameter, in float32 like the single tensor step (steps live on the cpu, so no sync)
+            steps = [state["step"] for state in states]
+            step_sizes = [-(lr / (1 - beta1**step)).item() for step in steps]
+            denom_corrections = [((1 - beta2**step) ** 0.5).item() for step in steps]
+
+            if weight_decay:
+                torch._foreach_mul_(group_params, _scalar(1 - lr * weight_decay, device))
+
+            torch._foreach_mul_(exp_avgs, _scalar(beta1, device))
+            torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+
+            torch._foreach_mul_(exp_avg_sqs, _scalar(beta2, device))
+            torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+
+            centered_variances = torch._foreach_sqrt(exp_avg_sqs)
+            torch._foreach_div_(centered_variances, denom_corrections)
+            torch._foreach_add_(centered_variances, eps)
+
+            if not use_kahan_summation:
+                torch._foreach_addcdiv_(
+                    group_params, exp_avgs, centered_variances, step_sizes
                 )
-
-                # lr update to compensation
-                if use_kahan_summation:
-                    compensation = state["compensation"]
-
-                    compensation.addcdiv_(exp_avg, centered_variance, value=-step_size)
-
-                    # update weights with compensation (Kahan summation)
-                    # save error back to compensation for next iteration
-                    temp_buffer = p.detach().clone()
-                    p.data.add_(compensation)
-                    compensation.add_(temp_buffer.sub_(p.data))
-
-                else:
-                    # usual AdamW updates
-                    p.data.addcdiv_(exp_avg, centered_variance, value=-step_size)
+                continue
+
+            compensations = [state["compensation"] for state in states]
+            torch._foreach_addcdiv_(
+                compensations, exp_avgs, centered_variances, step_sizes
+            )
+            del centered_variances
+
+            # Kahan summation, through the scratch buffer a chunk of parameters at a time
+            scratch = self.get_kahan_scratch(
+                device,
+                dtype,
+                max(KAHAN_SCRATCH_NUMEL, max(p.numel() for p in group_params)),
+            )
+            start = 0
+            while start < len(group_params):
+                end, numel = start, 0
+                while end < len(group_params) and (
+                    end == start or numel + group_params[end].numel() <= scratch.numel()
+                ):
+                    numel += group_params[end].numel()
+                    end += 1
+                chunk = group_params[start:end]
+                temp_buffers = []
+                offset = 0
+                for p in chunk:
+                    temp_buffers.append(scratch[offset : offset + p.numel()].view_as(p))
+                    offset += p.numel()
+                torch._foreach_copy_(temp_buffers, chunk)
+                torch._foreach_add_(chunk, compensations[start:end])
+                torch._foreach_sub_(temp_buffers, chunk)
+                torch._foreach_add_(compensations[start:end], temp_buffers)
+                start = end
+
+    def _fused_step(self, group, params):
+        """one compiled kernel per parameter; intermediates stay in float32 instead of the state dtypes"""
+        beta1, beta2 = group["betas"]
+        lr = group["lr"]
+        weight_decay = group["weight_decay"]
+        eps = group["eps"]
+
+        for p in params:
+            state = self.state[p]
+            step = state["step"]
+            # tensors rather than floats, so changing values don't recompile the kernel
+            hyperparameters = torch.tensor(
+                [
+                    lr,
+                    beta1,
+                    beta2,
+                    eps,
+                    weight_decay,
+                    (lr / (1 - beta1**step)).item(),
+                    ((1 - beta2**step) ** 0.5).item(),
+                ],
+                dtype=torch.float32,
+            ).to(p.device, non_blocking=True)
+            fused_adamw_update(
+                p,
+                p.grad,
+                state["exp_avg"],
+                state["exp_avg_sq"],
+                state.get("compensation"),
+                hyperparameters,
+            )
+
+
+def _scalar(value, device):
+    # the cpu fallback of in-place foreach ops rounds python scalars to the tensors' dtype (0.9 -> 0.8984375 in
+    # bfloat16) before multiplying, unlike the single tensor ops; 0-dim tensors are multiplied in float32
+    return torch.tensor(value) if device.type == "cpu" else value
+
+
+def _adamw_update(p, grad, exp_avg, exp_avg_sq, compensation, hyperparameters):
+    lr, beta1, beta2, eps, weight_decay, step_size, denom_correction = hyperparameters.unbind()
+    param = p.float() * (1 - lr * weight_decay)
+    grad = grad.float()
+    new_exp_avg = exp_avg.float() * beta1 + grad * (1 - beta1)
+    new_exp_avg_sq = exp_avg_sq.float() * beta2 + grad * grad * (1 - beta2)
+    update = -step_size * new_exp_avg / (new_exp_avg_sq.sqrt() / denom_correction + eps)
+    exp_avg.copy_(new_exp_avg)
+    exp_avg_sq.copy_(new_exp_avg_sq)
+    if compensation is None:
+        p.copy_(param + update)
+        return
+    # Kahan summation: carry what the rounding to p's dtype lost over to the next step
+    total = compensation.float() + update
+    new_p = (param + total).to(p.dtype)
+    compensation.copy_(total + (param - new_p.float()))
+    p.copy_(new_p)
+
+
+_compiled_adamw_update = None
+
+
+def fused_adamw_update(*args):
+    global _compiled_adamw_update
+    if _compiled_adamw_update is None:
+        _compiled_adamw_update = torch.compile(_adamw_update, dynamic=True)
+    _compiled_adamw_update(*args)
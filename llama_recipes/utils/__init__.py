@@ -4,4 +4,6 @@
 from .memory_utils import MemoryTrace
 from .dataset_utils import *
 from .fsdp_utils import fsdp_auto_wrap_policy
+from .packing_utils import DataCollatorForPackedSequences, enable_document_attention
+from .sampler_utils import LengthGroupedBatchSampler
 from .train_utils import *
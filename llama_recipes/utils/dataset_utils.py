@@ -1,11 +1,22 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates.
 # This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
 
+import dataclasses
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import time
+
+import datasets
 import torch
+import torch.distributed as dist
 
 from functools import partial
 
 
+import ft_datasets
 from ft_datasets import (
     get_grammar_dataset,
     get_alpaca_dataset,
@@ -22,8 +33,74 @@ DATASET_PREPROC = {
 }
 
 
+def _hash_file(h, path: str) -> None:
+    with open(path, "rb") as f:
+        while block := f.read(1 << 23):
+            h.update(block)
+
+
+def hash_path(h, path: str) -> None:
+    """
+    feeds the contents of a file, or of every file under a directory along with its path within it, into h;
+    where the file or directory itself is doesn't matter
+    """
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                h.update(os.path.relpath(file_path, path).encode())
+                _hash_file(h, file_path)
+        return
+    # the extension picks how the data is loaded
+    h.update(os.path.splitext(path)[1].encode())
+    _hash_file(h, path)
+
+
+def get_dataset_cache_key(tokenizer, dataset_config, split: str) -> str:
+    """
+    Hash of everything that goes into a preprocessed dataset: the data files, the tokenizer, the dataset
+    config (max_seq_length, chunk_size, packing...) and the code of the builder, which holds the template.
+    """
+    h = hashlib.sha256()
+    config = {
+        f.name: getattr(dataset_config, f.name)
+        for f in dataclasses.fields(dataset_config)
+    }
+    # doesn't change the result
+    config.pop("num_proc", None)
+    # data files are hashed by their contents, not where they are, e.g. a new temporary path every run
+    paths = {
+        name: config.pop(name)
+        for name, value in list(config.items())
+        if isinstance(value, str) and os.path.exists(value)
+    }
+    h.update(json.dumps([split, config], sort_keys=True, default=str).encode())
+    for name, path in sorted(paths.items()):
+        h.update(name.encode())
+        hash_path(h, path)
+
+    tokenizer_state = [
+        type(tokenizer).__name__,
+        tokenizer.special_tokens_map,
+        tokenizer.get_added_vocab(),
+        tokenizer.model_max_length,
+        getattr(tokenizer, "legacy", None),
+    ]
+    h.update(json.dumps(tokenizer_state, sort_keys=True, default=str).encode())
+    vocab_file = getattr(tokenizer, "vocab_file", None)
+    if vocab_file and os.path.exists(vocab_file):
+        hash_path(h, vocab_file)
+
+    builder = DATASET_PREPROC[dataset_config.dataset]
+    builder = getattr(builder, "func", builder)
+    for module in (inspect.getmodule(builder), ft_datasets.utils):
+        h.update(inspect.getsource(module).encode())
+    return h.hexdigest()[:32]
+
+
 def get_preprocessed_dataset(
-    tokenizer, dataset_config, split: str = "train"
+    tokenizer, dataset_config, split: str = "train", cache_dir: str = None
 ) -> torch.utils.data.Dataset:
     if dataset_config.dataset not in DATASET_PREPROC:
         raise NotImplementedError(f"{dataset_config.dataset} is not (yet) implemented")
@@ -35,8 +112,44 @@ def get_preprocessed_dataset(
             else dataset_config.test_split
         )
 
-    return DATASET_PREPROC[dataset_config.dataset](
-        dataset_config,
-        tokenizer,
-        get_split(),
-    )
+    def build():
+        return DATASET_PREPROC[dataset_config.dataset](
+            dataset_config,
+            tokenizer,
+            get_split(),
+        )
+
+    if not cache_dir:
+        return build()
+
+    distributed = dist.is_initialized()
+    if distributed and dist.get_rank() != 0:
+        # wait for rank 0 to fill the cache, then load what it wrote
+        dist.barrier()
+
+    start = time.time()
+    key = get_dataset_cache_key(tokenizer, dataset_config, split)
+    path = os.path.join(cache_dir, f"{dataset_config.dataset}-{split}-{key}")
+    if os.path.exists(path):
+        dataset = datasets.load_from_disk(path)
+        print(f"--> Loaded preprocessed {split} dataset from {path} in {time.time() - start:.2f}s")
+    else:
+        dataset = build()
+        print(f"--> Preprocessed {split} dataset in {time.time() - start:.2f}s")
+        # only Arrow datasets can be cached, the others (alpaca, grammar) tokenize lazily anyway
+        if isinstance(dataset, datasets.Dataset) and (
+            not distributed or dist.get_rank() == 0
+        ):
+            tmp_path = f"{path}.tmp-{os.getpid()}"
+            dataset.save_to_disk(tmp_path)
+            if os.path.exists(path):
+                # another run got there first
+                shutil.rmtree(tmp_path)
+            else:
+                os.replace(tmp_path, path)
+            # read back from the cache so the dataset is memory-mapped rather than held in memory
+            dataset = datasets.load_from_disk(path)
+
+    if distributed and dist.get_rank() == 0:
+        dist.barrier()
+    return dataset
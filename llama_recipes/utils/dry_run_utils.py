@@ -0,0 +1,168 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
+
+import json
+import math
+import time
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+from .train_utils import get_diagnostics_path, gradient_sync_context
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def profile_training_steps(
+    model,
+    train_dataloader,
+    optimizer,
+    gradient_accumulation_steps,
+    num_steps,
+    device,
+    warmup_steps=1,
+    no_sync=False,
+):
+    """
+    Runs warmup_steps + num_steps real optimizer steps, going round train_dataloader as often as needed, and
+    times each of the last num_steps, waiting for the GPU after every one. Returns their times and the real
+    (not padding) and padded tokens each one trained on.
+    """
+    model.train()
+
+    def batches():
+        while True:
+            yield from train_dataloader
+
+    batch_iter = batches()
+    step_times, real_tokens, padded_tokens = [], [], []
+    for step in range(warmup_steps + num_steps):
+        synchronize()
+        start = time.perf_counter()
+        real, padded = 0, 0
+        for micro_step in range(gradient_accumulation_steps):
+            batch = next(batch_iter)
+            for key in batch.keys():
+                batch[key] = batch[key].to(device, non_blocking=True)
+            sync = micro_step == gradient_accumulation_steps - 1
+            with gradient_sync_context(model, sync or not no_sync):
+                loss = model(**batch).loss / gradient_accumulation_steps
+                loss.backward()
+            if "attention_mask" in batch:
+                real += int(batch["attention_mask"].ne(0).sum())
+            else:
+                real += batch["input_ids"].numel()
+            padded += batch["input_ids"].numel()
+        optimizer.step()
+        optimizer.zero_grad()
+        synchronize()
+        if step >= warmup_steps:
+            step_times.append(time.perf_counter() - start)
+            real_tokens.append(real)
+            padded_tokens.append(padded)
+    return step_times, real_tokens, padded_tokens
+
+
+def project_training_run(
+    step_times,
+    real_tokens,
+    padded_tokens,
+    steps_per_epoch,
+    num_epochs,
+    world_size=1,
+    gpu_hourly_cost=None,
+):
+    """
+    Throughput of the profiled steps, and the wall time (and cost, at gpu_hourly_cost per GPU hour) of
+    num_epochs epochs of steps_per_epoch steps at the median step time. Token counts are of all world_size
+    ranks together.
+    """
+    step_times = np.array(step_times)
+    step_time = float(np.median(step_times))
+    tokens_per_step = sum(real_tokens) / len(real_tokens)
+    total_steps = steps_per_epoch * num_epochs
+    hours = total_steps * step_time / 3600
+    report = {
+        "step_time_p50": step_time,
+        "step_time_p90": float(np.percentile(step_times, 90)),
+        "tokens_per_step": tokens_per_step,
+        "tokens_per_sec": tokens_per_step / step_time,
+        "padding_efficiency": sum(real_tokens) / sum(padded_tokens),
+        "steps_per_epoch": steps_per_epoch,
+        "total_steps": total_steps,
+        "projected_tokens": tokens_per_step * total_steps,
+        "projected_hours": hours,
+        "projected_gpu_hours": hours * world_size,
+    }
+    if gpu_hourly_cost is not None:
+        report["projected_cost"] = hours * world_size * gpu_hourly_cost
+    return report
+
+
+def dry_run(
+    model,
+    train_dataloader,
+    optimizer,
+    gradient_accumulation_steps,
+    train_config,
+    device,
+    data_fraction=1.0,
+    world_size=1,
+    rank=0,
+    no_sync=False,
+):
+    """
+    Profiles train_config.dry_run_steps steps on the (sampled) training data, and projects the full run from
+    them. data_fraction is the fraction of the training data the dataloader holds. The report is printed and,
+    on rank 0, written to train_config.dry_run_file (in diagnostics_dir, unless it's absolute) as JSON.
+    """
+    step_times, real_tokens, padded_tokens = profile_training_steps(
+        model,
+        train_dataloader,
+        optimizer,
+        gradient_accumulation_steps,
+        train_config.dry_run_steps,
+        device,
+        no_sync=no_sync,
+    )
+    if world_size > 1:
+        tokens = torch.tensor([real_tokens, padded_tokens], dtype=torch.float64, device=device)
+        dist.all_reduce(tokens)
+        real_tokens, padded_tokens = tokens.tolist()
+    steps_per_epoch = math.ceil(
+        len(train_dataloader) / data_fraction / gradient_accumulation_steps
+    )
+    report = project_training_run(
+        step_times,
+        real_tokens,
+        padded_tokens,
+        steps_per_epoch,
+        train_config.num_epochs,
+        world_size,
+        train_config.gpu_hourly_cost,
+    )
+    report.update(
+        batch_size_training=train_config.batch_size_training,
+        gradient_accumulation_steps=gradient_accumulation_steps,
+        world_size=world_size,
+        pack_sequences=train_config.pack_sequences,
+        chunk_size=train_config.chunk_size,
+        data_fraction=data_fraction,
+    )
+    if rank == 0:
+        print(
+            f"--> Dry run: {report['step_time_p50']:.2f}s per step, {report['tokens_per_sec']:.0f} tokens/s, "
+            f"padding efficiency {report['padding_efficiency']:.1%}. {report['total_steps']} steps over "
+            f"{train_config.num_epochs} epochs would take {report['projected_hours']:.2f} hours "
+            f"({report['projected_gpu_hours']:.2f} GPU hours)"
+            + (f", costing {report['projected_cost']:.2f}" if "projected_cost" in report else "")
+        )
+        dry_run_path = get_diagnostics_path(train_config, train_config.dry_run_file)
+        if dry_run_path:
+            with open(dry_run_path, "w") as f:
+                json.dump(report, f, indent=2)
+    return report
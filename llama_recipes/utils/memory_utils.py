@@ -1,7 +1,11 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates.
 # This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
+import csv
 import gc
+import json
+import os
 import threading
+import time
 
 import psutil
 import torch
@@ -11,54 +15,145 @@ def byte2gb(x):
     return int(x / 2**30)
 
 
+def reset_peak_rss():
+    """resets the kernel's high-water mark of resident memory for this process, where supported (Linux)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_rss():
+    """the kernel's high-water mark of resident memory for this process in bytes, or None if unavailable"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def get_timeline_path(template, name, rank=0):
+    """memory timeline path for one traced block, e.g. memory_timeline.json -> memory_timeline-train_epoch0-rank0.json"""
+    if not template:
+        return None
+    root, ext = os.path.splitext(template)
+    return f"{root}-{name}-rank{rank}{ext}"
+
+
 # This context manager is used to track the peak memory usage of the process
 class MemoryTrace:
+    """
+    Samples CPU RSS and CUDA allocated/reserved memory every `interval` seconds on a background thread, which
+    sleeps in between. Peaks don't depend on sampling: CUDA peaks come from the allocator's stats and the CPU peak
+    from the kernel's high-water mark, where available. If `timeline_path` is set, the samples are written there on
+    exit, as CSV if it ends with .csv and as a Chrome trace (chrome://tracing, Perfetto) otherwise.
+    """
+
+    def __init__(self, interval=0.1, timeline_path=None):
+        self.interval = interval
+        self.timeline_path = timeline_path
+
     def __enter__(self):
         gc.collect()
-        torch.cuda.empty_cache()
-        torch.cuda.reset_max_memory_allocated()  # reset the peak gauge to zero
-        self.begin = byte2gb(torch.cuda.memory_allocated())
+        self.cuda = torch.cuda.is_available()
+        if self.cuda:
+            torch.cuda.empty_cache()
+            torch.cuda.reset_max_memory_allocated()  # reset the peak gauge to zero
+            self.device = torch.cuda.current_device()
+            self.begin = byte2gb(torch.cuda.memory_allocated(self.device))
+        else:
+            self.begin = 0
         self.process = psutil.Process()
+        self.exact_cpu_peak = reset_peak_rss()
         self.cpu_begin = byte2gb(self.cpu_mem_used())
-        self.peak_monitoring = True
-        peak_monitor_thread = threading.Thread(target=self.peak_monitor_func)
-        peak_monitor_thread.daemon = True
-        peak_monitor_thread.start()
+        self.cpu_peak = -1
+        self.samples = []
+        self.start_time = time.time()
+        self.peak_monitoring = threading.Event()
+        self.peak_monitor_thread = threading.Thread(target=self.peak_monitor_func)
+        self.peak_monitor_thread.daemon = True
+        self.peak_monitor_thread.start()
         return self
 
     def cpu_mem_used(self):
         """get resident set size memory for the current process"""
         return self.process.memory_info().rss
 
-    def peak_monitor_func(self):
-        self.cpu_peak = -1
-
-        while True:
-            self.cpu_peak = max(self.cpu_mem_used(), self.cpu_peak)
-
-            # can't sleep or will not catch the peak right (this comment is here on purpose)
-            # time.sleep(0.001) # 1msec
+    def sample(self):
+        cpu = self.cpu_mem_used()
+        self.cpu_peak = max(cpu, self.cpu_peak)
+        if self.cuda:
+            allocated = torch.cuda.memory_allocated(self.device)
+            reserved = torch.cuda.memory_reserved(self.device)
+        else:
+            allocated = reserved = 0
+        self.samples.append((time.time() - self.start_time, cpu, allocated, reserved))
 
-            if not self.peak_monitoring:
-                break
+    def peak_monitor_func(self):
+        self.sample()
+        while not self.peak_monitoring.wait(self.interval):
+            self.sample()
 
     def __exit__(self, *exc):
-        self.peak_monitoring = False
+        self.peak_monitoring.set()
+        self.peak_monitor_thread.join()
+        self.sample()
 
         gc.collect()
-        torch.cuda.empty_cache()
-        self.end = byte2gb(torch.cuda.memory_allocated())
-        self.peak = byte2gb(torch.cuda.max_memory_allocated())
-        cuda_info = torch.cuda.memory_stats()
-        self.peak_active_gb = byte2gb(cuda_info["active_bytes.all.peak"])
-        self.cuda_malloc_retires = cuda_info.get("num_alloc_retries", 0)
-        self.peak_active_gb = byte2gb(cuda_info["active_bytes.all.peak"])
-        self.m_cuda_ooms = cuda_info.get("num_ooms", 0)
+        if self.cuda:
+            torch.cuda.empty_cache()
+            self.end = byte2gb(torch.cuda.memory_allocated(self.device))
+            self.peak = byte2gb(torch.cuda.max_memory_allocated(self.device))
+            cuda_info = torch.cuda.memory_stats(self.device)
+            self.peak_active_gb = byte2gb(cuda_info["active_bytes.all.peak"])
+            self.cuda_malloc_retires = cuda_info.get("num_alloc_retries", 0)
+            self.m_cuda_ooms = cuda_info.get("num_ooms", 0)
+            self.max_reserved = byte2gb(torch.cuda.max_memory_reserved(self.device))
+        else:
+            self.end = self.peak = self.peak_active_gb = self.max_reserved = 0
+            self.cuda_malloc_retires = self.m_cuda_ooms = 0
         self.used = byte2gb(self.end - self.begin)
         self.peaked = byte2gb(self.peak - self.begin)
-        self.max_reserved = byte2gb(torch.cuda.max_memory_reserved())
 
+        if self.exact_cpu_peak:
+            self.cpu_peak = max(get_peak_rss() or 0, self.cpu_peak)
         self.cpu_end = self.cpu_mem_used()
         self.cpu_used = byte2gb(self.cpu_end - self.cpu_begin)
         self.cpu_peaked = byte2gb(self.cpu_peak - self.cpu_begin)
         # print(f"delta used/peak {self.used:4d}/{self.peaked:4d}")
+
+        if self.timeline_path:
+            self.export_timeline(self.timeline_path)
+
+    def export_timeline(self, path):
+        """writes the sampled memory timeline, as CSV or as Chrome trace counter events"""
+        if path.endswith(".csv"):
+            with open(path, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(
+                    ["time_s", "cpu_rss_bytes", "cuda_allocated_bytes", "cuda_reserved_bytes"]
+                )
+                writer.writerows(self.samples)
+            return
+
+        events = [
+            {
+                "name": "memory (MB)",
+                "ph": "C",
+                "ts": (self.start_time + t) * 1e6,
+                "pid": os.getpid(),
+                "args": {
+                    "cpu_rss": cpu / 2**20,
+                    "cuda_allocated": allocated / 2**20,
+                    "cuda_reserved": reserved / 2**20,
+                },
+            }
+            for t, cpu, allocated, reserved in self.samples
+        ]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
@@ -0,0 +1,202 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
+
+import json
+import time
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+# dense bf16/fp16 tensor core peak, in TFLOPS, by substring of the device name
+PEAK_TFLOPS = {
+    "H100": 989.0,
+    "A100": 312.0,
+    "L40": 181.0,
+    "4090": 165.2,
+    "A40": 149.7,
+    "A6000": 154.8,
+    "A10": 125.0,
+    "V100": 125.0,
+    "L4": 121.0,
+    "T4": 65.0,
+}
+
+
+def get_peak_flops(device=None):
+    """peak FLOPS of a cuda device, or None if unknown"""
+    if not torch.cuda.is_available():
+        return None
+    name = torch.cuda.get_device_name(device)
+    for key, tflops in PEAK_TFLOPS.items():
+        if key in name:
+            return tflops * 1e12
+    return None
+
+
+def get_flops_per_token(model, world_size=1):
+    """
+    Rough training FLOPs per token: 2 per parameter for the forward pass, 2 more for activation gradients and,
+    when the base weights are trained, 2 more for their gradients. Attention scores are ignored.
+    """
+    # FSDP flattens and shards parameters, so each rank only sees its share
+    num_params = sum(p.numel() for p in model.parameters()) * world_size
+    num_trainable = sum(p.numel() for p in model.parameters() if p.requires_grad)
+    full_finetune = num_trainable * world_size > num_params / 2
+    return (6 if full_finetune else 4) * num_params
+
+
+class TrainingMetrics:
+    """
+    Accumulates training metrics without synchronizing with the GPU on every step.
+
+    Loss and token counts are summed on device; every `log_every` steps the sums are all-reduced and copied to
+    pinned memory asynchronously, and only read back at the following flush, by which point the copy has long
+    finished. Step times come from CUDA events read at the same time. Each report (loss, tokens/sec, samples/sec,
+    step time percentiles, estimated MFU and padding fraction) is printed and appended to `path` as a JSON line.
+    """
+
+    def __init__(
+        self,
+        device,
+        log_every: int = 10,
+        path: str = None,
+        flops_per_token: float = None,
+        peak_flops: float = None,
+        world_size: int = 1,
+        rank: int = 0,
+    ):
+        self.device = torch.device(device)
+        self.cuda = self.device.type == "cuda"
+        self.log_every = log_every
+        self.path = path
+        self.flops_per_token = flops_per_token
+        self.peak_flops = peak_flops
+        self.world_size = world_size
+        self.rank = rank
+        self.step = 0
+        self.epoch = 0
+        self.pending = None
+        # loss, real tokens, padded tokens, samples
+        self.sums = torch.zeros(4, dtype=torch.float64, device=self.device)
+        self.steps = 0
+        self.marks = []
+
+    def _mark(self):
+        """a point in time on the device stream, without waiting for it"""
+        if self.cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def _elapsed(self, start, end):
+        if self.cuda:
+            return start.elapsed_time(end) / 1000
+        return end - start
+
+    def start_epoch(self, epoch: int) -> None:
+        """starts timing afresh, so time spent between epochs (evaluation, checkpoints) isn't counted"""
+        self.flush()
+        self.epoch = epoch
+        self.marks = [self._mark()]
+
+    def update(self, loss: torch.Tensor, batch: dict) -> None:
+        """records a training step; `loss` is the unscaled loss of `batch`"""
+        input_ids = batch["input_ids"]
+        self.sums[0] += loss.detach().float()
+        if "attention_mask" in batch:
+            self.sums[1] += batch["attention_mask"].ne(0).sum()
+        else:
+            self.sums[1] += input_ids.numel()
+        self.sums[2] += input_ids.numel()
+        self.sums[3] += input_ids.shape[0]
+        self.step += 1
+        self.steps += 1
+        self.marks.append(self._mark())
+        if self.steps >= self.log_every:
+            self.flush()
+
+    def flush(self) -> None:
+        """reports the previous interval, and starts copying this one to the host"""
+        if self.pending is not None:
+            self._report(*self.pending)
+            self.pending = None
+        if not self.steps:
+            return
+        sums = self.sums
+        if self.world_size > 1:
+            dist.all_reduce(sums)
+        if self.cuda:
+            host = torch.empty(sums.shape, dtype=sums.dtype, pin_memory=True)
+            host.copy_(sums, non_blocking=True)
+        else:
+            host = sums.clone()
+        self.pending = (self.step, self.epoch, self.steps, host, self.marks, self._mark())
+        self.sums = torch.zeros_like(sums)
+        self.steps = 0
+        self.marks = [self.marks[-1]]
+
+    def close(self) -> None:
+        """reports everything recorded so far"""
+        self.flush()
+        self.flush()
+
+    def log_eval(self, loss: float, perplexity: float, accuracy: float) -> None:
+        """
+        appends an evaluation at the current step to `path`, alongside the training reports; the time it took
+        isn't counted in the next step's time
+        """
+        if self.marks:
+            self.marks[-1] = self._mark()
+        if self.rank != 0 or not self.path:
+            return
+        metrics = {
+            "epoch": self.epoch,
+            "step": self.step,
+            "eval_loss": loss,
+            "eval_perplexity": perplexity,
+            "eval_accuracy": accuracy,
+        }
+        with open(self.path, "a") as f:
+            f.write(json.dumps(metrics) + "\n")
+
+    def _report(self, step, epoch, steps, host, marks, copied):
+        if self.cuda:
+            copied.synchronize()
+        loss, real_tokens, padded_tokens, samples = host.tolist()
+        step_times = np.array(
+            [self._elapsed(start, end) for start, end in zip(marks, marks[1:])]
+        )
+        elapsed = step_times.sum()
+        metrics = {
+            "epoch": epoch,
+            "step": step,
+            # the loss of each rank is summed by the all-reduce
+            "loss": loss / steps / self.world_size,
+            "tokens_per_sec": real_tokens / elapsed,
+            "samples_per_sec": samples / elapsed,
+            "step_time_p50": float(np.percentile(step_times, 50)),
+            "step_time_p90": float(np.percentile(step_times, 90)),
+            "step_time_p99": float(np.percentile(step_times, 99)),
+            "padding_fraction": 1 - real_tokens / padded_tokens,
+        }
+        if self.flops_per_token and self.peak_flops:
+            metrics["mfu"] = (
+                self.flops_per_token * padded_tokens / elapsed
+                / (self.peak_flops * self.world_size)
+            )
+        if self.rank != 0:
+            return
+        report = (
+            f"step {step}: loss {metrics['loss']:.4f}, {metrics['tokens_per_sec']:.0f} tokens/s, "
+            f"{metrics['samples_per_sec']:.2f} samples/s, step time p50/p90/p99 "
+            f"{metrics['step_time_p50'] * 1000:.0f}/{metrics['step_time_p90'] * 1000:.0f}/"
+            f"{metrics['step_time_p99'] * 1000:.0f} ms, padding {metrics['padding_fraction']:.1%}"
+        )
+        if "mfu" in metrics:
+            report += f", MFU {metrics['mfu']:.1%}"
+        print(report)
+        if self.path:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(metrics) + "\n")
@@ -0,0 +1,74 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
+
+import types
+
+import torch
+from transformers import DataCollatorForTokenClassification
+from transformers.models.llama.modeling_llama import LlamaModel
+
+
+class DataCollatorForPackedSequences(DataCollatorForTokenClassification):
+    """
+    Collates sequences packed by ft_datasets.utils.pack_best_fit, padding their position_ids alongside the
+    input_ids, labels and attention_mask (whose values are document indices, and survive padding as they are).
+    """
+
+    def torch_call(self, features):
+        position_ids = [feature["position_ids"] for feature in features]
+        batch = super().torch_call(
+            [{k: v for k, v in f.items() if k != "position_ids"} for f in features]
+        )
+        sequence_length = batch["input_ids"].shape[1]
+        padded = torch.zeros((len(features), sequence_length), dtype=torch.long)
+        for i, ids in enumerate(position_ids):
+            if self.tokenizer.padding_side == "right":
+                padded[i, : len(ids)] = torch.tensor(ids)
+            else:
+                padded[i, sequence_length - len(ids) :] = torch.tensor(ids)
+        batch["position_ids"] = padded
+        return batch
+
+
+def _prepare_document_attention_mask(
+    self, attention_mask, input_shape, inputs_embeds, past_key_values_length
+):
+    """
+    Builds a causal mask that is also block-diagonal over documents: tokens attend to earlier tokens with the same
+    document index in attention_mask, and never to padding (index 0). A plain 0/1 mask gives the usual causal mask.
+    """
+    if past_key_values_length or input_shape[-1] == 1:
+        return LlamaModel._prepare_decoder_attention_mask(
+            self,
+            attention_mask.clamp(max=1),
+            input_shape,
+            inputs_embeds,
+            past_key_values_length,
+        )
+    sequence_length = input_shape[-1]
+    causal = torch.ones(
+        (sequence_length, sequence_length), dtype=torch.bool, device=inputs_embeds.device
+    ).tril()
+    documents = attention_mask.to(inputs_embeds.device)
+    allowed = (
+        (documents[:, :, None] == documents[:, None, :])
+        & (documents[:, None, :] != 0)
+        & causal
+    )
+    mask = torch.zeros(allowed.shape, dtype=inputs_embeds.dtype, device=inputs_embeds.device)
+    mask.masked_fill_(~allowed, torch.finfo(inputs_embeds.dtype).min)
+    # [bsz, seq_len, seq_len] -> [bsz, 1, seq_len, seq_len]
+    return mask[:, None]
+
+
+def enable_document_attention(model):
+    """Makes every LlamaModel in `model` read packed document boundaries from attention_mask."""
+    patched = 0
+    for module in model.modules():
+        if isinstance(module, LlamaModel):
+            module._prepare_decoder_attention_mask = types.MethodType(
+                _prepare_document_attention_mask, module
+            )
+            patched += 1
+    if not patched:
+        raise ValueError("Document attention needs a Llama model")
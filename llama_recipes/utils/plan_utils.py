@@ -0,0 +1,198 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
+
+from dataclasses import dataclass
+
+import torch
+
+# Estimates the GPU memory of a Llama fine-tune from its config, and plans the micro-batch size and number of
+# activation checkpointed layers from it. Activation sizes follow what transformers' Llama saves for backward
+# (measured with measure_saved_bytes, see tests/unit_tests/test_plan_utils.py): RMSNorm keeps its input upcast to
+# fp32, attention keeps the rotated queries and keys, the values and the softmax in fp32 and in the model dtype,
+# and the MLP keeps its three intermediate-width activations. Frozen projections don't keep their inputs, but
+# LoRA adapters on them do.
+
+
+@dataclass
+class MemoryPlan:
+    batch_size: int
+    gradient_accumulation_steps: int
+    checkpointed_layers: int
+    estimated_bytes: int
+    budget_bytes: int
+
+
+# projections reading the same tensor
+PROJECTION_INPUTS = {
+    "q_proj": "attention",
+    "k_proj": "attention",
+    "v_proj": "attention",
+    "o_proj": "attention_output",
+    "gate_proj": "mlp",
+    "up_proj": "mlp",
+    "down_proj": "mlp_hidden",
+}
+
+
+def _projection_widths(config):
+    """(input, output) features of each projection in a decoder layer"""
+    hidden, intermediate = config.hidden_size, config.intermediate_size
+    kv_width = hidden // config.num_attention_heads * getattr(
+        config, "num_key_value_heads", config.num_attention_heads
+    )
+    return {
+        "q_proj": (hidden, hidden),
+        "k_proj": (hidden, kv_width),
+        "v_proj": (hidden, kv_width),
+        "o_proj": (hidden, hidden),
+        "gate_proj": (hidden, intermediate),
+        "up_proj": (hidden, intermediate),
+        "down_proj": (intermediate, hidden),
+    }
+
+
+def count_parameters(config, lora_r=None, lora_target_modules=()):
+    """(parameters, trainable parameters) of the model; all of them are trained without lora_r"""
+    hidden, vocab = config.hidden_size, config.vocab_size
+    widths = _projection_widths(config)
+    per_layer = sum(i * o for i, o in widths.values()) + 2 * hidden
+    num_params = per_layer * config.num_hidden_layers + 2 * vocab * hidden + hidden
+    if not lora_r:
+        return num_params, num_params
+    lora_params = config.num_hidden_layers * sum(
+        lora_r * sum(widths[name]) for name in lora_target_modules
+    )
+    return num_params + lora_params, lora_params
+
+
+def decoder_layer_activation_bytes(
+    config,
+    batch_size,
+    seq_len,
+    lora_r=None,
+    lora_target_modules=(),
+    lora_dropout=0.0,
+    dtype_bytes=2,
+):
+    """bytes a decoder layer saves for backward; without lora_r, all of its weights are trained"""
+    hidden, intermediate = config.hidden_size, config.intermediate_size
+    heads = config.num_attention_heads
+    # two RMSNorms, each keeping its fp32 input and inverse RMS
+    per_token = 2 * (4 * hidden + 4)
+    # rotated queries and keys, values, and the softmax in fp32 (then cast, unless the model is fp32)
+    per_token += 3 * dtype_bytes * hidden
+    per_token += (4 + (dtype_bytes if dtype_bytes != 4 else 0)) * heads * seq_len
+    # gate and up projections, and the activated gate
+    per_token += 3 * dtype_bytes * intermediate
+    if not lora_r:
+        # inputs of the norm weights and projections, which only need keeping when they're trained
+        per_token += dtype_bytes * (5 * hidden + intermediate)
+    else:
+        widths = _projection_widths(config)
+        inputs = set()
+        for name in lora_target_modules:
+            in_features = widths[name][0]
+            # lora_B's input, and lora_A's dropped out input and dropout mask; without dropout, lora_A keeps
+            # the projection's input, which projections of the same input share
+            per_token += dtype_bytes * lora_r
+            if lora_dropout:
+                per_token += (dtype_bytes + 1) * in_features
+            elif PROJECTION_INPUTS[name] not in inputs:
+                inputs.add(PROJECTION_INPUTS[name])
+                per_token += dtype_bytes * in_features
+    return batch_size * seq_len * per_token
+
+
+def logits_bytes(config, batch_size, seq_len, dtype_bytes=2):
+    """the logits, their fp32 upcast and the log-softmax the loss keeps, which are all alive at once"""
+    return batch_size * seq_len * config.vocab_size * (dtype_bytes + 4 + 4)
+
+
+def estimate_training_memory(
+    config,
+    batch_size,
+    seq_len,
+    checkpointed_layers=0,
+    world_size=1,
+    lora_r=None,
+    lora_target_modules=(),
+    lora_dropout=0.0,
+    dtype_bytes=2,
+    optimizer_state_bytes=None,
+):
+    """
+    Peak bytes on one GPU while training with FSDP FULL_SHARD over world_size GPUs: the parameter shards, up to
+    two gathered decoder layers, gradients and AdamW states of the trainable parameters, and the activations of
+    a micro-batch. Checkpointed layers only keep their input, but one of them is recomputed at a time.
+    optimizer_state_bytes is per trainable parameter, both AdamW moments in the parameters' dtype by default.
+    """
+    if optimizer_state_bytes is None:
+        optimizer_state_bytes = 2 * dtype_bytes
+    num_params, num_trainable = count_parameters(config, lora_r, lora_target_modules)
+    layer_params = (num_params - 2 * config.vocab_size * config.hidden_size) / config.num_hidden_layers
+
+    static = num_params * dtype_bytes / world_size
+    static += num_trainable * (dtype_bytes + optimizer_state_bytes) / world_size
+    if world_size > 1:
+        static += 2 * layer_params * dtype_bytes
+
+    layer = decoder_layer_activation_bytes(
+        config, batch_size, seq_len, lora_r, lora_target_modules, lora_dropout, dtype_bytes
+    )
+    layer_input = batch_size * seq_len * config.hidden_size * dtype_bytes
+    activations = (config.num_hidden_layers - checkpointed_layers) * layer
+    activations += checkpointed_layers * layer_input
+    if checkpointed_layers:
+        activations += layer
+    # the causal attention mask, and the logits
+    activations += batch_size * seq_len * seq_len * dtype_bytes
+    activations += logits_bytes(config, batch_size, seq_len, dtype_bytes)
+    return int(static + activations)
+
+
+def plan_batch_size(config, seq_len, global_batch_size, budget_bytes, **kwargs):
+    """
+    The largest micro-batch, and the fewest checkpointed layers at that micro-batch, estimated to fit in
+    budget_bytes. Micro-batches divide global_batch_size (per GPU, per optimizer step), so accumulating
+    gradients over the rest keeps it unchanged. kwargs are passed to estimate_training_memory. Raises
+    ValueError if even a micro-batch of 1 with every layer checkpointed doesn't fit.
+    """
+    for batch_size in range(global_batch_size, 0, -1):
+        if global_batch_size % batch_size:
+            continue
+        for checkpointed_layers in range(config.num_hidden_layers + 1):
+            estimated = estimate_training_memory(
+                config, batch_size, seq_len, checkpointed_layers, **kwargs
+            )
+            if estimated <= budget_bytes:
+                return MemoryPlan(
+                    batch_size=batch_size,
+                    gradient_accumulation_steps=global_batch_size // batch_size,
+                    checkpointed_layers=checkpointed_layers,
+                    estimated_bytes=estimated,
+                    budget_bytes=budget_bytes,
+                )
+    raise ValueError(
+        f"Training on sequences of {seq_len} tokens is estimated to need "
+        f"{estimate_training_memory(config, 1, seq_len, config.num_hidden_layers, **kwargs) / 2**30:.1f} GB, "
+        f"more than the {budget_bytes / 2**30:.1f} GB available. Try a shorter chunk_size or more GPUs."
+    )
+
+
+def measure_saved_bytes(fn, exclude=()):
+    """
+    runs fn() and returns its result and the bytes of the tensors autograd saved for backward in it, counting
+    each storage once and skipping those of the `exclude` tensors (e.g. parameters)
+    """
+    excluded = {t.untyped_storage().data_ptr() for t in exclude}
+    saved = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in excluded:
+            saved[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        result = fn()
+    return result, sum(saved.values())
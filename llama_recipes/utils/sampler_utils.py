@@ -0,0 +1,167 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
+
+import itertools
+
+import datasets
+import numpy as np
+from torch.utils.data import Sampler
+
+
+def get_lengths(dataset):
+    """number of tokens in every sample of dataset"""
+    if isinstance(dataset, datasets.Dataset):
+        input_ids = dataset.with_format("arrow")[:]["input_ids"].combine_chunks()
+        return np.diff(input_ids.offsets.to_numpy())
+    return np.array([len(sample["input_ids"]) for sample in dataset])
+
+
+def padding_ratio(lengths, batches):
+    """fraction of the tokens in padded batches that are padding"""
+    real = sum(int(lengths[batch].sum()) for batch in batches)
+    padded = sum(len(batch) * int(lengths[batch].max()) for batch in batches)
+    return 1 - real / padded if padded else 0.0
+
+
+class LengthGroupedBatchSampler(Sampler):
+    """
+    Yields batches of samples with similar lengths, so little of each batch is padding.
+
+    Every epoch the samples are shuffled, split into megabatches of `megabatch_size` batches and sorted by length
+    within each megabatch; the batches cut from those are shuffled again, so batch lengths vary from step to step.
+    With `max_tokens`, batches hold as many samples as fit in `max_tokens` padded tokens instead of `batch_size`.
+
+    Shuffling only depends on `seed` and the epoch (see `set_epoch`), so all ranks agree on the batches. Each group
+    of `num_replicas` consecutive batches is split between the ranks, which keeps them at similar lengths too.
+    """
+
+    def __init__(
+        self,
+        lengths,
+        batch_size: int,
+        max_tokens: int = None,
+        num_replicas: int = 1,
+        rank: int = 0,
+        shuffle: bool = True,
+        seed: int = 0,
+        megabatch_size: int = 50,
+        drop_last: bool = True,
+    ):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.megabatch_size = megabatch_size
+        self.drop_last = drop_last
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+        self.batches = self._make_batches()
+
+    def _split(self, indices):
+        """cuts indices, sorted longest first, into batches"""
+        if not self.max_tokens:
+            return [
+                indices[i : i + self.batch_size]
+                for i in range(0, len(indices), self.batch_size)
+            ]
+        batches = []
+        start = 0
+        while start < len(indices):
+            # the first sample is the longest, so it sets the padded length of the batch
+            size = max(self.max_tokens // int(self.lengths[indices[start]]), 1)
+            batches.append(indices[start : start + size])
+            start += size
+        return batches
+
+    def _make_batches(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        indices = (
+            rng.permutation(len(self.lengths))
+            if self.shuffle
+            else np.arange(len(self.lengths))
+        )
+        megabatch = self.megabatch_size * self.batch_size * self.num_replicas
+        batches = []
+        for i in range(0, len(indices), megabatch):
+            chunk = indices[i : i + megabatch]
+            chunk = chunk[np.argsort(-self.lengths[chunk], kind="stable")]
+            batches.extend(self._split(chunk))
+        if self.drop_last and not self.max_tokens:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+
+        # every rank needs a batch from each group
+        num_groups = len(batches) // self.num_replicas
+        if not self.drop_last and len(batches) % self.num_replicas:
+            batches += batches[: self.num_replicas - len(batches) % self.num_replicas]
+            num_groups += 1
+        groups = [
+            batches[g * self.num_replicas : (g + 1) * self.num_replicas]
+            for g in range(num_groups)
+        ]
+        if self.shuffle and groups:
+            order = rng.permutation(len(groups))
+            # run the longest batches first, so running out of memory happens right away
+            longest = max(
+                range(len(groups)),
+                key=lambda g: max(int(self.lengths[b].max()) for b in groups[g]),
+            )
+            order = [longest] + [g for g in order if g != longest]
+            groups = [groups[g] for g in order]
+        return [group[self.rank] for group in groups]
+
+    def padding_ratio(self) -> float:
+        """fraction of this rank's tokens this epoch that are padding"""
+        return padding_ratio(self.lengths, self.batches)
+
+    def random_padding_ratio(self) -> float:
+        """the padding ratio of the same number of samples in random batches of batch_size, for comparison"""
+        rng = np.random.default_rng(self.seed + self.epoch)
+        num_samples = sum(len(batch) for batch in self.batches)
+        indices = rng.permutation(len(self.lengths))[:num_samples]
+        return padding_ratio(
+            self.lengths,
+            [
+                indices[i : i + self.batch_size]
+                for i in range(0, len(indices), self.batch_size)
+            ],
+        )
+
+    def __iter__(self):
+        for batch in self.batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        return len(self.batches)
+
+
+class ResumableBatchSampler(Sampler):
+    """
+    Wraps a batch sampler so that training can resume part way through an epoch: after `skip(n)`, the next pass
+    leaves out its first n batches. Only their indices are drawn, so the skipped samples are never loaded.
+    Other attributes (`set_epoch`, `padding_ratio`, ...) are the wrapped sampler's, and the length stays that of
+    a whole epoch.
+    """
+
+    def __init__(self, batch_sampler):
+        self.batch_sampler = batch_sampler
+        self.start = 0
+
+    def skip(self, num_batches: int) -> None:
+        self.start = num_batches
+
+    def __iter__(self):
+        start, self.start = self.start, 0
+        return itertools.islice(iter(self.batch_sampler), start, None)
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def __getattr__(self, name):
+        if name == "batch_sampler":
+            raise AttributeError(name)
+        return getattr(self.batch_sampler, name)
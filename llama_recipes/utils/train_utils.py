@@ -1,10 +1,15 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates.
 # This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
 
+import contextlib
+import itertools
+import math
 import os
+import random
 import sys
 import yaml
 
+import numpy as np
 import torch
 from tqdm import tqdm
 
@@ -17,7 +22,8 @@ from transformers import LlamaTokenizer
 from torch.distributed.fsdp import StateDictType
 import torch.distributed as dist
 from pkg_resources import packaging
-from .memory_utils import MemoryTrace
+from .memory_utils import MemoryTrace, get_timeline_path
+from .metrics_utils import TrainingMetrics, get_flops_per_token, get_peak_flops
 import model_checkpointing
 import torch.cuda.nccl as nccl
 from torch.distributed.fsdp.sharded_grad_scaler import ShardedGradScaler
@@ -37,6 +43,51 @@ def byte2mb(x):
     return int(x / 2**20)
 
 
+def get_device(train_config, local_rank=None):
+    """the device to train on: the rank's GPU with FSDP, otherwise the first GPU, or the CPU if there isn't one"""
+    if train_config.enable_fsdp:
+        return local_rank
+    return "cuda:0" if torch.cuda.is_available() else "cpu"
+
+
+def get_diagnostics_path(train_config, path):
+    """path inside train_config.diagnostics_dir, unless it's absolute (or None)"""
+    if not path or os.path.isabs(path):
+        return path
+    os.makedirs(train_config.diagnostics_dir, exist_ok=True)
+    return os.path.join(train_config.diagnostics_dir, path)
+
+
+def gradient_sync_context(model, sync: bool):
+    """
+    Context for the forward and backward pass of a micro-batch: with `sync` False, a distributed model (FSDP, DDP)
+    accumulates gradients locally instead of reducing them across ranks, which then happens once, on the first
+    micro-batch run with `sync`.
+    """
+    if sync or not hasattr(model, "no_sync"):
+        return contextlib.nullcontext()
+    return model.no_sync()
+
+
+def get_rng_state():
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
 def train(
     model,
     train_dataloader,
@@ -49,6 +100,7 @@ def train(
     fsdp_config=None,
     local_rank=None,
     rank=None,
+    training_state=None,
 ):
     """
     Trains the model on the given dataloader
@@ -64,6 +116,7 @@ def train(
         train_config: The training configuration
         eval_dataloader: The dataloader containing the eval data
         tokenizer: tokenizer used in the eval for decoding the predicitons
+        training_state: trainer state returned by model_checkpointing.load_training_state, to resume from
 
     Returns: results dictionary containing average training and validation perplexity and loss
     """
@@ -74,54 +127,179 @@ def train(
         scaler = torch.cuda.amp.GradScaler()
     if train_config.enable_fsdp:
         world_size = int(os.environ["WORLD_SIZE"])
+    metrics_path = get_diagnostics_path(train_config, train_config.metrics_file)
+    if (
+        metrics_path
+        and training_state is None
+        and (not train_config.enable_fsdp or rank == 0)
+    ):
+        # a resumed run carries on the reports of the one it resumes, anything else starts afresh
+        open(metrics_path, "w").close()
+    metrics = TrainingMetrics(
+        get_device(train_config, local_rank),
+        log_every=train_config.log_every_n_steps,
+        path=metrics_path,
+        flops_per_token=get_flops_per_token(
+            model, world_size if train_config.enable_fsdp else 1
+        ),
+        peak_flops=train_config.peak_tflops * 1e12
+        if train_config.peak_tflops
+        else get_peak_flops(),
+        world_size=world_size if train_config.enable_fsdp else 1,
+        rank=rank if train_config.enable_fsdp else 0,
+    )
+    max_eval_batches = get_max_eval_batches(
+        train_config, world_size if train_config.enable_fsdp else 1
+    )
+    no_sync = train_config.enable_fsdp and (
+        train_config.use_peft
+        if train_config.no_sync_gradient_accumulation is None
+        else train_config.no_sync_gradient_accumulation
+    )
+    writer = (
+        model_checkpointing.AsyncCheckpointWriter(
+            train_config.max_checkpoints_in_flight,
+            distributed=train_config.enable_fsdp,
+        )
+        if train_config.async_checkpointing
+        else None
+    )
     train_prep = []
     train_loss = []
     val_prep = []
     val_loss = []
     results = {}
     best_val_loss = float("inf")
-    for epoch in range(train_config.num_epochs):
-        with MemoryTrace() as memtrace:  # track the memory usage
+    device = get_device(train_config, local_rank)
+    start_epoch, start_step, optimizer_steps = 0, 0, 0
+    if training_state is not None:
+        start_epoch = training_state["epoch"]
+        start_step = training_state["step"]
+        optimizer_steps = training_state["optimizer_steps"]
+        best_val_loss = training_state["best_val_loss"]
+        train_prep = training_state["train_prep"]
+        train_loss = training_state["train_loss"]
+        val_prep = training_state["val_prep"]
+        val_loss = training_state["val_loss"]
+        metrics.step = training_state["metrics_step"]
+        lr_scheduler.load_state_dict(training_state["lr_scheduler"])
+        if train_config.use_fp16:
+            scaler.load_state_dict(training_state["scaler"])
+        set_rng_state(training_state["rng"])
+    for epoch in range(start_epoch, train_config.num_epochs):
+        resume_step = start_step if epoch == start_epoch else 0
+        # length-grouped batches are reshuffled every epoch
+        batch_sampler = train_dataloader.batch_sampler
+        if hasattr(batch_sampler, "padding_ratio"):
+            batch_sampler.set_epoch(epoch)
+            if not train_config.enable_fsdp or rank == 0:
+                report = (
+                    f"--> Epoch {epoch}: {len(batch_sampler)} length-grouped batches, "
+                    f"padding ratio {batch_sampler.padding_ratio():.1%}"
+                )
+                if not batch_sampler.max_tokens:
+                    report += f" (random batches: {batch_sampler.random_padding_ratio():.1%})"
+                print(report)
+        if resume_step:
+            # the batches before resume_step were trained on before the state was saved
+            batch_sampler.skip(resume_step)
+        with MemoryTrace(
+            interval=train_config.memory_sample_interval,
+            timeline_path=get_timeline_path(
+                get_diagnostics_path(train_config, train_config.memory_timeline_file),
+                f"train_epoch{epoch}",
+                rank if train_config.enable_fsdp else 0,
+            ),
+        ) as memtrace:  # track the memory usage
             model.train()
-            total_loss = 0.0
+            total_loss = (
+                torch.tensor(training_state["total_loss"], device=device)
+                if resume_step
+                else 0.0
+            )
+            metrics.start_epoch(epoch)
             for step, batch in enumerate(
-                tqdm(train_dataloader, colour="blue", desc=f"Training Epoch{epoch}")
+                tqdm(
+                    train_dataloader,
+                    colour="blue",
+                    desc=f"Training Epoch{epoch}",
+                    initial=resume_step,
+                ),
+                start=resume_step,
             ):
+                # batches are pinned, so the copy doesn't wait for the previous step to finish
                 for key in batch.keys():
-                    if train_config.enable_fsdp:
-                        batch[key] = batch[key].to(local_rank)
+                    batch[key] = batch[key].to(device, non_blocking=True)
+
+                sync_gradients = (
+                    step + 1
+                ) % gradient_accumulation_steps == 0 or step == len(train_dataloader) - 1
+                with gradient_sync_context(model, sync_gradients or not no_sync):
+                    loss = model(**batch).loss
+                    step_loss = loss.detach()
+                    loss = loss / gradient_accumulation_steps
+                    total_loss += loss.detach().float()
+                    if train_config.use_fp16:
+                        # if fp16 is enabled, use gradient scaler to handle gradient update
+                        scaler.scale(loss).backward()
                     else:
-                        batch[key] = batch[key].to("cuda:0")
-
-                loss = model(**batch).loss
-                loss = loss / gradient_accumulation_steps
-                total_loss += loss.detach().float()
-                if train_config.use_fp16:
-                    # if fp16 is enabled, use gradient scaler to handle gradient update
-                    scaler.scale(loss).backward()
-                    if (step + 1) % gradient_accumulation_steps == 0 or step == len(
-                        train_dataloader
-                    ) - 1:
+                        # regular backpropagation when fp16 is not used
+                        loss.backward()
+                if sync_gradients:
+                    if train_config.use_fp16:
                         scaler.step(optimizer)
                         scaler.update()
-                        optimizer.zero_grad()
-                else:
-                    # regular backpropagation when fp16 is not used
-                    loss.backward()
-                    if (step + 1) % gradient_accumulation_steps == 0 or step == len(
-                        train_dataloader
-                    ) - 1:
+                    else:
                         optimizer.step()
-                        optimizer.zero_grad()
-                if train_config.enable_fsdp:
-                    if rank == 0:
-                        print(
-                            f"\n step {step} is completed and loss is {loss.detach().float()}"
-                        )
-                else:
-                    print(
-                        f"\n step {step} is completed and loss is {loss.detach().float()}"
+                    optimizer.zero_grad()
+                    optimizer_steps += 1
+                metrics.update(step_loss, batch)
+                if (
+                    sync_gradients
+                    and train_config.run_validation
+                    and train_config.eval_every_n_steps
+                    and optimizer_steps % train_config.eval_every_n_steps == 0
+                ):
+                    eval_ppl, eval_loss, eval_accuracy = evaluation(
+                        model,
+                        train_config,
+                        eval_dataloader,
+                        rank,
+                        tokenizer,
+                        max_batches=max_eval_batches,
+                        generate=False,
+                    )
+                    metrics.log_eval(eval_loss, eval_ppl, eval_accuracy)
+                    model.train()
+                if (
+                    sync_gradients
+                    and train_config.save_state_every_n_steps
+                    and optimizer_steps % train_config.save_state_every_n_steps == 0
+                ):
+                    trainer_state = {
+                        "epoch": epoch,
+                        "step": step + 1,
+                        "optimizer_steps": optimizer_steps,
+                        "total_loss": float(total_loss),
+                        "best_val_loss": best_val_loss,
+                        "train_prep": [float(x) for x in train_prep],
+                        "train_loss": [float(x) for x in train_loss],
+                        "val_prep": [float(x) for x in val_prep],
+                        "val_loss": [float(x) for x in val_loss],
+                        "metrics_step": metrics.step,
+                        "lr_scheduler": lr_scheduler.state_dict(),
+                        "scaler": scaler.state_dict() if train_config.use_fp16 else None,
+                        "rng": get_rng_state(),
+                    }
+                    model_checkpointing.save_training_state(
+                        model,
+                        optimizer,
+                        trainer_state,
+                        rank if train_config.enable_fsdp else 0,
+                        train_config,
+                        writer,
                     )
+            metrics.close()
 
         # Reducing total_loss across all devices if there's more than one CUDA device
         if torch.cuda.device_count() > 1 and train_config.enable_fsdp:
@@ -155,9 +333,15 @@ def train(
         lr_scheduler.step()
 
         if train_config.run_validation:
-            eval_ppl, eval_epoch_loss = evaluation(
-                model, train_config, eval_dataloader, rank, tokenizer
+            eval_ppl, eval_epoch_loss, eval_accuracy = evaluation(
+                model,
+                train_config,
+                eval_dataloader,
+                rank,
+                tokenizer,
+                max_batches=max_eval_batches,
             )
+            metrics.log_eval(eval_epoch_loss, eval_ppl, eval_accuracy)
             if train_config.save_model and eval_epoch_loss < best_val_loss:
                 if train_config.enable_fsdp:
                     dist.barrier()
@@ -167,7 +351,7 @@ def train(
                             print("we are about to save the PEFT modules")
                     else:
                         print("we are about to save the PEFT modules")
-                    model.save_pretrained(train_config.output_dir)
+                    save_peft_model(model, train_config, rank, writer)
                     if train_config.enable_fsdp:
                         if rank == 0:
                             print(
@@ -184,7 +368,7 @@ def train(
                         and fsdp_config.checkpoint_type == StateDictType.FULL_STATE_DICT
                     ):
                         model_checkpointing.save_model_checkpoint(
-                            model, optimizer, rank, train_config, epoch=epoch
+                            model, optimizer, rank, train_config, epoch=epoch, writer=writer
                         )
                     elif (
                         not train_config.use_peft
@@ -197,11 +381,11 @@ def train(
                         print("=====================================================")
 
                         model_checkpointing.save_model_and_optimizer_sharded(
-                            model, rank, train_config
+                            model, rank, train_config, writer=writer
                         )
                         if train_config.save_optimizer:
                             model_checkpointing.save_model_and_optimizer_sharded(
-                                model, rank, train_config, optim=optimizer
+                                model, rank, train_config, optim=optimizer, writer=writer
                             )
                             print(
                                 " Saving the FSDP model checkpoints qnd optimizer using SHARDED_STATE_DICT"
@@ -212,7 +396,7 @@ def train(
 
                     if not train_config.use_peft and train_config.save_optimizer:
                         model_checkpointing.save_optimizer_checkpoint(
-                            model, optimizer, rank, train_config, epoch=epoch
+                            model, optimizer, rank, train_config, epoch=epoch, writer=writer
                         )
                         print(
                             " Saving the FSDP model checkpoints qnd optimizer using FULL_STATE_DICT"
@@ -255,7 +439,7 @@ def train(
 
     # saving the training params including fsdp setting for reference.
     if train_config.enable_fsdp and not train_config.use_peft:
-        save_train_params(train_config, fsdp_config, rank)
+        save_train_params(train_config, fsdp_config, rank, writer)
 
     if train_config.use_peft and not train_config.run_validation:
         if train_config.enable_fsdp:
@@ -263,102 +447,139 @@ def train(
                 print("we are about to save the PEFT modules")
         else:
             print("we are about to save the PEFT modules")
-        model.save_pretrained(train_config.output_dir)
+        save_peft_model(model, train_config, rank, writer)
         if train_config.enable_fsdp:
             if rank == 0:
                 print(f"PEFT modules are saved in {train_config.output_dir} directory")
         else:
             print(f"PEFT modules are saved in {train_config.output_dir} directory")
 
+    if writer is not None:
+        writer.close()
     return results
 
 
+def save_peft_model(model, train_config, rank, writer=None):
+    """saves the PEFT adapter to train_config.output_dir, in the background with an AsyncCheckpointWriter"""
+    if train_config.adapter_only_checkpoint or writer is not None:
+        model_checkpointing.save_peft_adapter(
+            model, train_config.output_dir, rank if train_config.enable_fsdp else 0, writer
+        )
+    else:
+        model.save_pretrained(train_config.output_dir)
+
+
+def token_loss_and_accuracy(logits, labels, loss):
+    """
+    [loss summed over predicted tokens, predicted tokens, correctly predicted tokens] for a causal LM batch,
+    on device; `loss` is the model's mean loss over the batch's predicted tokens
+    """
+    labels = labels[:, 1:]
+    mask = labels != -100
+    tokens = mask.sum()
+    correct = ((logits[:, :-1].argmax(-1) == labels) & mask).sum()
+    return torch.stack([loss.double() * tokens, tokens.double(), correct.double()])
+
+
+def generate_validation_samples(model, tokenizer, prompts, device, max_new_tokens):
+    """completions of all the validation prompts, from a single batched generate call"""
+    padding_side = tokenizer.padding_side
+    tokenizer.padding_side = "left"
+    inputs = tokenizer(prompts, return_tensors="pt", padding=True).to(device)
+    tokenizer.padding_side = padding_side
+    output_ids = model.generate(
+        **inputs,
+        max_new_tokens=max_new_tokens,
+        do_sample=True,
+        top_k=250,
+        top_p=0.8,
+        temperature=0.75,
+    )
+    return tokenizer.batch_decode(output_ids, skip_special_tokens=True)
+
+
+def get_max_eval_batches(train_config, world_size=1):
+    """batches per rank that cover train_config.eval_samples validation samples, or None for all of them"""
+    if not train_config.eval_samples:
+        return None
+    return math.ceil(
+        train_config.eval_samples / (train_config.val_batch_size * world_size)
+    )
+
+
 def evaluation(
-    model, train_config, eval_dataloader, local_rank, tokenizer, prompt=None
+    model,
+    train_config,
+    eval_dataloader,
+    local_rank,
+    tokenizer,
+    prompt=None,
+    max_batches=None,
+    generate=True,
 ):
     """
     Evaluates the model on the given dataloader
 
+    Loss and next-token accuracy are accumulated on device and reduced across ranks once, at the end.
+
     Args:
         model: The model to evaluate
         eval_dataloader: The dataloader containing the evaluation data
         local_rank: The rank of the current node in a distributed setting
-        tokenizer: The tokenizer used to decode predictions
+        tokenizer: The tokenizer used to decode generations
+        max_batches: Only evaluate the first max_batches batches, the same ones every time
+        generate: Whether to generate completions of train_config.validation_prompt
 
-    Returns: eval_ppl, eval_epoch_loss
+    Returns: eval_ppl, eval_epoch_loss, eval_accuracy
     """
-    if train_config.enable_fsdp:
-        world_size = int(os.environ["WORLD_SIZE"])
+    device = get_device(train_config, local_rank)
     model.eval()
-    eval_preds = []
-    eval_loss = 0.0  # Initialize evaluation loss
-
-    with MemoryTrace() as memtrace:
-        for step, batch in enumerate(
-            tqdm(eval_dataloader, colour="green", desc="evaluating Epoch")
+    num_batches = len(eval_dataloader)
+    if max_batches is not None:
+        num_batches = min(num_batches, max_batches)
+    # loss summed over tokens, tokens, correctly predicted tokens
+    sums = torch.zeros(3, dtype=torch.float64, device=device)
+
+    # Ensure no gradients are computed for this scope to save memory
+    with torch.no_grad():
+        for batch in tqdm(
+            itertools.islice(eval_dataloader, num_batches),
+            total=num_batches,
+            colour="green",
+            desc="evaluating",
         ):
             for key in batch.keys():
-                if train_config.enable_fsdp:
-                    batch[key] = batch[key].to(local_rank)
-                else:
-                    batch[key] = batch[key].to("cuda:0")
-            # Ensure no gradients are computed for this scope to save memory
-            with torch.no_grad():
-                # Forward pass and compute loss
-                outputs = model(**batch)
-                loss = outputs.loss
-                eval_loss += loss.detach().float()
-
-            # Decode predictions and add to evaluation predictions list
-            preds = torch.argmax(outputs.logits, -1)
-            eval_preds.extend(
-                tokenizer.batch_decode(
-                    preds.detach().cpu().numpy(), skip_special_tokens=True
-                )
-            )
+                batch[key] = batch[key].to(device, non_blocking=True)
+            outputs = model(**batch)
+            sums += token_loss_and_accuracy(outputs.logits, batch["labels"], outputs.loss)
 
-    # If there's more than one CUDA device, reduce evaluation loss across all devices
-
-    if torch.cuda.device_count() > 1 and train_config.enable_fsdp:
-        dist.all_reduce(eval_loss, op=dist.ReduceOp.SUM)
+    if train_config.enable_fsdp:
+        dist.all_reduce(sums, op=dist.ReduceOp.SUM)
+    loss_sum, tokens, correct = sums.tolist()
 
     # Compute average loss and perplexity
-    eval_epoch_loss = eval_loss / len(eval_dataloader)
-    if train_config.enable_fsdp:
-        eval_epoch_loss = eval_epoch_loss / world_size
-    eval_ppl = torch.exp(eval_epoch_loss)
-
-    # Print evaluation metrics
-    if train_config.validation_prompt:
-        input_ids = tokenizer(train_config.validation_prompt, return_tensors="pt")[
-            "input_ids"
-        ].to(local_rank)
-
-        output_ids = model.generate(
-            inputs=input_ids,
-            max_length=50,
-            do_sample=True,
-            top_k=250,
-            top_p=0.8,
-            temperature=0.75,
+    eval_epoch_loss = loss_sum / max(tokens, 1)
+    eval_ppl = math.exp(eval_epoch_loss)
+    eval_accuracy = correct / max(tokens, 1)
+
+    prompts = train_config.validation_prompt
+    if isinstance(prompts, str):
+        prompts = [prompts]
+    generated_texts = []
+    if generate and prompts:
+        generated_texts = generate_validation_samples(
+            model, tokenizer, list(prompts), device, train_config.validation_max_new_tokens
         )
 
-        generated_text = tokenizer.decode(output_ids[0], skip_special_tokens=True)
-
-    if train_config.enable_fsdp:
-        if local_rank == 0:
-            print(f" {eval_ppl=} {eval_epoch_loss=}")
-            if train_config.validation_prompt:
-                print(
-                    f"\n\n---- Generated Response ----\n\n{generated_text}\n----------\n"
-                )
-
-    else:
-        if train_config.validation_prompt:
+    if not train_config.enable_fsdp or local_rank == 0:
+        for generated_text in generated_texts:
             print(f"\n\n---- Generated Response ----\n\n{generated_text}\n----------\n")
-        print(f" {eval_ppl=} {eval_epoch_loss=}")
+        print(
+            f" eval_ppl={eval_ppl:.4f} eval_epoch_loss={eval_epoch_loss:.4f} "
+            f"eval_accuracy={eval_accuracy:.4f} ({int(tokens)} tokens)"
+        )
 
-    return eval_ppl, eval_epoch_loss
+    return eval_ppl, eval_epoch_loss, eval_accuracy
 
 
 def freeze_transformer_layers(model, num_layer):
@@ -460,7 +681,7 @@ def get_policies(cfg, rank):
     return mixed_precision_policy, wrapping_policy
 
 
-def save_train_params(train_config, fsdp_config, rank):
+def save_train_params(train_config, fsdp_config, rank, writer=None):
     """
     This function saves the train_config and FSDP config into a train_params.yaml.
     This will be used by converter script in the inference folder to fetch the HF model name or path.
@@ -496,9 +717,15 @@ def save_train_params(train_config, fsdp_config, rank):
     # Check if there's a directory with the same name as the file
     if os.path.isdir(file_name):
         print(f"Error: {file_name} is a directory, not a file.")
+    elif writer is not None:
+        writer.submit(_write_train_params, config_yaml, file_name, rank)
     else:
-        # Write the YAML string to the file
-        with open(file_name, "w") as f:
-            f.write(config_yaml)
-        if rank == 0:
-            print(f"training params are saved in {file_name}")
+        _write_train_params(config_yaml, file_name, rank)
+
+
+def _write_train_params(config_yaml, file_name, rank):
+    # Write the YAML string to the file
+    with open(file_name, "w") as f:
+        f.write(config_yaml)
+    if rank == 0:
+        print(f"training params are saved in {file_name}")
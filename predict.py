@@ -1,16 +1,19 @@
+import asyncio
+import contextlib
 import functools
 import inspect
+import json
 import os
 import socket
 import time
-import zipfile
-from typing import Any, Callable, Optional
+from typing import Any, AsyncIterator, Callable, Iterator, Optional
 
 import torch
 from cog import BasePredictor, ConcatenateIterator, Input, Path
 import config
 from config import ENGINE, ENGINE_KWARGS, USE_SYSTEM_PROMPT
 from src.download import Downloader
+from src.lora_cache import LoRACache
 from src.utils import seed_all, delay_prints
 
 # This prompt formatting was copied from the original Llama v2 repo:
@@ -29,6 +32,22 @@ PROMPT_TEMPLATE = getattr(config, "PROMPT_TEMPLATE", PROMPT_TEMPLATE)
 DEFAULT_SYSTEM_PROMPT = """You are a helpful, respectful and honest assistant."""
 DEFAULT_SYSTEM_PROMPT = getattr(config, "DEFAULT_SYSTEM_PROMPT", DEFAULT_SYSTEM_PROMPT)
 
+# Byte budgets for the LoRA cache tiers, see src/lora_cache.py
+LORA_CACHE_GPU_BYTES = getattr(config, "LORA_CACHE_GPU_BYTES", 4 << 30)
+LORA_CACHE_HOST_BYTES = getattr(config, "LORA_CACHE_HOST_BYTES", 16 << 30)
+LORA_CACHE_DISK_BYTES = getattr(config, "LORA_CACHE_DISK_BYTES", 64 << 30)
+LORA_CACHE_DISK_PATH = getattr(config, "LORA_CACHE_DISK_PATH", "/tmp/lora-cache")
+
+# Max concurrent range requests across all downloads (base weights and LoRAs) is twice this; defaults to the cpu count
+DOWNLOAD_CONCURRENCY = getattr(config, "DOWNLOAD_CONCURRENCY", None)
+
+# Number of prompts handed to engine.generate_batch at a time in JSONL mode (prompts_jsonl)
+BATCH_SIZE = getattr(config, "BATCH_SIZE", 16)
+
+# Serve predictions with an async predict so several can run at once. Needs a cog version with
+# async predictor support and `concurrency: max` set in cog.yaml; only vLLM actually batches them.
+CONCURRENT_PREDICTIONS = getattr(config, "CONCURRENT_PREDICTIONS", False)
+
 # Temporary hack to disable Top K from the API. We should get rid of this once engines + configs are better standardized.
 USE_TOP_K = ENGINE.__name__ not in ("MLCEngine", "MLCvLLMEngine")
 
@@ -36,10 +55,19 @@ USE_TOP_K = ENGINE.__name__ not in ("MLCEngine", "MLCvLLMEngine")
 class Predictor(BasePredictor):
     def setup(self, weights: Optional[Path] = None):
         print("Starting setup")
-        self.downloader = Downloader()
+        # created before the engine so that its weights download through the same connection pool
+        self.downloader = Downloader(concurrency=DOWNLOAD_CONCURRENCY)
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
 
         self.engine = ENGINE(**ENGINE_KWARGS)
+        self.lora_cache = LoRACache(
+            self.engine,
+            self.downloader,
+            gpu_bytes=LORA_CACHE_GPU_BYTES,
+            host_bytes=LORA_CACHE_HOST_BYTES,
+            disk_bytes=LORA_CACHE_DISK_BYTES,
+            disk_path=LORA_CACHE_DISK_PATH,
+        )
 
         if weights is not None and weights.name == "weights":
             # bugfix
@@ -51,26 +79,8 @@ class Predictor(BasePredictor):
         else:
             print("Not using old-style COG_WEIGHTS LoRA weights")
 
-    # todo: adaptive cache like CLOCK
-    @functools.lru_cache(maxsize=10)
     def get_lora(self, replicate_weights: str) -> Any:
-        if "http" in str(replicate_weights):  # weights are in the cloud
-            print("Downloading peft weights")
-            st = time.time()
-            buffer = self.downloader.sync_download_file(str(replicate_weights))
-            print(f"Downloaded peft weights in {time.time() - st:.3f}")
-        else:
-            # zipfile accepts either a file-like or path-like object
-            buffer = replicate_weights
-        st = time.time()
-        with zipfile.ZipFile(buffer, "r") as zip_ref:
-            data = {name: zip_ref.read(name) for name in zip_ref.namelist()}
-        print(f"Unzipped peft weights in {time.time() - st:.3f}")
-        st = time.time()
-        lora = self.engine.load_lora(data)
-        del data, zip_ref
-        print(f"Initialized peft model in {time.time() - st:.3f}")
-        return lora
+        return self.lora_cache.get(replicate_weights)
 
     current_path: str | None = None
 
@@ -87,13 +97,85 @@ class Predictor(BasePredictor):
         self.current_path = None
         self.engine.delete_lora()
 
+    def format_prompt(
+        self,
+        prompt: str,
+        system_prompt: str,
+        prompt_template: str,
+        print: Callable = print,
+    ) -> str:
+        # we must apply a prompt template if it is passed even for base models
+        if prompt_template:
+            # very rough hack to catch mistral-instruct / no SYS token
+            # this is supposed to not proc for the default template, but actually always procs when prompt_template={prompt}
+            # however if you're doing that, it doesn't matter
+            if USE_SYSTEM_PROMPT and B_SYS not in prompt_template:
+                if system_prompt.strip() and not system_prompt.endswith(" "):
+                    # mistral doesn't have a SYS token, there's just a space between the system prompt and
+                    system_prompt = system_prompt.strip() + " "
+                    print("Added a space to your system prompt")
+            prompt = prompt_template.format(system_prompt=system_prompt, prompt=prompt)
+        # MLC adds BOS token
+        prompt = prompt.removeprefix("<s>")
+        print(f"Your formatted prompt is: \n{prompt}")
+        return prompt
+
+    # only one LoRA can be active on the engine at a time, so concurrent predictions
+    # share it: predictions for the active LoRA run together, and switching waits for them to drain
+    _lora_condition: asyncio.Condition | None = None
+    _in_flight = 0
+    _pending_switches = 0
+
+    @contextlib.asynccontextmanager
+    async def use_lora(self, replicate_weights: str | None) -> AsyncIterator[None]:
+        if self._lora_condition is None:
+            self._lora_condition = asyncio.Condition()
+        cond = self._lora_condition
+        if not replicate_weights and "COG_WEIGHTS" in os.environ:
+            # old-style loras stay loaded for every prediction
+            replicate_weights = self.current_path
+
+        async with cond:
+            needs_switch = self.current_path != replicate_weights
+            if needs_switch:
+                self._pending_switches += 1
+                await cond.wait_for(lambda: self._in_flight == 0)
+                self._pending_switches -= 1
+            else:
+                # don't let a steady stream of predictions for this LoRA starve a waiting switch
+                await cond.wait_for(
+                    lambda: self._in_flight == 0
+                    or (self.current_path == replicate_weights and not self._pending_switches)
+                )
+            if self.current_path != replicate_weights:
+                start = time.time()
+                if replicate_weights:
+                    await asyncio.to_thread(self.initialize_peft, replicate_weights)
+                else:
+                    await asyncio.to_thread(self.delete_lora)
+                print(f"Switching LoRA took {time.time() - start:.3f}")
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            async with cond:
+                self._in_flight -= 1
+                cond.notify_all()
+
     # currently, outputs including tokens and logs are throttled to 50ms
     # because of this, printing before outputing tokens is bad
     # so this patches print to not only print until after we leave this function
     # eventually that will be fixed and this can be removed
     def predict(
         self,
-        prompt: str = Input(description="Prompt to send to the model."),
+        prompt: str = Input(
+            description="Prompt to send to the model. Required unless prompts_jsonl is set.",
+            default=None,
+        ),
+        prompts_jsonl: Path = Input(
+            description='Batch mode: a JSONL file with one {"prompt": ...} object per line, optionally with its own "system_prompt". Each line is returned as a JSON line with the generated text added as "output".',
+            default=None,
+        ),
         system_prompt: str = Input(
             description="System prompt to send to the model. This is prepended to the prompt and helps guide system behavior. Should not be blank.",
             default=DEFAULT_SYSTEM_PROMPT,
@@ -157,22 +239,10 @@ class Predictor(BasePredictor):
         with delay_prints() as print:
             if stop_sequences:
                 stop_sequences = stop_sequences.split(",")
-            # we must apply a prompt template if it is passed even for base models
-            if prompt_template:
-                # very rough hack to catch mistral-instruct / no SYS token
-                # this is supposed to not proc for the default template, but actually always procs when prompt_template={prompt}
-                # however if you're doing that, it doesn't matter
-                if USE_SYSTEM_PROMPT and B_SYS not in prompt_template:
-                    if system_prompt.strip() and not system_prompt.endswith(" "):
-                        # mistral doesn't have a SYS token, there's just a space between the system prompt and
-                        system_prompt = system_prompt.strip() + " "
-                        print("Added a space to your system prompt")
-                prompt = prompt_template.format(
-                    system_prompt=system_prompt, prompt=prompt
-                )
-            # MLC adds BOS token
-            prompt = prompt.removeprefix("<s>")
-            print(f"Your formatted prompt is: \n{prompt}")
+            if prompts_jsonl is None:
+                if prompt is None:
+                    raise ValueError("Either prompt or prompts_jsonl must be provided.")
+                prompt = self.format_prompt(prompt, system_prompt, prompt_template, print)
 
             if replicate_weights:
                 start = time.time()
@@ -187,6 +257,22 @@ class Predictor(BasePredictor):
                 print(f"Setting seed to {seed}")
                 seed_all(seed)
 
+            if prompts_jsonl is not None:
+                yield from self.predict_batch(
+                    prompts_jsonl,
+                    system_prompt,
+                    prompt_template,
+                    print=print,
+                    temperature=temperature,
+                    top_p=top_p,
+                    top_k=top_k,
+                    repetition_penalty=repetition_penalty,
+                    max_new_tokens=max_new_tokens,
+                    min_new_tokens=min_new_tokens,
+                    stop_sequences=stop_sequences,
+                )
+                return
+
             n_tokens = 0
             st = time.time()
 
@@ -230,12 +316,119 @@ class Predictor(BasePredictor):
                 print(f"cur memory: {torch.cuda.memory_allocated()}")
                 print(f"max allocated: {torch.cuda.max_memory_allocated()}")
                 print(f"peak memory: {torch.cuda.max_memory_reserved()}")
+                print(f"lora cache: {self.lora_cache.stats()}")
+
+    def predict_batch(
+        self,
+        prompts_jsonl: Path,
+        system_prompt: str,
+        prompt_template: str,
+        print: Callable = print,
+        **kwargs,
+    ) -> Iterator[str]:
+        """
+        JSONL mode: runs the prompts through engine.generate_batch, BATCH_SIZE at a time, and yields one JSON
+        line per input line, in order, with the generated text added as "output".
+        """
+        with open(prompts_jsonl) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        st = time.time()
+        for start in range(0, len(rows), BATCH_SIZE):
+            batch = rows[start : start + BATCH_SIZE]
+            prompts = [
+                self.format_prompt(
+                    row["prompt"],
+                    row.get("system_prompt", system_prompt),
+                    prompt_template,
+                    print=lambda *args: None,
+                )
+                for row in batch
+            ]
+            for row, output in zip(batch, self.engine.generate_batch(prompts, **kwargs)):
+                yield json.dumps({**row, "output": output}) + "\n"
+        print(f"generated {len(rows)} outputs in {time.time() - st:.3f}s")
+
+    async def predict_concurrent(
+        self,
+        prompt: str,
+        prompts_jsonl: Path,
+        system_prompt: str,
+        max_new_tokens: int,
+        min_new_tokens: int,
+        temperature: float,
+        top_p: float,
+        top_k: int,
+        repetition_penalty: float,
+        stop_sequences: str,
+        seed: int,
+        debug: bool,
+        prompt_template: str,
+        replicate_weights: str,
+    ) -> AsyncIterator[str]:
+        """
+        Async predict, used when CONCURRENT_PREDICTIONS is set. Each prediction streams from its own engine
+        request, so engines with continuous batching (vLLM) serve concurrent predictions in the same batch.
+        """
+        if stop_sequences:
+            stop_sequences = stop_sequences.split(",")
+        if seed is not None:
+            # seeding is process-global, which concurrent predictions would clobber
+            print("seed is ignored for concurrent predictions")
+        kwargs = dict(
+            temperature=temperature,
+            top_p=top_p,
+            top_k=top_k,
+            repetition_penalty=repetition_penalty,
+            max_new_tokens=max_new_tokens,
+            min_new_tokens=min_new_tokens,
+            stop_sequences=stop_sequences,
+        )
+        if prompts_jsonl is not None:
+            async with self.use_lora(replicate_weights):
+                lines = await asyncio.to_thread(
+                    list,
+                    self.predict_batch(
+                        prompts_jsonl, system_prompt, prompt_template, **kwargs
+                    ),
+                )
+            for line in lines:
+                yield line
+            return
+        if prompt is None:
+            raise ValueError("Either prompt or prompts_jsonl must be provided.")
+        prompt = self.format_prompt(prompt, system_prompt, prompt_template)
+
+        n_tokens = 0
+        st = time.time()
+        async with self.use_lora(replicate_weights):
+            async for decoded_token in self.engine.astream(prompt, **kwargs):
+                n_tokens += 1
+                yield decoded_token
+        if debug:
+            print(f"hostname: {socket.gethostname()}")
+            print(f"Tokens per second: {n_tokens / (time.time() - st):.2f}")
+            print(f"lora cache: {self.lora_cache.stats()}")
+
+    # cog reads the inputs off predict's signature
+    predict_concurrent.__signature__ = inspect.signature(predict)
+
+    if CONCURRENT_PREDICTIONS:
+        predict = predict_concurrent
 
     def remove(f: Callable, defaults: dict[str, Any]) -> Callable:
         # pylint: disable=no-self-argument
-        def wrapper(self, *args, **kwargs):
-            kwargs.update(defaults)
-            return f(self, *args, **kwargs)
+        if inspect.isasyncgenfunction(f):
+            # cog decides whether to run predict async by looking at the function itself
+            async def wrapper(self, *args, **kwargs):
+                kwargs.update(defaults)
+                async for output in f(self, *args, **kwargs):
+                    yield output
+
+        else:
+
+            def wrapper(self, *args, **kwargs):
+                kwargs.update(defaults)
+                return f(self, *args, **kwargs)
 
         # Update wrapper attributes for documentation, etc.
         functools.update_wrapper(wrapper, f)
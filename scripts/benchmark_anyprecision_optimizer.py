@@ -0,0 +1,93 @@
+"""
+Benchmarks AnyPrecisionAdamW steps over the parameters of a Llama-shaped model (pure bf16 with Kahan summation,
+as llama_finetuning sets it up for pure_bf16 full fine-tunes), comparing the per-parameter loop with the
+multi-tensor (foreach) step and the compiled (fused) step. Runs on cuda if available, otherwise on CPU.
+
+    python scripts/benchmark_anyprecision_optimizer.py --hidden_size 4096 --num_layers 4 --modes loop foreach fused
+"""
+import argparse
+import json
+import sys
+import time
+
+import torch
+
+sys.path.append(".")
+sys.path.append("llama_recipes")
+
+from policies.anyprecision_optimizer import AnyPrecisionAdamW
+
+MODES = {
+    "loop": dict(foreach=False),
+    "foreach": dict(foreach=True),
+    "fused": dict(fused=True),
+}
+
+
+def make_params(args, device):
+    """the weights of a Llama decoder: attention, MLP and norms per layer"""
+    hidden, intermediate = args.hidden_size, int(args.hidden_size * 8 / 3)
+    shapes = []
+    for _ in range(args.num_layers):
+        shapes += [(hidden, hidden)] * 4
+        shapes += [(intermediate, hidden), (intermediate, hidden), (hidden, intermediate)]
+        shapes += [(hidden,)] * 2
+    params = []
+    for shape in shapes:
+        p = torch.nn.Parameter(torch.randn(shape, device=device, dtype=torch.bfloat16))
+        p.grad = torch.randn_like(p)
+        params.append(p)
+    return params
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def measure(mode, args, device):
+    params = make_params(args, device)
+    optimizer = AnyPrecisionAdamW(
+        params,
+        lr=1e-5,
+        weight_decay=0.0,
+        use_kahan_summation=not args.no_kahan_summation,
+        **MODES[mode],
+    )
+    for _ in range(args.warmup_steps):
+        optimizer.step()
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(args.num_steps):
+        optimizer.step()
+    synchronize(device)
+    elapsed = (time.perf_counter() - start) / args.num_steps
+    return elapsed, sum(p.numel() for p in params), len(params)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark AnyPrecisionAdamW step implementations.")
+    parser.add_argument("--hidden_size", type=int, default=512)
+    parser.add_argument("--num_layers", type=int, default=8)
+    parser.add_argument("--num_steps", type=int, default=10)
+    parser.add_argument("--warmup_steps", type=int, default=2)
+    parser.add_argument("--no_kahan_summation", action="store_true")
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES))
+    parser.add_argument("--output", type=str, default="anyprecision_optimizer_benchmark_results.json")
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    results = {}
+    for mode in args.modes:
+        elapsed, num_params, num_tensors = measure(mode, args, device)
+        print(
+            f"{mode}: {elapsed * 1000:.1f} ms per step "
+            f"({num_params / 1e6:.1f}M parameters in {num_tensors} tensors on {device})"
+        )
+        results[mode] = elapsed
+    for mode in args.modes:
+        if mode != "loop" and "loop" in results:
+            print(f"{mode}: {results['loop'] / results[mode]:.2f}x the loop")
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
@@ -0,0 +1,93 @@
+"""
+Benchmarks streaming detokenization the way ExllamaEngine does it: the old approach re-decodes the whole
+sequence every step and slices off the text seen so far, IncrementalDetokenizer decodes a small window.
+Reports the mean per-token cost over each stretch of the generation, which should stay flat for the
+incremental detokenizer out to 4k tokens.
+
+    python scripts/benchmark_detokenizer.py --tokenizer_path tests/assets/llama_tokenizer/tokenizer.model
+"""
+import argparse
+import json
+import random
+import sys
+import time
+
+from sentencepiece import SentencePieceProcessor
+
+sys.path.append(".")
+
+from src.utils import IncrementalDetokenizer
+
+
+# both yield once per token, with "" for tokens that don't complete any text yet
+
+
+def full_decode(decode, prompt_ids, generated_ids):
+    """what ExllamaEngine used to do"""
+    ids = list(prompt_ids)
+    text = decode(ids)
+    for token_id in generated_ids:
+        ids.append(token_id)
+        new_text = decode(ids)[len(text) :]
+        if len(new_text.replace("�", "")) == 0:
+            new_text = ""
+        text += new_text
+        yield new_text
+
+
+def incremental_decode(decode, prompt_ids, generated_ids):
+    detokenizer = IncrementalDetokenizer(decode, prompt_ids)
+    for token_id in generated_ids:
+        yield detokenizer(token_id)
+
+
+def measure(stream, buckets):
+    """mean seconds per token within each bucket of the generation"""
+    times = []
+    start = time.perf_counter()
+    for _ in stream:
+        now = time.perf_counter()
+        times.append(now - start)
+        start = now
+    size = len(times) // buckets
+    return [sum(times[i * size : (i + 1) * size]) / size for i in range(buckets)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark streaming detokenization.")
+    parser.add_argument(
+        "--tokenizer_path",
+        type=str,
+        default="tests/assets/llama_tokenizer/tokenizer.model",
+    )
+    parser.add_argument("--prompt_length", type=int, default=512)
+    parser.add_argument("--output_length", type=int, default=4096)
+    parser.add_argument(
+        "--buckets",
+        type=int,
+        default=8,
+        help="Number of stretches of the generation to report per-token cost for.",
+    )
+    parser.add_argument("--output", type=str, default="detokenizer_benchmark_results.json")
+    args = parser.parse_args()
+
+    tokenizer = SentencePieceProcessor(model_file=args.tokenizer_path)
+    rng = random.Random(0)
+    # skip the control tokens (<unk>, <s>, </s>), everything else including byte fallbacks is fair game
+    vocab = range(3, tokenizer.vocab_size())
+    prompt_ids = [tokenizer.bos_id()] + rng.choices(vocab, k=args.prompt_length)
+    generated_ids = rng.choices(vocab, k=args.output_length)
+
+    results = {}
+    for name, stream in [("full", full_decode), ("incremental", incremental_decode)]:
+        per_token = measure(
+            stream(tokenizer.Decode, prompt_ids, generated_ids), args.buckets
+        )
+        results[name] = per_token
+        print(f"--- {name} ---")
+        size = args.output_length // args.buckets
+        for i, t in enumerate(per_token):
+            print(f"tokens {i * size}-{(i + 1) * size}: {t * 1e6:.1f} us/token")
+
+    with open(args.output, "w") as f:
+        json.dump(results, f)
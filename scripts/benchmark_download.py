@@ -0,0 +1,148 @@
+"""
+Benchmarks Downloader (the path Engine.load_weights uses) against a local stand-in for the weights bucket,
+so cold-start download tuning can be measured without pget or network access.
+
+    python scripts/benchmark_download.py --n_files 4 --file_size_mb 512 --concurrency 4 8 16 --bandwidth_mbps 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from aiohttp import web
+
+sys.path.append(".")
+
+from src.download import Downloader
+
+
+class StandInServer:
+    """
+    Serves n_files of file_size bytes with range support. Each connection is throttled to bandwidth
+    bytes/sec and every request waits latency seconds first, roughly like a remote object store.
+    """
+
+    def __init__(self, file_size, bandwidth, latency):
+        self.data = os.urandom(file_size)
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    async def handle(self, request):
+        await asyncio.sleep(self.latency)
+        if request.method == "HEAD":
+            return web.Response(headers={"Content-Length": str(len(self.data))})
+        start, end = map(
+            int, request.headers["Range"].removeprefix("bytes=").split("-")
+        )
+        response = web.StreamResponse(status=206)
+        response.content_length = end + 1 - start
+        await response.prepare(request)
+        step = 1 << 20
+        for offset in range(start, end + 1, step):
+            chunk = self.data[offset : min(offset + step, end + 1)]
+            await response.write(chunk)
+            if self.bandwidth:
+                await asyncio.sleep(len(chunk) / self.bandwidth)
+        return response
+
+    def start(self):
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+        return f"http://127.0.0.1:{self.port}"
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_route("*", "/{name:.*}", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+
+def benchmark_download(url, n_files, concurrency, resumable):
+    filenames = [
+        f"model-{str(i).zfill(5)}-of-{str(n_files).zfill(5)}.safetensors"
+        for i in range(1, n_files + 1)
+    ]
+    path = tempfile.mkdtemp(prefix="benchmark-download-")
+    try:
+        downloader = Downloader(concurrency=concurrency)
+        start = time.time()
+        stats = downloader.sync_maybe_download_files(
+            path, url, filenames, resumable=resumable
+        )
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(path)
+    total_bytes = sum(s["size"] for s in stats.values())
+    return {
+        "elapsed": elapsed,
+        "throughput_mbps": total_bytes / elapsed / 1024 / 1024,
+        "files": {
+            name: {
+                "size": s["size"],
+                "elapsed": s["elapsed"],
+                "throughput_mbps": s["size"] / s["elapsed"] / 1024 / 1024,
+            }
+            for name, s in stats.items()
+        },
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark weight downloads.")
+    parser.add_argument("--n_files", type=int, default=4)
+    parser.add_argument("--file_size_mb", type=int, default=256)
+    parser.add_argument(
+        "--concurrency",
+        nargs="+",
+        type=int,
+        default=[2, 4, 8, 16],
+        help="Downloader concurrencies to compare.",
+    )
+    parser.add_argument(
+        "--bandwidth_mbps",
+        type=float,
+        default=100,
+        help="Per-connection bandwidth cap of the stand-in server, 0 for unlimited.",
+    )
+    parser.add_argument(
+        "--latency_ms",
+        type=float,
+        default=20,
+        help="Time to first byte of every request to the stand-in server.",
+    )
+    parser.add_argument(
+        "--in_memory",
+        action="store_true",
+        help="Download through an anonymous mmap and copy to disk, instead of the resumable file-backed path.",
+    )
+    parser.add_argument("--output", type=str, default="download_benchmark_results.json")
+    args = parser.parse_args()
+
+    server = StandInServer(
+        args.file_size_mb << 20, args.bandwidth_mbps * (1 << 20), args.latency_ms / 1000
+    )
+    url = server.start()
+
+    results = {}
+    for concurrency in args.concurrency:
+        print(f"\n--- Benchmarking concurrency {concurrency} ---")
+        result = benchmark_download(
+            url, args.n_files, concurrency, resumable=not args.in_memory
+        )
+        print(
+            f"{args.n_files} x {args.file_size_mb} MB in {result['elapsed']:.3f}s"
+            f" ({result['throughput_mbps']:.2f} MB/s)"
+        )
+        results[concurrency] = result
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
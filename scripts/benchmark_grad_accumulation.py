@@ -0,0 +1,115 @@
+"""
+Compares gradient accumulation with a gradient reduction on every micro-batch against reducing only on the last
+micro-batch of each optimizer step (gradient_sync_context, as train_utils.train does with
+no_sync_gradient_accumulation), counting the collectives each rank issues.
+
+FSDP needs an accelerator, so this runs the same loop on DDP over gloo on CPU; both expose no_sync, and DDP's
+bucketed all-reduce stands in for FSDP's per-unit reduce-scatter.
+
+    python scripts/benchmark_grad_accumulation.py --world_size 4 --gradient_accumulation_steps 8
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
+from torch.nn.parallel import DistributedDataParallel
+from transformers import LlamaConfig, LlamaForCausalLM
+
+sys.path.append(".")
+sys.path.append("llama_recipes")
+
+from utils.train_utils import gradient_sync_context
+
+
+def counting_allreduce_hook(counter, bucket):
+    counter["collectives"] += 1
+    counter["bytes"] += bucket.buffer().numel() * bucket.buffer().element_size()
+    return default_hooks.allreduce_hook(None, bucket)
+
+
+def run_steps(model, optimizer, args, no_sync):
+    for _ in range(args.num_steps):
+        for micro_step in range(args.gradient_accumulation_steps):
+            input_ids = torch.randint(0, 1000, (args.batch_size, args.seq_length))
+            sync = micro_step == args.gradient_accumulation_steps - 1
+            with gradient_sync_context(model, sync or not no_sync):
+                loss = model(input_ids=input_ids, labels=input_ids).loss
+                (loss / args.gradient_accumulation_steps).backward()
+        optimizer.step()
+        optimizer.zero_grad()
+
+
+def worker(rank, args, results):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(args.port)
+    dist.init_process_group("gloo", rank=rank, world_size=args.world_size)
+    torch.manual_seed(0)
+    torch.set_num_threads(1)
+    config = LlamaConfig(
+        vocab_size=1000,
+        hidden_size=args.hidden_size,
+        intermediate_size=args.hidden_size * 4,
+        num_hidden_layers=args.num_layers,
+        num_attention_heads=8,
+    )
+    model = DistributedDataParallel(
+        LlamaForCausalLM(config), bucket_cap_mb=args.bucket_cap_mb
+    )
+    counter = {"collectives": 0, "bytes": 0}
+    model.register_comm_hook(counter, counting_allreduce_hook)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+
+    for name, no_sync in [("sync_every_micro_batch", False), ("no_sync", True)]:
+        run_steps(model, optimizer, args, no_sync)  # warm up
+        counter.update(collectives=0, bytes=0)
+        dist.barrier()
+        start = time.time()
+        run_steps(model, optimizer, args, no_sync)
+        dist.barrier()
+        elapsed = time.time() - start
+        if rank == 0:
+            results[name] = {
+                "collectives_per_step": counter["collectives"] / args.num_steps,
+                "mb_reduced_per_step": counter["bytes"] / args.num_steps / 2**20,
+                "step_time": elapsed / args.num_steps,
+            }
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark collectives with and without no_sync gradient accumulation."
+    )
+    parser.add_argument("--world_size", type=int, default=2)
+    parser.add_argument("--gradient_accumulation_steps", type=int, default=4)
+    parser.add_argument("--num_steps", type=int, default=5)
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--seq_length", type=int, default=64)
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--num_layers", type=int, default=4)
+    parser.add_argument("--bucket_cap_mb", type=float, default=25)
+    parser.add_argument("--port", type=int, default=29511)
+    parser.add_argument(
+        "--output", type=str, default="grad_accumulation_benchmark_results.json"
+    )
+    args = parser.parse_args()
+
+    with mp.Manager() as manager:
+        results = manager.dict()
+        mp.spawn(worker, args=(args, results), nprocs=args.world_size)
+        results = dict(results)
+
+    for name, result in results.items():
+        print(
+            f"{name}: {result['collectives_per_step']:.0f} all-reduces "
+            f"({result['mb_reduced_per_step']:.1f} MB) per optimizer step, "
+            f"{result['step_time']:.3f}s per step"
+        )
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
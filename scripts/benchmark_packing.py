@@ -0,0 +1,145 @@
+"""
+Benchmarks sequence packing (Concatenator, as used by the completion dataset when pack_sequences=True)
+on a large synthetic tokenized dataset, against a reference that packs with Python lists the way
+Concatenator used to. Also reports the packing efficiency (real tokens / chunk_size * sequences) of
+in-order packing against best_fit_packing.
+
+    python scripts/benchmark_packing.py --num_samples 1000000 --chunk_size 2048
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pyarrow as pa
+from datasets import Dataset
+
+sys.path.append(".")
+
+from llama_recipes.ft_datasets.utils import Concatenator, pack_best_fit
+
+
+class ListConcatenator:
+    """packs whole samples with per-sample list extends, like the previous implementation of _concat"""
+
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.residual = {}
+
+    def __call__(self, batch):
+        keys = list(batch.keys())
+        current = {k: self.residual.get(k, []) for k in keys}
+        results = {k: [] for k in keys}
+        for idx in range(len(batch[keys[0]])):
+            if len(current[keys[0]]) + len(batch[keys[0]][idx]) > self.chunk_size:
+                if current[keys[0]]:
+                    for k in keys:
+                        results[k].append(current[k])
+                        current[k] = []
+            for k in keys:
+                current[k].extend(batch[k][idx])
+        self.residual = current
+        return results
+
+
+def make_dataset(path, num_samples, mean_length, seed=0, batch_size=100_000):
+    """writes a tokenized dataset to an Arrow file and loads it memory-mapped, like a real preprocessed dataset"""
+    rng = np.random.default_rng(seed)
+    num_tokens = 0
+    writer = None
+    for start in range(0, num_samples, batch_size):
+        lengths = rng.integers(
+            mean_length // 4, mean_length * 7 // 4, min(batch_size, num_samples - start)
+        )
+        offsets = pa.array(np.concatenate([[0], np.cumsum(lengths)]), pa.int32())
+        tokens = rng.integers(0, 32000, lengths.sum(), dtype=np.int32)
+        column = pa.ListArray.from_arrays(offsets, pa.array(tokens))
+        ones = pa.ListArray.from_arrays(offsets, pa.array(np.ones_like(tokens)))
+        batch = pa.record_batch(
+            [column, ones, column], names=["input_ids", "attention_mask", "labels"]
+        )
+        if writer is None:
+            writer = pa.ipc.new_stream(path, batch.schema)
+        writer.write_batch(batch)
+        num_tokens += len(tokens)
+    writer.close()
+    return Dataset.from_file(path), num_tokens
+
+
+def benchmark(dataset, packer, arrow):
+    if arrow:
+        dataset = dataset.with_format("arrow")
+    start = time.time()
+    packed = dataset.map(packer, batched=True, load_from_cache_file=False)
+    packed.cleanup_cache_files()
+    elapsed = time.time() - start
+    return elapsed, packed.num_rows
+
+
+def run(dataset, num_tokens, args):
+    results = {}
+    for wrap in (False, True):
+        name = "wrap" if wrap else "concat"
+        elapsed, num_chunks = benchmark(
+            dataset, Concatenator(args.chunk_size, wrap_packed_sequences=wrap), arrow=True
+        )
+        efficiency = num_tokens / (num_chunks * args.chunk_size)
+        print(
+            f"{name}: {num_chunks} chunks in {elapsed:.2f}s ({args.num_samples / elapsed:.0f} samples/s), "
+            f"packing efficiency {efficiency:.1%}"
+        )
+        results[name] = {
+            "elapsed": elapsed,
+            "samples_per_second": args.num_samples / elapsed,
+            "packing_efficiency": efficiency,
+        }
+
+    start = time.time()
+    num_chunks = len(pack_best_fit(dataset, args.chunk_size))
+    elapsed = time.time() - start
+    efficiency = num_tokens / (num_chunks * args.chunk_size)
+    print(f"best_fit: {num_chunks} chunks in {elapsed:.2f}s, packing efficiency {efficiency:.1%}")
+    results["best_fit"] = {
+        "elapsed": elapsed,
+        "samples_per_second": args.num_samples / elapsed,
+        "packing_efficiency": efficiency,
+    }
+
+    if args.reference_samples:
+        subset = dataset.select(range(min(args.reference_samples, args.num_samples)))
+        elapsed, num_chunks = benchmark(subset, ListConcatenator(args.chunk_size), arrow=False)
+        print(f"reference: {num_chunks} chunks in {elapsed:.2f}s ({len(subset) / elapsed:.0f} samples/s)")
+        results["reference"] = {"elapsed": elapsed, "samples_per_second": len(subset) / elapsed}
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark sequence packing.")
+    parser.add_argument("--num_samples", type=int, default=1_000_000)
+    parser.add_argument("--mean_length", type=int, default=200)
+    parser.add_argument("--chunk_size", type=int, default=2048)
+    parser.add_argument(
+        "--reference_samples",
+        type=int,
+        default=100_000,
+        help="The list-based reference is slow, so it runs on the first samples only. 0 to skip.",
+    )
+    parser.add_argument("--output", type=str, default="packing_benchmark_results.json")
+    args = parser.parse_args()
+
+    path = tempfile.mkdtemp(prefix="benchmark-packing-")
+    try:
+        dataset, num_tokens = make_dataset(
+            os.path.join(path, "data.arrow"), args.num_samples, args.mean_length
+        )
+        print(f"{args.num_samples} samples, {num_tokens} tokens")
+        results = run(dataset, num_tokens, args)
+    finally:
+        shutil.rmtree(path)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
@@ -0,0 +1,82 @@
+"""
+Microbenchmark for StreamingTextStopSequenceHandler, which runs on every generated token in ExllamaEngine.
+Streams long synthetic generations through the handler and reports the time per token, which should stay
+flat as the generation and the number of stop sequences grow.
+
+    python scripts/benchmark_stop_sequences.py --generation_lengths 1000 10000 100000 --num_stop_sequences 1 16 256
+"""
+import argparse
+import json
+import random
+import string
+import sys
+import time
+
+sys.path.append(".")
+
+from src.utils import StreamingTextStopSequenceHandler
+
+EOS_TOKEN = "</s>"
+
+
+def make_tokens(generation_length, stop_sequences, seed=0):
+    """random short tokens that often start, but never finish, a stop sequence"""
+    rng = random.Random(seed)
+    tokens = []
+    for _ in range(generation_length):
+        if rng.random() < 0.1:
+            seq = rng.choice(stop_sequences)
+            tokens.append(seq[: rng.randrange(1, len(seq))])
+        else:
+            tokens.append(
+                "".join(rng.choices(string.ascii_letters + " ", k=rng.randint(1, 6)))
+            )
+    return tokens
+
+
+def measure(stop_sequences, tokens):
+    handler = StreamingTextStopSequenceHandler(stop_sequences, eos_token=EOS_TOKEN)
+    start = time.perf_counter()
+    for token in tokens:
+        for yielded_text in handler(token):
+            if yielded_text == EOS_TOKEN:
+                raise RuntimeError("benchmark tokens shouldn't complete a stop sequence")
+    for _ in handler.finalize():
+        pass
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark stop sequence handling.")
+    parser.add_argument(
+        "--generation_lengths",
+        nargs="+",
+        type=int,
+        default=[1000, 10000, 100000],
+        help="Number of tokens per generation.",
+    )
+    parser.add_argument(
+        "--num_stop_sequences",
+        nargs="+",
+        type=int,
+        default=[1, 4, 16, 256],
+    )
+    parser.add_argument("--output", type=str, default="stop_sequence_benchmark_results.json")
+    args = parser.parse_args()
+
+    results = {}
+    for num_stop_sequences in args.num_stop_sequences:
+        # "~" never shows up in the generated tokens, so stop sequences are never completed
+        stop_sequences = [f"</stop_{i}~>" for i in range(num_stop_sequences)]
+        for generation_length in args.generation_lengths:
+            tokens = make_tokens(generation_length, stop_sequences)
+            elapsed = measure(stop_sequences, tokens)
+            us_per_token = elapsed / generation_length * 1e6
+            print(
+                f"{num_stop_sequences} stop sequences, {generation_length} tokens: "
+                f"{elapsed:.4f}s ({us_per_token:.2f} us/token)"
+            )
+            results[f"{num_stop_sequences}_{generation_length}"] = us_per_token
+
+    with open(args.output, "w") as f:
+        json.dump(results, f)
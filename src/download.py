@@ -1,5 +1,8 @@
 import asyncio
+import base64
 import functools
+import hashlib
+import json
 import mmap
 import os
 import random
@@ -10,7 +13,6 @@ import typing as t
 from concurrent.futures import ThreadPoolExecutor
 import aiohttp
 from yarl import URL
-from .utils import check_files_exist
 
 # some important tricks:
 # 1. os.sched_getaffinity to get an accurate cpu count in containers
@@ -20,21 +22,82 @@ from .utils import check_files_exist
 # 5. thread for file writes
 
 MIN_CHUNK_SIZE = 1024 * 1024 * 8  # 8mb
+# resumable downloads use fixed chunks so the journal still lines up after a restart
+RESUMABLE_CHUNK_SIZE = MIN_CHUNK_SIZE * 8  # 64mb
 
 global_downloader = None
 
 
+def content_md5(headers: t.Mapping[str, str]) -> str | None:
+    """hex md5 from a Content-MD5 or GCS x-goog-hash header (both base64), if the response has one"""
+    encoded = headers.get("Content-MD5")
+    if not encoded:
+        hashes = dict(
+            h.strip().split("=", 1) for h in headers.get("x-goog-hash", "").split(",") if "=" in h
+        )
+        encoded = hashes.get("md5")
+    if not encoded:
+        return None
+    try:
+        return base64.b64decode(encoded, validate=True).hex()
+    except ValueError:
+        return None
+
+
+class ChecksumError(ValueError):
+    pass
+
+
+def get_downloader() -> "Downloader":
+    """the process-wide Downloader, so all downloads share one connection pool and concurrency limit"""
+    return global_downloader or Downloader()
+
+
 # zipfile requires seekable
 class SeekableMmap(mmap.mmap):
     def seekable(self) -> bool:
         return True
 
 
+class DownloadJournal:
+    """
+    Records which byte ranges of a partial download are safely on disk. The first line is a JSON
+    header describing the remote file; every following line is a completed "start end" range.
+    A journal whose header doesn't match the remote file (e.g. the ETag changed) is discarded.
+    """
+
+    def __init__(self, path: str, header: dict) -> None:
+        self.path = path
+        self.completed: set[tuple[int, int]] = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                lines = f.read().splitlines()
+            if lines and json.loads(lines[0]) == header:
+                for line in lines[1:]:
+                    start, end = line.split()
+                    self.completed.add((int(start), int(end)))
+        if not self.completed:
+            with open(path, "w") as f:
+                f.write(json.dumps(header) + "\n")
+        self.file = open(path, "a")
+
+    def complete(self, start: int, end: int) -> None:
+        self.file.write(f"{start} {end}\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.completed.add((start, end))
+
+    def close(self) -> None:
+        self.file.close()
+
+
 class Downloader:
     def __init__(self, concurrency: int | None = None) -> None:
         if not concurrency:
             concurrency = len(os.sched_getaffinity(0))
         self.concurrency = concurrency
+        # per-file metrics: name -> {"size", "downloaded", "resumed", "start", "elapsed"}
+        self.stats: dict[str, dict] = {}
         self.sem = asyncio.Semaphore(concurrency * 2)
         self.retries = 0
         try:
@@ -63,7 +126,9 @@ class Downloader:
             self._threadpool = ThreadPoolExecutor(2)
         return self._threadpool
 
-    async def get_remote_file_size(self, url: str | URL) -> "tuple[URL, int]":
+    async def get_remote_file_info(
+        self, url: str | URL
+    ) -> "tuple[URL, int, str | None, str | None]":
         # try:
         #     direct_url = str(url).replace(
         #         "pbxt.replicate.delivery", "replicate-files.object.lga1.coreweave.com"
@@ -87,7 +152,12 @@ class Downloader:
                     print("HEAD failed:", response, response.headers.items())
                 # https://docs.aiohttp.org/en/stable/client_reference.html#aiohttp.ClientResponse.url
                 # .url is the url of the final request, as opposed to .real_url
-                return response.url, int(response.headers["Content-Length"])
+                return (
+                    response.url,
+                    int(response.headers["Content-Length"]),
+                    response.headers.get("ETag"),
+                    content_md5(response.headers),
+                )
             except KeyError as e:
                 print("HEAD failed", repr(e))
                 print(response.headers, response)
@@ -98,8 +168,50 @@ class Downloader:
             await asyncio.sleep(random.random() / 10)
         raise ValueError(f"Failed to HEAD {url} after multiple retries")
 
+    async def get_remote_file_size(self, url: str | URL) -> "tuple[URL, int]":
+        url, size, _, _ = await self.get_remote_file_info(url)
+        return url, size
+
+    def start_stats(self, name: str, size: int, resumed: int = 0) -> dict:
+        stats = {
+            "size": size,
+            "downloaded": resumed,
+            "resumed": resumed,
+            "start": time.time(),
+            "elapsed": None,
+        }
+        self.stats[name] = stats
+        return stats
+
+    @staticmethod
+    def finish_stats(stats: dict) -> str:
+        stats["elapsed"] = elapsed = time.time() - stats["start"]
+        fetched = stats["downloaded"] - stats["resumed"]
+        throughput = fetched / max(elapsed, 1e-6) / 1024 / 1024
+        return f"{fetched / 1024 / 1024:.2f} MB in {elapsed:.3f}s ({throughput:.2f} MB/s)"
+
+    async def report_progress(self, names: list[str], interval: float = 5.0) -> None:
+        """prints progress for the given files every interval seconds until cancelled"""
+        while True:
+            await asyncio.sleep(interval)
+            for name in names:
+                stats = self.stats.get(name)
+                if stats is None or stats["elapsed"] is not None:
+                    continue
+                fetched = stats["downloaded"] - stats["resumed"]
+                throughput = fetched / (time.time() - stats["start"]) / 1024 / 1024
+                print(
+                    f"{name}: {stats['downloaded'] / 1024 / 1024:.0f}/{stats['size'] / 1024 / 1024:.0f} MB"
+                    f" ({100 * stats['downloaded'] / max(stats['size'], 1):.0f}%, {throughput:.2f} MB/s)"
+                )
+
     async def download_chunk(
-        self, url: str | URL, start: int, end: int, buffer_view: memoryview
+        self,
+        url: str | URL,
+        start: int,
+        end: int,
+        buffer_view: memoryview,
+        stats: dict | None = None,
     ) -> None:
         async with self.sem:
             for i in range(5):
@@ -107,10 +219,14 @@ class Downloader:
                 try:
                     headers |= {"Range": f"bytes={start}-{end}"}
                     async with self.session.get(url, headers=headers) as response:
+                        response.raise_for_status()
                         buffer_view[start : end + 1] = await response.read()
+                        if stats is not None:
+                            stats["downloaded"] += end + 1 - start
                         return
                 except (aiohttp.ClientError, asyncio.TimeoutError) as e:
                     print(f"Error: {e}")
+                    self.retries += 1
                     await asyncio.sleep(random.random() / 10)  # sleep 0-100ms
         raise ValueError(f"Failed to download {url} after multiple retries")
 
@@ -134,16 +250,18 @@ class Downloader:
         concurrency = min(allowed_concurrency, max_chunks)
         chunk_size = file_size // concurrency
         tasks = []
+        stats = self.start_stats(os.path.basename(str(url.path)), file_size)
         buf = SeekableMmap(-1, file_size)
         buffer_view = memoryview(buf)
         start_time = time.time()
         for i in range(concurrency):
             start = i * chunk_size
             end = start + chunk_size - 1 if i != concurrency - 1 else file_size - 1
-            tasks.append(self.download_chunk(url, start, end, buffer_view))
+            tasks.append(self.download_chunk(url, start, end, buffer_view, stats))
 
         await asyncio.gather(*tasks)
         buf.seek(0)
+        self.finish_stats(stats)
         print(
             f"Downloaded {os.path.basename(str(url))} as {concurrency} {chunk_size // 1024}"
             f" kB chunks in {time.time() - start_time:.3f}s with {self.retries} retries"
@@ -160,28 +278,159 @@ class Downloader:
         )
         buf.close()
 
-    async def maybe_download_files_to_disk(
-        self, path: str, remote_path: str, filenames: list[str]
+    async def download_file_resumable(
+        self,
+        url: str | URL,
+        path: str,
+        sha256: str | None = None,
+        name: str | None = None,
+        info: "tuple[URL, int, str | None, str | None] | None" = None,
+    ) -> None:
+        """
+        Downloads url to path through a sparse, file-backed mmap at path.partial, journaling completed
+        chunks to path.journal. If the download is interrupted (retries exhausted, container restarted),
+        calling this again only fetches the chunks that are missing. The result is checked against
+        sha256 if given, or the md5 the server sent in Content-MD5 or x-goog-hash, before being moved into
+        place. ETags aren't checked, since CDNs, encrypted objects and proxies use ones that only look like md5s.
+        """
+        name = name or os.path.basename(path)
+        url, file_size, etag, md5 = info or await self.get_remote_file_info(url)
+        self.total_size += file_size
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        partial_path, journal_path = f"{path}.partial", f"{path}.journal"
+        header = {
+            "url": str(url).split("?")[0],
+            "size": file_size,
+            "etag": etag,
+            "chunk_size": RESUMABLE_CHUNK_SIZE,
+        }
+        if not os.path.exists(partial_path) and os.path.exists(journal_path):
+            os.remove(journal_path)
+        journal = DownloadJournal(journal_path, header)
+        with open(partial_path, "a+b") as f:
+            # truncate to the full size up front; unwritten ranges stay sparse holes
+            f.truncate(file_size)
+            buf = mmap.mmap(f.fileno(), file_size) if file_size else None
+
+        buffer_view = memoryview(buf) if buf else None
+        try:
+            ranges = [
+                (start, min(start + RESUMABLE_CHUNK_SIZE, file_size) - 1)
+                for start in range(0, file_size, RESUMABLE_CHUNK_SIZE)
+            ]
+            missing = [r for r in ranges if r not in journal.completed]
+            resumed = file_size - sum(end + 1 - start for start, end in missing)
+            stats = self.start_stats(name, file_size, resumed)
+
+            async def fetch(start: int, end: int) -> None:
+                await self.download_chunk(url, start, end, buffer_view, stats)
+                # chunk starts are page aligned since RESUMABLE_CHUNK_SIZE is a multiple of the page size
+                await self.loop.run_in_executor(
+                    self.threadpool,
+                    lambda: (buf.flush(start, end + 1 - start), journal.complete(start, end)),
+                )
+
+            results = await asyncio.gather(
+                *(fetch(start, end) for start, end in missing), return_exceptions=True
+            )
+            errors = [r for r in results if isinstance(r, BaseException)]
+            if errors:
+                raise ValueError(
+                    f"Failed to download {len(errors)} of {len(missing)} chunks of {url}, "
+                    "the rest are kept for the next attempt"
+                ) from errors[0]
+            print(
+                f"Downloaded {name}: {self.finish_stats(stats)}, "
+                f"{len(missing)} of {len(ranges)} chunks with {len(ranges) - len(missing)} resumed"
+            )
+            await self.loop.run_in_executor(
+                self.threadpool, self.verify_download, buf, sha256, md5
+            )
+        except ValueError as e:
+            if isinstance(e, ChecksumError):
+                # don't resume from corrupt data
+                os.remove(partial_path)
+                os.remove(journal_path)
+            raise
+        finally:
+            journal.close()
+            if buffer_view:
+                buffer_view.release()
+            if buf:
+                buf.close()
+        os.rename(partial_path, path)
+        os.remove(journal_path)
+
+    @staticmethod
+    def verify_download(
+        buf: mmap.mmap | None, sha256: str | None, md5: str | None
     ) -> None:
+        data = buf if buf is not None else b""
+        if sha256:
+            digest = hashlib.sha256(data).hexdigest()
+            if digest != sha256.lower():
+                raise ChecksumError(f"sha256 mismatch: expected {sha256}, got {digest}")
+            return
+        if md5:
+            digest = hashlib.md5(data).hexdigest()
+            if digest != md5:
+                raise ChecksumError(f"md5 mismatch: expected {md5}, got {digest}")
+
+    async def maybe_download_files_to_disk(
+        self,
+        path: str,
+        remote_path: str,
+        filenames: list[str],
+        resumable: bool = False,
+    ) -> dict[str, dict]:
+        """
+        Downloads each of filenames (which may include subdirectories) from remote_path that isn't in path yet.
+        Returns the per-file stats for this batch.
+        """
         remote_path = remote_path.rstrip("/")
-        if not os.path.exists(path):
-            os.makedirs(path, exist_ok=True)
-            missing_files = filenames
-        else:
-            missing_files = check_files_exist(filenames, path)
-        start = time.time()
-        coros = [
-            self.download_file_to_disk(f"{remote_path}/{f}", f"{path}/{f}")
-            for f in missing_files
+        missing_files = [
+            f for f in filenames if not os.path.exists(os.path.join(path, f))
         ]
-        await asyncio.gather(*coros)
+        for f in missing_files:
+            os.makedirs(os.path.dirname(os.path.join(path, f)), exist_ok=True)
+        start = time.time()
+        if resumable:
+            # HEAD everything up front so that chunks queue on the semaphore in filename order,
+            # and files land one after another instead of all at the very end
+            infos = await asyncio.gather(
+                *(self.get_remote_file_info(f"{remote_path}/{f}") for f in missing_files)
+            )
+            coros = [
+                self.download_file_resumable(
+                    f"{remote_path}/{f}", f"{path}/{f}", name=f, info=info
+                )
+                for f, info in zip(missing_files, infos)
+            ]
+        else:
+            coros = [
+                self.download_file_to_disk(f"{remote_path}/{f}", f"{path}/{f}")
+                for f in missing_files
+            ]
+        progress = asyncio.ensure_future(self.report_progress(missing_files))
+        try:
+            await asyncio.gather(*coros)
+        finally:
+            progress.cancel()
         elapsed = time.time() - start
         throughput = self.total_size / elapsed / 1024 / 1024
         print(
             f"downloaded {self.total_size / 1024 / 1024:.2f} MB in {elapsed:.3f}s ({throughput:.2f} MB/s)"
+            f" with {self.retries} retries"
         )
         self.total_size = 0
+        self.retries = 0
         self.files_processed = 0  # loras can use a bunch of connections
+        return {f: self.stats[f] for f in missing_files if f in self.stats}
+
+    def start_background_download(
+        self, path: str, remote_path: str, filenames: list[str]
+    ) -> "BackgroundDownload":
+        return BackgroundDownload(self, path, remote_path, filenames)
 
     def sync(f: t.Callable) -> t.Callable:
         # pylint: disable=no-self-argument
@@ -205,6 +454,46 @@ class Downloader:
 
     sync_download_file = sync(download_file)
     sync_maybe_download_files = sync(maybe_download_files_to_disk)
+    sync_download_file_resumable = sync(download_file_resumable)
+
+
+class BackgroundDownload:
+    """
+    Runs maybe_download_files_to_disk (resumable) in a background thread, so callers can start
+    on each file as soon as it lands. Files are downloaded in the order given.
+    """
+
+    def __init__(
+        self, downloader: Downloader, path: str, remote_path: str, filenames: list[str]
+    ) -> None:
+        self.path = path
+        self.filenames = filenames
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="background-download")
+        self.future = self.executor.submit(
+            downloader.sync_maybe_download_files,
+            path,
+            remote_path,
+            filenames,
+            resumable=True,
+        )
+        # takes no more work, so the thread exits as soon as the download finishes
+        self.executor.shutdown(wait=False)
+
+    def wait_for(self, filename: str) -> str:
+        """blocks until filename is fully downloaded (and verified), returning its local path"""
+        local_path = os.path.join(self.path, filename)
+        # resumable downloads are only renamed into place once they're complete
+        while not os.path.exists(local_path):
+            if self.future.done():
+                self.future.result()  # raises if the download failed
+                if not os.path.exists(local_path):
+                    raise FileNotFoundError(local_path)
+            time.sleep(0.05)
+        return local_path
+
+    def wait(self) -> str:
+        self.future.result()
+        return self.path
 
 
 if __name__ == "__main__":
@@ -1,9 +1,11 @@
+import asyncio
+import threading
 import time
 from abc import ABC, abstractmethod
-from typing import Any
+from typing import Any, AsyncIterator, List
 
 from src.config_utils import Weights
-from src.utils import maybe_download_with_pget
+from src.download import BackgroundDownload, get_downloader
 
 
 class Engine(ABC):
@@ -13,12 +15,30 @@ class Engine(ABC):
 
     def load_weights(self, weights: Weights):
         start = time.time()
-        maybe_download_with_pget(
-            weights.local_path, weights.remote_path, weights.remote_files
-        )
+        if weights.remote_path:
+            # resumable, so a cold start that gets interrupted only pays for the missing bytes next time
+            get_downloader().sync_maybe_download_files(
+                weights.local_path,
+                weights.remote_path,
+                weights.remote_files,
+                resumable=True,
+            )
         print(f"downloading weights took {time.time() - start:.3f}s")
         return weights.local_path
 
+    def start_weights_download(self, weights: Weights) -> BackgroundDownload:
+        """
+        like load_weights, but returns right away so the engine can be built while the weights download.
+        small files (configs, tokenizer) are fetched first, then weight shards in order.
+        """
+        filenames = sorted(
+            weights.remote_files if weights.remote_path else [],
+            key=lambda f: f.endswith((".safetensors", ".bin")),
+        )
+        return get_downloader().start_background_download(
+            weights.local_path, weights.remote_path, filenames
+        )
+
     @abstractmethod
     def load_lora(self, lora_data: dict):
         """
@@ -34,6 +54,20 @@ class Engine(ABC):
         """
         pass
 
+    def offload_lora(self, lora: Any) -> Any:
+        """
+        moves a loaded lora (created w/load_lora) into host memory so it can be cached off the gpu.
+        returns None if this engine can't do that, in which case the lora is dropped instead.
+        """
+        return None
+
+    def restore_lora(self, offloaded_lora: Any) -> Any:
+        """
+        given the output of offload_lora, returns a lora in the format load_lora produces, without re-reading any files.
+        only called with something other than None from offload_lora; by default, that's already a usable lora.
+        """
+        return offloaded_lora
+
     @abstractmethod
     def is_lora_active(self) -> bool:
         """
@@ -54,3 +88,47 @@ class Engine(ABC):
         generation!
         """
         pass
+
+    def generate_batch(self, prompts: List[str], **kwargs) -> List[str]:
+        """
+        generates a completion for each prompt, with the same sampling kwargs as __call__, and returns the full
+        texts in order. engines that can batch (vLLM, transformers, exllama) override this; by default the
+        prompts just run one after another.
+        """
+        return ["".join(self(prompt, **kwargs)) for prompt in prompts]
+
+    async def astream(self, prompt, **kwargs) -> AsyncIterator[str]:
+        """
+        async generation, for concurrent predictions. engines that batch concurrent requests (vLLM) override this;
+        by default calls take turns running __call__ in a worker thread, so the event loop stays responsive.
+        """
+        if getattr(self, "_astream_lock", None) is None:
+            self._astream_lock = asyncio.Lock()
+
+        loop = asyncio.get_running_loop()
+        outputs = asyncio.Queue()
+        stopped = threading.Event()
+        end_of_stream = object()
+
+        def run():
+            try:
+                for text in self(prompt, **kwargs):
+                    if stopped.is_set():
+                        break
+                    loop.call_soon_threadsafe(outputs.put_nowait, text)
+            except Exception as e:
+                loop.call_soon_threadsafe(outputs.put_nowait, e)
+            else:
+                loop.call_soon_threadsafe(outputs.put_nowait, end_of_stream)
+
+        async with self._astream_lock:
+            worker = loop.run_in_executor(None, run)
+            try:
+                while (text := await outputs.get()) is not end_of_stream:
+                    if isinstance(text, Exception):
+                        raise text
+                    yield text
+            finally:
+                # don't hand the engine to the next caller while this generation is still running
+                stopped.set()
+                await worker
@@ -6,6 +6,7 @@ import glob
 import torch
 import time
 import typing as tp
+from collections import OrderedDict
 
 from src.config_utils import Weights
 
@@ -18,7 +19,11 @@ from exllama.tokenizer import ExLlamaTokenizer
 from exllama.generator import ExLlamaGenerator
 
 from src.inference_engines.engine import Engine
-from ..utils import StreamingTextStopSequenceHandler
+from ..utils import (
+    IncrementalDetokenizer,
+    StreamingTextStopSequenceHandler,
+    truncate_at_stop_sequences,
+)
 
 torch.cuda._lazy_init()
 torch.set_printoptions(precision=10)
@@ -41,6 +46,13 @@ def begin(generator):
     return generator
 
 
+def common_prefix_length(a: torch.Tensor, b: torch.Tensor) -> int:
+    """number of leading tokens two (1, n) id tensors share"""
+    n = min(a.shape[-1], b.shape[-1])
+    mismatches = (a[0, :n] != b[0, :n]).nonzero()
+    return int(mismatches[0]) if len(mismatches) else n
+
+
 def timer(name, func):
     t = time.time()
     ret = func()
@@ -50,7 +62,22 @@ def timer(name, func):
 
 
 class ExllamaEngine(Engine):
-    def __init__(self, weights: Weights, fused_attn=True):
+    """
+    With reuse_prefix, keeps the KV cache between requests and only prefills the part of each prompt
+    that differs from the last sequence (prompt + output) it ran. Prefixes that get reused (e.g. the
+    system prompt block) are also snapshotted, up to prefix_snapshots of them, so they survive a
+    request that doesn't share them.
+    """
+
+    def __init__(
+        self,
+        weights: Weights,
+        fused_attn=True,
+        reuse_prefix: bool = True,
+        prefix_snapshots: int = 4,
+        min_snapshot_tokens: int = 16,
+        max_batch_size: int = 8,
+    ):
         model_directory = self.load_weights(weights)
         tokenizer_path = os.path.join(model_directory, "tokenizer.model")
         model_config_path = os.path.join(model_directory, "config.json")
@@ -86,24 +113,176 @@ class ExllamaEngine(Engine):
             logits = timer("Warmup", lambda: next_logits(generator, warmup_ids, None))
 
         self.generator = begin(generator)
+        self.reuse_prefix = reuse_prefix
+        self.max_batch_size = max_batch_size
+        self.prefix_snapshots = prefix_snapshots
+        self.min_snapshot_tokens = min_snapshot_tokens
+        # token ids -> ExLlamaCache holding just that prefix, least recently used first
+        self.snapshots: "OrderedDict[tuple[int, ...], ExLlamaCache]" = OrderedDict()
+
+    def invalidate_prefix_cache(self) -> None:
+        """cached keys/values depend on the lora, so they can't be reused across lora changes"""
+        self.generator.sequence = None
+        self.generator.cache.current_seq_len = 0
+        self.snapshots.clear()
+
+    def snapshot_prefix(self, tokens: torch.Tensor) -> None:
+        key = tuple(tokens[0].tolist())
+        if key in self.snapshots:
+            self.snapshots.move_to_end(key)
+            return
+        length = len(key)
+        snapshot = ExLlamaCache(self.model, max_seq_len=length)
+        self.generator.cache.copy_states(snapshot, 0, length, 0, length, 0, 1, 0, 1)
+        snapshot.current_seq_len = length
+        self.snapshots[key] = snapshot
+        while len(self.snapshots) > self.prefix_snapshots:
+            self.snapshots.popitem(last=False)
+
+    def begin_with_prefix(self, in_tokens: torch.Tensor) -> int:
+        """
+        Equivalent to begin + gen_begin, but reuses as much of the KV cache as it can. Returns the number
+        of prompt tokens that didn't need prefilling.
+        """
+        generator = self.generator
+        if not self.reuse_prefix:
+            begin(generator)
+            generator.gen_begin(in_tokens)
+            return 0
+
+        generator.end_beam_search()
+        # the last prompt token is always fed by the first generation step, so the most we can reuse
+        # is everything but that one
+        limit = in_tokens.shape[-1] - 1
+        reuse = 0
+        if generator.sequence is not None:
+            # the cache holds keys/values for all but the last token of the sequence
+            reuse = min(
+                common_prefix_length(generator.sequence, in_tokens),
+                generator.cache.current_seq_len,
+                limit,
+            )
+        live_reuse = reuse
+
+        for key, snapshot in reversed(self.snapshots.items()):
+            length = len(key)
+            if reuse < length <= limit and key == tuple(in_tokens[0, :length].tolist()):
+                snapshot.copy_states(generator.cache, 0, length, 0, length, 0, 1, 0, 1)
+                self.snapshots.move_to_end(key)
+                reuse = length
+                break
+
+        if reuse == 0:
+            begin(generator)
+            generator.gen_begin(in_tokens)
+            return 0
+
+        generator.cache.current_seq_len = reuse
+        generator.sequence = in_tokens[:, : reuse + 1].clone()
+        generator.sequence_actual = generator.sequence.clone()
+        if reuse + 1 < in_tokens.shape[-1]:
+            generator.gen_feed_tokens(in_tokens[:, reuse + 1 :])
+
+        # a prefix shared by two requests in a row is probably the system prompt, so keep it around
+        if live_reuse == reuse and reuse >= self.min_snapshot_tokens:
+            self.snapshot_prefix(in_tokens[:, :reuse])
+        return reuse
 
     def delete_lora(self):
         self.generator.lora = None
+        self.invalidate_prefix_cache()
         return
 
     def is_lora_active(self) -> bool:
         return self.generator.lora is None
 
     def load_lora(self, data_ref: dict) -> ExLlamaLora:
+        # read_lora_archive has already loaded the weights, from adapter_model.bin or .safetensors, but
+        # ExLlamaLora reads them itself with torch.load from a file, so they're serialized once more here
+        weights = data_ref.get("adapter_model.safetensors", data_ref.get("adapter_model.bin"))
+        buffer = io.BytesIO()
+        torch.save(weights, buffer)
+        buffer.seek(0)
         return ExLlamaLora(
             self.model,
             data_ref["adapter_config.json"],
-            io.BytesIO(data_ref["adapter_model.bin"]),
+            buffer,
         )
 
     def set_lora(self, lora: ExLlamaLora | None) -> None:
+        if lora is not self.generator.lora:
+            self.invalidate_prefix_cache()
         self.generator.lora = lora
 
+    def generate_batch(
+        self,
+        prompts: tp.List[str],
+        repetition_penalty: float = 1.15,
+        repetition_penalty_sustain: int = 256,
+        token_repetition_penalty_decay: float = 128,
+        temperature: float = 0.95,
+        top_p: float = 0.65,
+        top_k: int = 20,
+        max_new_tokens: int = 128,
+        min_new_tokens: int = 0,
+        stop_sequences: tp.List[str] = None,
+        **kwargs,
+    ) -> tp.List[str]:
+        """
+        Generates max_batch_size prompts at a time with a batched cache. The batch gets its own generator and
+        cache, sized to what it needs, so the prefix cache used by __call__ is left alone.
+        """
+        if top_k <= 0:
+            top_k = 20
+        tokenizer = self.generator.tokenizer
+        texts = []
+        for start in range(0, len(prompts), self.max_batch_size):
+            batch = prompts[start : start + self.max_batch_size]
+            ids, mask = tokenizer.encode(
+                batch, return_mask=True, max_seq_len=self.model.config.max_seq_len
+            )
+            if ids.shape[-1] >= self.model.config.max_input_len:
+                raise ValueError(
+                    f"Your input is too long. Max input length is {self.model.config.max_input_len} tokens, but you supplied {ids.shape[-1]} tokens."
+                )
+            n_new_tokens = min(
+                max_new_tokens, self.model.config.max_seq_len - ids.shape[-1]
+            )
+            cache = ExLlamaCache(
+                self.model, batch_size=len(batch), max_seq_len=ids.shape[-1] + n_new_tokens
+            )
+            generator = ExLlamaGenerator(self.model, tokenizer, cache)
+            generator.lora = self.generator.lora
+            generator.settings.token_repetition_penalty_max = repetition_penalty
+            generator.settings.token_repetition_penalty_sustain = repetition_penalty_sustain
+            generator.settings.token_repetition_penalty_decay = (
+                token_repetition_penalty_decay
+            )
+            generator.settings.temperature = temperature
+            generator.settings.top_p = top_p
+            generator.settings.top_k = top_k
+
+            generator.gen_begin(ids, mask=mask)
+            finished = torch.zeros(len(batch), dtype=torch.bool)
+            for i in range(n_new_tokens):
+                if i < min_new_tokens:
+                    generator.disallow_tokens(
+                        [tokenizer.newline_token_id, tokenizer.eos_token_id]
+                    )
+                else:
+                    generator.disallow_tokens(None)
+                token = generator.gen_single_token(mask=mask)
+                finished |= token[:, 0].cpu() == tokenizer.eos_token_id
+                if finished.all():
+                    break
+
+            for row in generator.sequence[:, ids.shape[-1] :].tolist():
+                if tokenizer.eos_token_id in row:
+                    row = row[: row.index(tokenizer.eos_token_id)]
+                text = tokenizer.tokenizer.Decode(row)
+                texts.append(truncate_at_stop_sequences(text, stop_sequences))
+        return texts
+
     def __call__(
         self,
         prompt: str,
@@ -121,7 +300,7 @@ class ExllamaEngine(Engine):
     ):
         if top_k <= 0:
             top_k = 20
-        generator = begin(self.generator)
+        generator = self.generator
         generator.settings.token_repetition_penalty_max = repetition_penalty
         generator.settings.token_repetition_penalty_sustain = repetition_penalty_sustain
         generator.settings.token_repetition_penalty_decay = (
@@ -144,15 +323,23 @@ class ExllamaEngine(Engine):
             max_new_tokens, generator.model.config.max_seq_len - n_in_tokens
         )
 
-        num_res_tokens = in_tokens.shape[-1]  # Decode from here
-
-        generator.gen_begin(in_tokens)
+        start = time.time()
+        reused = self.begin_with_prefix(in_tokens)
+        print(
+            f"prefilled {n_in_tokens - reused} of {n_in_tokens} prompt tokens in {time.time() - start:.3f}s"
+        )
         generator.begin_beam_search()
 
         stop_sequence_handler = StreamingTextStopSequenceHandler(
             stop_sequences=stop_sequences,
             eos_token=generator.tokenizer.eos_token,
         )
+        # decode with sentencepiece directly, ExLlamaTokenizer.decode wants a tensor
+        detokenizer = IncrementalDetokenizer(
+            generator.tokenizer.tokenizer.Decode, in_tokens[0].tolist()
+        )
+        # just enough of the text so far for the endswith check below
+        last_text = prompt[-len("[/INST]") :]
 
         for i in range(max_new_tokens):
             if i < min_new_tokens:
@@ -172,19 +359,14 @@ class ExllamaEngine(Engine):
             if gen_token.item() == generator.tokenizer.eos_token_id:
                 generator.replace_last_token(generator.tokenizer.newline_token_id)
 
-            num_res_tokens += 1
-            text = generator.tokenizer.decode(
-                generator.sequence_actual[:, -num_res_tokens:][0]
-            )
-            new_text = text[len(prompt):]
-
-            if len(new_text.replace("�", "")) == 0:
-                # if we're getting �, then we're halfway through an emoji; ignore it til it's fully generated. 
+            new_text = detokenizer(gen_token.item())
+            if not new_text:
+                # halfway through a multi-byte character (e.g. an emoji); wait til it's fully generated
                 continue
-            skip_space = prompt.endswith(("\n", "[/INST]")) and new_text.startswith(
+            skip_space = last_text.endswith(("\n", "[/INST]")) and new_text.startswith(
                 " "
             )  # Bit prettier console output
-            prompt += new_text
+            last_text = (last_text + new_text)[-len("[/INST]") :]
             if skip_space:
                 new_text = new_text[1:]
 
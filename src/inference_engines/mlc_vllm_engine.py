@@ -40,6 +40,12 @@ class MLCvLLMEngine(Engine):
 
         return self.engine.load_lora(lora_data)
 
+    def offload_lora(self, lora: Any) -> Any:
+        return self.engine.offload_lora(lora)
+
+    def restore_lora(self, offloaded_lora: Any) -> Any:
+        return self.engine.restore_lora(offloaded_lora)
+
     def is_lora_active(self) -> bool:
         """
         Returns True if the engine is currently configured to use a lora, False otherwise.
@@ -85,3 +91,10 @@ class MLCvLLMEngine(Engine):
         )
         for val in gen:
             yield val
+
+    def generate_batch(self, prompts: List[str], **kwargs) -> List[str]:
+        return self.engine.generate_batch(prompts, **kwargs)
+
+    async def astream(self, prompt, **kwargs):
+        async for val in self.engine.astream(prompt, **kwargs):
+            yield val
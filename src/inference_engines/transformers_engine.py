@@ -1,6 +1,6 @@
 import os
 import shutil
-from transformers import AutoModelForCausalLM, TextIteratorStreamer, StoppingCriteria
+from transformers import TextIteratorStreamer, StoppingCriteria
 from typing import Optional, List, Tuple, Any
 from threading import Thread
 from peft import PeftModel, LoraConfig
@@ -9,6 +9,8 @@ from peft.utils.save_and_load import set_peft_model_state_dict
 import torch.nn.init
 
 from src.config_utils import Weights
+from src.utils import truncate_at_stop_sequences
+from src.weights_loader import load_model_streaming
 
 torch.nn.init.kaiming_uniform_ = lambda x, *args, **kwargs: x
 torch.nn.init.uniform_ = lambda x, *args, **kwargs: x
@@ -44,10 +46,8 @@ class TransformersEngine(Engine):
     """
 
     def __init__(self, weights: Weights, tokenizer_func=None, device="cuda"):
-        model_path = self.load_weights(weights)
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_path, torch_dtype=torch.bfloat16
-        ).to(device)
+        download = self.start_weights_download(weights)
+        self.model = load_model_streaming(download, device=device, dtype=torch.bfloat16)
         self.tokenizer = tokenizer_func()
         self.device = device
         print("Transformers engine initialized.")
@@ -62,19 +62,37 @@ class TransformersEngine(Engine):
         # and this implementation isn't built for speed anyway
         model_dir = "tmp/model"
         os.makedirs(model_dir)
+        weights = None
         for handle in lora_weights:
+            if isinstance(lora_weights[handle], dict):
+                # already loaded into tensors by src.lora_loader.read_lora_archive
+                weights = lora_weights[handle]
+                continue
             fpath = os.path.join(model_dir, handle)
             with open(fpath, "wb") as f:
                 f.write(lora_weights[handle])
 
         config = LoraConfig.from_pretrained(model_dir)
-        weights = torch.load(
-            os.path.join(model_dir, "adapter_model.bin"),
-            map_location=torch.device("cuda" if torch.cuda.is_available() else "cpu"),
-        )
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        if weights is None:
+            weights = torch.load(
+                os.path.join(model_dir, "adapter_model.bin"), map_location=device
+            )
+        else:
+            weights = {k: v.to(device) for k, v in weights.items()}
         shutil.rmtree(model_dir)
         return (config, weights)
 
+    def offload_lora(self, lora: Tuple[LoraConfig, Any]) -> Tuple[LoraConfig, Any]:
+        config, weights = lora
+        return config, {k: v.to("cpu").pin_memory() for k, v in weights.items()}
+
+    def restore_lora(self, offloaded_lora: Tuple[LoraConfig, Any]) -> Tuple[LoraConfig, Any]:
+        config, weights = offloaded_lora
+        return config, {
+            k: v.to(self.device, non_blocking=True) for k, v in weights.items()
+        }
+
     def is_lora_active(self) -> bool:
         return isinstance(self.model, PeftModel)
 
@@ -126,6 +144,47 @@ class TransformersEngine(Engine):
             logits = output.logits[:, -1, :]
         return logits
 
+    def generate_batch(
+        self,
+        prompts: List[str],
+        max_new_tokens: int = 128,
+        min_new_tokens: int = -1,
+        temperature: float = 0.75,
+        top_p: float = 0.9,
+        top_k: int = 50,
+        stop_sequences: Optional[List[str]] = None,
+        **kwargs,
+    ) -> List[str]:
+        """
+        Runs all prompts through one left-padded generate call. Stop sequences are applied to the finished texts.
+        """
+        padding_side = self.tokenizer.padding_side
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        try:
+            inputs = self.tokenizer(prompts, return_tensors="pt", padding=True).to(
+                self.device
+            )
+        finally:
+            self.tokenizer.padding_side = padding_side
+
+        with torch.no_grad():
+            output_ids = self.model.generate(
+                **inputs,
+                do_sample=True,
+                max_new_tokens=max_new_tokens,
+                min_new_tokens=min_new_tokens,
+                temperature=temperature,
+                top_p=top_p,
+                top_k=top_k,
+                pad_token_id=self.tokenizer.pad_token_id,
+            )
+        texts = self.tokenizer.batch_decode(
+            output_ids[:, inputs.input_ids.shape[-1] :], skip_special_tokens=True
+        )
+        return [truncate_at_stop_sequences(text, stop_sequences) for text in texts]
+
     def __call__(
         self,
         prompt,
@@ -1,12 +1,17 @@
 import asyncio
+import concurrent.futures
 import json
 import os
+import queue
+import threading
+import uuid
 from io import BytesIO, IOBase
-from typing import AsyncIterator, BinaryIO, List, Optional, Union, get_args
+from typing import AsyncIterator, BinaryIO, Callable, List, Optional, Union, get_args
 
 import torch
 from vllm import AsyncLLMEngine
 from vllm.engine.arg_utils import AsyncEngineArgs
+from vllm.outputs import RequestOutput
 from vllm.sampling_params import SamplingParams
 
 from src.config_utils import Weights
@@ -16,6 +21,8 @@ from .engine import Engine
 FILE_LIKE = str | os.PathLike
 BYTES_LIKE = str | BinaryIO | IOBase | bytes
 
+END_OF_STREAM = object()
+
 
 class LoRA:
     def __init__(
@@ -44,6 +51,20 @@ class LoRA:
             adapter_config=adapter_config_bytes, adapter_model=adapter_model_bytes
         )
 
+    @classmethod
+    def load_from_state_dict(
+        cls, adapter_config: dict, adapter_model: dict[str, torch.Tensor]
+    ) -> "LoRA":
+        """
+        Builds a LoRA from an already parsed config and state dict, moving the tensors to the gpu.
+        """
+        lora = cls.__new__(cls)
+        lora.adapter_config = adapter_config
+        lora.adapter_model = {
+            k: v.to("cuda", non_blocking=True) for k, v in adapter_model.items()
+        }
+        return lora
+
 
 class vLLMEngine(Engine):
     """
@@ -59,6 +80,12 @@ class vLLMEngine(Engine):
         )
         self.engine = AsyncLLMEngine.from_engine_args(args)
         self.tokenizer = self.engine.engine.tokenizer
+        # AsyncLLMEngine is bound to the event loop it first runs on. Giving it a loop of its own lets
+        # every prediction, whichever thread or loop it comes from, feed the same continuous batch.
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(
+            target=self.loop.run_forever, name="vllm-engine-loop", daemon=True
+        ).start()
 
     def load_lora(
         self,
@@ -86,19 +113,24 @@ class vLLMEngine(Engine):
 
         if lora_state_dict is not None:
             ADAPTER_CONFIG_KEY_NAME = "adapter_config.json"
-            ADAPTER_MODEL_KEY_NAME = "adapter_model.bin"
+            ADAPTER_MODEL_KEY_NAMES = ("adapter_model.safetensors", "adapter_model.bin")
+            adapter_model_key = next(
+                (k for k in ADAPTER_MODEL_KEY_NAMES if k in lora_state_dict), None
+            )
             if (
                 ADAPTER_CONFIG_KEY_NAME not in lora_state_dict.keys()
-                or ADAPTER_MODEL_KEY_NAME not in lora_state_dict.keys()
+                or adapter_model_key is None
             ):
                 raise ValueError(
-                    f"lora_state_dict must include at least: '{ADAPTER_MODEL_KEY_NAME}' and '{ADAPTER_CONFIG_KEY_NAME}'."
+                    f"lora_state_dict must include at least: one of {ADAPTER_MODEL_KEY_NAMES} and '{ADAPTER_CONFIG_KEY_NAME}'."
                 )
 
-            adapter_config, adapter_model = (
-                lora_state_dict[ADAPTER_CONFIG_KEY_NAME],
-                BytesIO(lora_state_dict[ADAPTER_MODEL_KEY_NAME]),
-            )
+            adapter_config = lora_state_dict[ADAPTER_CONFIG_KEY_NAME]
+            adapter_model = lora_state_dict[adapter_model_key]
+            if isinstance(adapter_model, dict):
+                # already loaded into tensors by src.lora_loader.read_lora_archive
+                return LoRA.load_from_state_dict(json.loads(adapter_config), adapter_model)
+            adapter_model = BytesIO(adapter_model)
 
         if isinstance(adapter_model, get_args(FILE_LIKE)) and isinstance(
             adapter_config, get_args(FILE_LIKE)
@@ -119,6 +151,18 @@ class vLLMEngine(Engine):
 
         return lora
 
+    def offload_lora(self, lora: LoRA) -> tuple[dict, dict[str, torch.Tensor]]:
+        """
+        Copies a LoRA's tensors into pinned host memory, so restoring it is a single async copy.
+        """
+        return lora.adapter_config, {
+            k: v.to("cpu").pin_memory() for k, v in lora.adapter_model.items()
+        }
+
+    def restore_lora(self, offloaded_lora: tuple[dict, dict[str, torch.Tensor]]) -> LoRA:
+        adapter_config, adapter_model = offloaded_lora
+        return LoRA.load_from_state_dict(adapter_config, adapter_model)
+
     def is_lora_active(self) -> bool:
         """
         Returns True if the engine is currently configured to use a lora, False otherwise.
@@ -139,15 +183,40 @@ class vLLMEngine(Engine):
         self.engine.engine.delete_lora()
 
     async def generate_stream(
-        self, prompt: str, sampling_params: SamplingParams
-    ) -> AsyncIterator[str]:
-        results_generator = self.engine.generate(prompt, sampling_params, 0)
+        self, prompt: str, sampling_params: SamplingParams, request_id: str
+    ) -> AsyncIterator[RequestOutput]:
+        results_generator = self.engine.generate(prompt, sampling_params, request_id)
         async for generated_text in results_generator:
             yield generated_text
 
-    def __call__(
+    def submit(
         self,
         prompt: str,
+        sampling_params: SamplingParams,
+        put: Callable[[RequestOutput | BaseException | object], None],
+    ) -> concurrent.futures.Future:
+        """
+        Schedules a request on the engine loop under a fresh request id. Every RequestOutput is handed to `put`
+        (from the engine thread), followed by either an exception or END_OF_STREAM. Cancelling the returned
+        future aborts the request inside vLLM.
+        """
+        request_id = uuid.uuid4().hex
+
+        async def pump() -> None:
+            try:
+                async for request_output in self.generate_stream(
+                    prompt, sampling_params, request_id
+                ):
+                    put(request_output)
+            except Exception as e:
+                put(e)
+            else:
+                put(END_OF_STREAM)
+
+        return asyncio.run_coroutine_threadsafe(pump(), self.loop)
+
+    def get_sampling_params(
+        self,
         max_new_tokens: int,
         temperature: float,
         top_p: float,
@@ -155,27 +224,8 @@ class vLLMEngine(Engine):
         stop_sequences: str | List[str] = None,
         stop_token_ids: List[int] = None,
         frequency_penalty: float = 1.0,
-        incremental_generation: bool = True,
-        *args,
         **kwargs,
-    ) -> str:
-        """
-        Given a prompt, runs generation on the language model with vLLM.
-
-        Args:
-        - prompt (str): the prompt to give the model.
-        - max_new_tokens (int): the maximum number of new tokens to generate.
-        - temperature (float): the parameter to anneal the sampling distribution with.
-        - top_p (float): the amount to truncate the sampling distribution by.
-        - top_k (int): the number of tokens to truncate the sampling distribution by.
-        - stop_sequences (str | List[str]): the string to stop generation at.
-        - stop_token_ids (List[str]): a list of token ids to stop generation at.
-        - frequency_penalty (float): the amount to penalize tokens that have already been generated, higher values penalize more.
-        - incremental_generation: whether to yield the entire generated sequence or the next generated token at each step.
-
-        Yields:
-        - generated_text (str): the generated text, or next token, depending on the value of `incremental_generation`.
-        """
+    ) -> SamplingParams:
         if top_k is None or top_k == 0:
             top_k = -1
 
@@ -185,20 +235,20 @@ class vLLMEngine(Engine):
                 "min_new_tokens is currently not supported by vLLM Engine."
             )
 
-        stop_token_ids = stop_token_ids or []
+        stop_token_ids = list(stop_token_ids or [])
         stop_token_ids.append(self.tokenizer.eos_token_id)
 
         if isinstance(stop_sequences, str) and stop_sequences != "":
             stop = [stop_sequences]
         elif isinstance(stop_sequences, list) and len(stop_sequences) > 0:
-            stop = stop_sequences
+            stop = list(stop_sequences)
         else:
             stop = []
 
         for tid in stop_token_ids:
             stop.append(self.tokenizer.decode(tid))
 
-        sampling_params = SamplingParams(
+        return SamplingParams(
             n=1,
             top_p=top_p,
             top_k=top_k,
@@ -209,33 +259,180 @@ class vLLMEngine(Engine):
             frequency_penalty=frequency_penalty,
         )
 
+    @staticmethod
+    def get_text(
+        request_output: RequestOutput, generation_length: int, incremental_generation: bool
+    ) -> tuple[str | None, int]:
+        """
+        Returns the text to yield for this output (or None) and the new generation length.
+        """
+        assert len(request_output.outputs) == 1
+        generated_text = request_output.outputs[0].text
+        if not incremental_generation:
+            return generated_text, len(generated_text)
+        # it takes multiple engine steps to render one emoji.
+        # this check keeps us from needlesly yielding empty strings
+        if len(generated_text) > generation_length:
+            return generated_text[generation_length:], len(generated_text)
+        return None, len(generated_text)
+
+    def generate_batch(
+        self,
+        prompts: List[str],
+        max_new_tokens: int,
+        temperature: float,
+        top_p: float,
+        top_k: int,
+        stop_sequences: str | List[str] = None,
+        stop_token_ids: List[int] = None,
+        frequency_penalty: float = 1.0,
+        **kwargs,
+    ) -> List[str]:
+        """
+        Submits every prompt at once and lets vLLM's scheduler batch them, returning the generated texts in order.
+        """
+        sampling_params = self.get_sampling_params(
+            max_new_tokens,
+            temperature,
+            top_p,
+            top_k,
+            stop_sequences=stop_sequences,
+            stop_token_ids=stop_token_ids,
+            frequency_penalty=frequency_penalty,
+            **kwargs,
+        )
+        texts = [""] * len(prompts)
+        errors = []
+
+        def collector(i: int) -> Callable:
+            def put(request_output: RequestOutput | BaseException | object) -> None:
+                if isinstance(request_output, BaseException):
+                    errors.append(request_output)
+                elif request_output is not END_OF_STREAM:
+                    texts[i] = request_output.outputs[0].text
+
+            return put
+
+        futures = [
+            self.submit(prompt, sampling_params, collector(i))
+            for i, prompt in enumerate(prompts)
+        ]
         try:
-            loop = asyncio.get_event_loop()
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
+            for future in futures:
+                future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+        if errors:
+            raise errors[0]
+        return texts
 
-        gen = self.generate_stream(
+    def __call__(
+        self,
+        prompt: str,
+        max_new_tokens: int,
+        temperature: float,
+        top_p: float,
+        top_k: int,
+        stop_sequences: str | List[str] = None,
+        stop_token_ids: List[int] = None,
+        frequency_penalty: float = 1.0,
+        incremental_generation: bool = True,
+        *args,
+        **kwargs,
+    ) -> str:
+        """
+        Given a prompt, runs generation on the language model with vLLM.
+        Safe to call from several threads at once; concurrent calls are batched together by vLLM.
+
+        Args:
+        - prompt (str): the prompt to give the model.
+        - max_new_tokens (int): the maximum number of new tokens to generate.
+        - temperature (float): the parameter to anneal the sampling distribution with.
+        - top_p (float): the amount to truncate the sampling distribution by.
+        - top_k (int): the number of tokens to truncate the sampling distribution by.
+        - stop_sequences (str | List[str]): the string to stop generation at.
+        - stop_token_ids (List[str]): a list of token ids to stop generation at.
+        - frequency_penalty (float): the amount to penalize tokens that have already been generated, higher values penalize more.
+        - incremental_generation: whether to yield the entire generated sequence or the next generated token at each step.
+
+        Yields:
+        - generated_text (str): the generated text, or next token, depending on the value of `incremental_generation`.
+        """
+        sampling_params = self.get_sampling_params(
+            max_new_tokens,
+            temperature,
+            top_p,
+            top_k,
+            stop_sequences=stop_sequences,
+            stop_token_ids=stop_token_ids,
+            frequency_penalty=frequency_penalty,
+            **kwargs,
+        )
+
+        outputs = queue.Queue()
+        future = self.submit(prompt, sampling_params, outputs.put)
+        try:
+            generation_length = 0
+            while (request_output := outputs.get()) is not END_OF_STREAM:
+                if isinstance(request_output, BaseException):
+                    raise request_output
+                text, generation_length = self.get_text(
+                    request_output, generation_length, incremental_generation
+                )
+                if text is not None:
+                    yield text
+        finally:
+            # no-op if the request finished, aborts it if the caller stopped early
+            future.cancel()
+
+    async def astream(
+        self,
+        prompt: str,
+        max_new_tokens: int,
+        temperature: float,
+        top_p: float,
+        top_k: int,
+        stop_sequences: str | List[str] = None,
+        stop_token_ids: List[int] = None,
+        frequency_penalty: float = 1.0,
+        incremental_generation: bool = True,
+        **kwargs,
+    ) -> AsyncIterator[str]:
+        """
+        Async version of __call__. Each call is its own vLLM request, so concurrent predictions
+        are merged into the same batch by vLLM's scheduler.
+        """
+        sampling_params = self.get_sampling_params(
+            max_new_tokens,
+            temperature,
+            top_p,
+            top_k,
+            stop_sequences=stop_sequences,
+            stop_token_ids=stop_token_ids,
+            frequency_penalty=frequency_penalty,
+            **kwargs,
+        )
+
+        loop = asyncio.get_running_loop()
+        outputs = asyncio.Queue()
+        future = self.submit(
             prompt,
             sampling_params,
+            lambda item: loop.call_soon_threadsafe(outputs.put_nowait, item),
         )
-
-        generation_length = 0
-        while True:
-            try:
-                request_output = loop.run_until_complete(gen.__anext__())
-                assert len(request_output.outputs) == 1
-                generated_text = request_output.outputs[0].text
-                if incremental_generation:
-                    # it takes multiple calls to gen.__anext__ to render one emoji. 
-                    # this check keeps us from needlesly yielding empty strings
-                    if len(generated_text) > generation_length:
-                        yield generated_text[generation_length:]
-                else:
-                    yield generated_text
-                generation_length = len(generated_text)
-            except StopAsyncIteration:
-                break
+        try:
+            generation_length = 0
+            while (request_output := await outputs.get()) is not END_OF_STREAM:
+                if isinstance(request_output, BaseException):
+                    raise request_output
+                text, generation_length = self.get_text(
+                    request_output, generation_length, incremental_generation
+                )
+                if text is not None:
+                    yield text
+        finally:
+            future.cancel()
 
 
 def run_generation():
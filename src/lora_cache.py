@@ -0,0 +1,235 @@
+import hashlib
+import os
+import shutil
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+import torch
+
+from .download import Downloader
+from .lora_loader import read_lora_archive
+
+# three tiers, each with its own byte budget:
+# 1. gpu: whatever engine.load_lora returned, ready for set_lora
+# 2. host: engine.offload_lora output (cpu tensors), restored without unzip or torch.load
+# 3. disk: the downloaded zip, so a cold url is only ever downloaded once
+
+
+def tensor_nbytes(obj: Any) -> int:
+    """total size of the tensors in a (possibly nested) dict/list/tuple"""
+    if isinstance(obj, torch.Tensor):
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, dict):
+        return sum(tensor_nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(tensor_nbytes(v) for v in obj)
+    return 0
+
+
+class ClockCache:
+    """
+    Byte-budgeted CLOCK (second chance) cache. Entries sit on a ring in insertion order;
+    a hit sets the entry's reference bit, and eviction sweeps the hand over the ring,
+    clearing bits until it finds an entry that hasn't been used since the last sweep.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        capacity_bytes: int,
+        on_evict: Optional[Callable[[str, Any], None]] = None,
+    ) -> None:
+        self.name = name
+        self.capacity_bytes = capacity_bytes
+        self.on_evict = on_evict
+        # key -> [value, nbytes, referenced]; the front of the dict is the clock hand
+        self.entries: "OrderedDict[str, list]" = OrderedDict()
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: str) -> Any:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry[2] = True
+        return entry[0]
+
+    def pop(self, key: str) -> Any:
+        value, nbytes, _ = self.entries.pop(key)
+        self.used_bytes -= nbytes
+        return value
+
+    def put(self, key: str, value: Any, nbytes: int) -> bool:
+        """
+        Inserts value, evicting as needed. Returns False (and evicts the value itself) if
+        it can never fit in this tier.
+        """
+        if key in self.entries:
+            self.pop(key)
+        if nbytes > self.capacity_bytes:
+            self.evictions += 1
+            if self.on_evict:
+                self.on_evict(key, value)
+            return False
+        while self.used_bytes + nbytes > self.capacity_bytes:
+            self._evict_one()
+        # new entries start unreferenced so a one-off adapter can't push out a hot one
+        self.entries[key] = [value, nbytes, False]
+        self.used_bytes += nbytes
+        return True
+
+    def _evict_one(self) -> None:
+        while True:
+            key, entry = next(iter(self.entries.items()))
+            if entry[2]:
+                # second chance: clear the bit and advance the hand past it
+                entry[2] = False
+                self.entries.move_to_end(key)
+                continue
+            value = self.pop(key)
+            self.evictions += 1
+            if self.on_evict:
+                self.on_evict(key, value)
+            return
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "used_bytes": self.used_bytes,
+            "capacity_bytes": self.capacity_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class LoRACache:
+    """
+    Caches LoRAs across gpu, host and disk tiers, keyed by their replicate_weights url or path.
+    Adapters evicted from the gpu tier are demoted to host memory if the engine supports
+    offload_lora; adapters evicted from host memory are dropped, but their zip stays on disk.
+    """
+
+    def __init__(
+        self,
+        engine: Any,
+        downloader: Downloader,
+        gpu_bytes: int,
+        host_bytes: int,
+        disk_bytes: int,
+        disk_path: str,
+    ) -> None:
+        self.engine = engine
+        self.downloader = downloader
+        self.disk_path = disk_path
+        self.downloads = 0
+        self.gpu = ClockCache("gpu", gpu_bytes, on_evict=self._demote)
+        self.host = ClockCache("host", host_bytes)
+        self.disk = ClockCache("disk", disk_bytes, on_evict=self._remove_archive)
+        os.makedirs(disk_path, exist_ok=True)
+        # pick up archives left behind by a previous process, oldest first
+        archives = sorted(
+            (entry for entry in os.scandir(disk_path) if entry.name.endswith(".zip")),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+        for entry in archives:
+            self.disk.put(entry.name, entry.path, entry.stat().st_size)
+
+    def get(self, replicate_weights: str) -> Any:
+        key = str(replicate_weights)
+
+        lora = self.gpu.get(key)
+        if lora is not None:
+            print("LoRA cache hit (gpu)")
+            return lora
+
+        offloaded = self.host.get(key)
+        if offloaded is not None:
+            st = time.time()
+            self.host.pop(key)
+            lora, nbytes = self._measure(
+                lambda: self.engine.restore_lora(offloaded), tensor_nbytes(offloaded)
+            )
+            print(f"LoRA cache hit (host), restored in {time.time() - st:.3f}")
+            self.gpu.put(key, lora, nbytes)
+            return lora
+
+        if "http" in key:  # weights are in the cloud
+            archive_name = hashlib.sha256(key.encode()).hexdigest()[:32] + ".zip"
+            buffer = self.disk.get(archive_name)
+            if buffer is not None:
+                print("LoRA cache hit (disk)")
+            else:
+                buffer = self._download(key, archive_name)
+        else:
+            # read_lora_archive accepts either a file-like or path-like object
+            buffer = key
+
+        st = time.time()
+        data = read_lora_archive(buffer)
+        print(f"Read peft weights in {time.time() - st:.3f}")
+        st = time.time()
+        lora, nbytes = self._measure(
+            lambda: self.engine.load_lora(data), tensor_nbytes(data)
+        )
+        del data
+        print(f"Initialized peft model in {time.time() - st:.3f}")
+        self.gpu.put(key, lora, nbytes)
+        return lora
+
+    def stats(self) -> dict:
+        return {
+            "downloads": self.downloads,
+            "gpu": self.gpu.stats(),
+            "host": self.host.stats(),
+            "disk": self.disk.stats(),
+        }
+
+    def _download(self, url: str, archive_name: str) -> Any:
+        print("Downloading peft weights")
+        st = time.time()
+        buffer = self.downloader.sync_download_file(url)
+        self.downloads += 1
+        print(f"Downloaded peft weights in {time.time() - st:.3f}")
+        path = os.path.join(self.disk_path, archive_name)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            shutil.copyfileobj(buffer, f, length=2 << 18)
+        os.rename(tmp_path, path)
+        buffer.seek(0)
+        self.disk.put(archive_name, path, os.path.getsize(path))
+        return buffer
+
+    def _measure(self, load: Callable[[], Any], fallback_nbytes: int) -> "tuple[Any, int]":
+        """
+        runs load and returns its result along with how much gpu memory it took,
+        falling back to fallback_nbytes on cpu or if the allocator can't tell us
+        """
+        if not torch.cuda.is_available():
+            return load(), fallback_nbytes
+        before = torch.cuda.memory_allocated()
+        result = load()
+        nbytes = torch.cuda.memory_allocated() - before
+        return result, nbytes if nbytes > 0 else fallback_nbytes
+
+    def _demote(self, key: str, lora: Any) -> None:
+        offloaded = self.engine.offload_lora(lora)
+        if offloaded is not None:
+            self.host.put(key, offloaded, tensor_nbytes(offloaded))
+
+    def _remove_archive(self, archive_name: str, path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,184 @@
+import hashlib
+import json
+import os
+import struct
+import zipfile
+from typing import Any, Optional
+
+import torch
+from safetensors.torch import load_file, save
+
+# Packs a trained PEFT LoRA into the zip that inference replicas download.
+# Weights are written as fp16/bf16 safetensors, optionally truncated to a lower rank, and stored
+# uncompressed at an aligned offset, so src.lora_loader can view them straight out of the archive.
+
+EXPORT_DTYPES = {
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+    "float32": torch.float32,
+}
+
+ADAPTER_CONFIG_NAME = "adapter_config.json"
+ADAPTER_WEIGHTS_NAMES = ("adapter_model.safetensors", "adapter_model.bin")
+EXPORTED_WEIGHTS_NAME = "adapter_model.safetensors"
+MANIFEST_NAME = "manifest.json"
+# files besides the adapter config and weights that are packaged with them, if adapter_dir has them
+EXTRA_FILE_NAMES = ("README.md",)
+
+# stored members start on this boundary, so tensors viewing them are aligned
+ZIP_ALIGNMENT = 64
+# zip extra field id for alignment padding, as used by Android's zipalign
+ZIP_ALIGNMENT_EXTRA_ID = 0xD935
+
+
+def lora_pairs(state_dict: dict[str, torch.Tensor]) -> dict[str, tuple[str, str]]:
+    """{module prefix: (lora_A key, lora_B key)}"""
+    pairs = {}
+    for key in state_dict:
+        if ".lora_A." in key:
+            prefix, suffix = key.split(".lora_A.")
+            b_key = f"{prefix}.lora_B.{suffix}"
+            if b_key in state_dict:
+                pairs[prefix] = (key, b_key)
+    return pairs
+
+
+def lora_singular_values(a: torch.Tensor, b: torch.Tensor):
+    """
+    SVD of the update b @ a (out x r @ r x in) through the QR factors of its thin sides, so only an r x r
+    matrix is decomposed. Returns (q_b @ u, s, v^T @ q_a^T), with b @ a == q_b @ u @ diag(s) @ v^T @ q_a^T.
+    """
+    q_b, r_b = torch.linalg.qr(b.double())
+    q_a, r_a = torch.linalg.qr(a.double().T)
+    u, s, vh = torch.linalg.svd(r_b @ r_a.T)
+    return q_b @ u, s, vh @ q_a.T
+
+
+def truncate_lora_rank(
+    state_dict: dict[str, torch.Tensor], rank: int, energy_threshold: float
+) -> tuple[dict[str, torch.Tensor], int, dict[str, float]]:
+    """
+    Lowers the rank of every LoRA pair to the smallest rank keeping `energy_threshold` of the squared singular
+    values of each module's update. The config's rank is shared by all modules, so they all get the largest rank
+    any of them needs. lora_alpha is unchanged and the factors are rescaled for the new alpha / rank scaling.
+    Returns the state dict, the new rank and the energy retained per module.
+    """
+    pairs = lora_pairs(state_dict)
+    factors = {
+        prefix: lora_singular_values(state_dict[a_key], state_dict[b_key])
+        for prefix, (a_key, b_key) in pairs.items()
+    }
+
+    new_rank = 1
+    for _, s, _ in factors.values():
+        energy = torch.cumsum(s**2, 0) / (s**2).sum().clamp(min=1e-30)
+        needed = int(torch.searchsorted(energy, energy_threshold - 1e-12)) + 1
+        new_rank = max(new_rank, min(needed, len(s)))
+    new_rank = min(new_rank, rank)
+
+    truncated = dict(state_dict)
+    retained = {}
+    for prefix, (a_key, b_key) in pairs.items():
+        left, s, right = factors[prefix]
+        retained[prefix] = float((s[:new_rank] ** 2).sum() / (s**2).sum().clamp(min=1e-30))
+        # (alpha / new_rank) * b' @ a' == (alpha / rank) * b @ a, split evenly between the factors
+        scale = (s[:new_rank] * new_rank / rank).sqrt()
+        truncated[b_key] = (left[:, :new_rank] * scale).to(state_dict[b_key].dtype)
+        truncated[a_key] = (scale[:, None] * right[:new_rank]).to(state_dict[a_key].dtype)
+    return truncated, new_rank, retained
+
+
+def aligned_zip_info(name: str, offset: int) -> zipfile.ZipInfo:
+    """ZipInfo for a stored member whose data starts on a ZIP_ALIGNMENT boundary when written at offset"""
+    info = zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+    info.compress_type = zipfile.ZIP_STORED
+    # local header, then name, then a 4 byte extra field header and its padding
+    unpadded = offset + 30 + len(name.encode()) + 4
+    padding = -unpadded % ZIP_ALIGNMENT
+    info.extra = struct.pack("<HH", ZIP_ALIGNMENT_EXTRA_ID, padding) + b"\0" * padding
+    return info
+
+
+def write_stored_zip(path: str, files: dict[str, bytes]) -> None:
+    """writes files uncompressed, each member's data aligned to ZIP_ALIGNMENT"""
+    with open(path, "wb") as f, zipfile.ZipFile(f, "w", zipfile.ZIP_STORED) as zip_ref:
+        for name, contents in files.items():
+            zip_ref.writestr(aligned_zip_info(name, f.tell()), contents)
+
+
+def load_adapter(adapter_dir: str) -> tuple[dict[str, Any], dict[str, torch.Tensor]]:
+    """the adapter config and weights PEFT's save_pretrained wrote to adapter_dir"""
+    with open(os.path.join(adapter_dir, ADAPTER_CONFIG_NAME)) as f:
+        config = json.load(f)
+    for name in ADAPTER_WEIGHTS_NAMES:
+        path = os.path.join(adapter_dir, name)
+        if not os.path.exists(path):
+            continue
+        if name.endswith(".safetensors"):
+            return config, load_file(path)
+        return config, torch.load(path, map_location="cpu")
+    raise FileNotFoundError(f"No adapter weights ({', '.join(ADAPTER_WEIGHTS_NAMES)}) in {adapter_dir}")
+
+
+def export_adapter(
+    adapter_dir: str,
+    out_path: str,
+    dtype: str = "float16",
+    energy_threshold: Optional[float] = None,
+) -> dict[str, Any]:
+    """
+    Writes the LoRA in adapter_dir to the zip at out_path as `dtype` safetensors, along with its adapter config,
+    a manifest and those of EXTRA_FILE_NAMES in adapter_dir; nothing else in adapter_dir is packaged. With energy_threshold (0, 1], the rank is truncated to keep
+    that fraction of each update's energy (see truncate_lora_rank). Returns the manifest.
+    """
+    config, state_dict = load_adapter(adapter_dir)
+    original_rank = config.get("r")
+    manifest = {
+        "format": "safetensors",
+        "dtype": dtype,
+        "rank": original_rank,
+        "original_rank": original_rank,
+    }
+
+    if energy_threshold is not None and original_rank and lora_pairs(state_dict):
+        state_dict, rank, retained = truncate_lora_rank(
+            {k: v.float() for k, v in state_dict.items()},
+            original_rank,
+            energy_threshold,
+        )
+        config["r"] = manifest["rank"] = rank
+        manifest["energy_threshold"] = energy_threshold
+        manifest["min_retained_energy"] = min(retained.values())
+
+    torch_dtype = EXPORT_DTYPES[dtype]
+    state_dict = {k: v.to(torch_dtype).contiguous() for k, v in state_dict.items()}
+    for k, v in state_dict.items():
+        if not torch.isfinite(v).all():
+            raise ValueError(f"{k} doesn't fit in {dtype}; export the adapter as bfloat16 or float32")
+
+    files = {
+        ADAPTER_CONFIG_NAME: json.dumps(config, indent=2).encode(),
+        EXPORTED_WEIGHTS_NAME: save(state_dict, metadata={"format": "pt"}),
+    }
+    for name in EXTRA_FILE_NAMES:
+        path = os.path.join(adapter_dir, name)
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                files[name] = f.read()
+
+    manifest["files"] = {
+        name: {"size": len(contents), "sha256": hashlib.sha256(contents).hexdigest()}
+        for name, contents in files.items()
+    }
+    manifest["tensors"] = {
+        k: {"shape": list(v.shape), "dtype": str(v.dtype).replace("torch.", "")}
+        for k, v in state_dict.items()
+    }
+    # small files first, the weights last
+    files = {
+        MANIFEST_NAME: json.dumps(manifest, indent=2).encode(),
+        **{k: v for k, v in files.items() if k != EXPORTED_WEIGHTS_NAME},
+        EXPORTED_WEIGHTS_NAME: files[EXPORTED_WEIGHTS_NAME],
+    }
+    write_stored_zip(out_path, files)
+    return manifest
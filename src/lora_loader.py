@@ -0,0 +1,145 @@
+import io
+import json
+import mmap
+import os
+import struct
+import zipfile
+from typing import Any
+
+import torch
+
+# Reads LoRA zips without materializing the archive's members as bytes.
+# Stored (uncompressed) members are sliced straight out of the archive buffer, so a
+# stored safetensors adapter costs no host copies at all before it is moved to the gpu.
+# Compressed members are inflated once, directly into the buffer the tensors end up viewing.
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+ZIP_LOCAL_HEADER = struct.Struct("<4s5H3I2H")
+
+
+class MemoryviewReader(io.RawIOBase):
+    """seekable file-like over a memoryview, for torch.load without a BytesIO copy"""
+
+    def __init__(self, view: memoryview) -> None:
+        self.view = view
+        self.pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b: Any) -> int:
+        n = min(len(b), len(self.view) - self.pos)
+        b[:n] = self.view[self.pos : self.pos + n]
+        self.pos += n
+        return n
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        else:
+            self.pos = len(self.view) + offset
+        return self.pos
+
+    def tell(self) -> int:
+        return self.pos
+
+
+def load_safetensors(view: memoryview) -> dict[str, torch.Tensor]:
+    """cpu tensors that share memory with view"""
+    (header_len,) = struct.unpack("<Q", view[:8])
+    header = json.loads(bytes(view[8 : 8 + header_len]))
+    header.pop("__metadata__", None)
+    data_start = 8 + header_len
+    tensors = {}
+    for name, info in header.items():
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        if begin == end:
+            tensors[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        tensors[name] = torch.frombuffer(
+            view,
+            dtype=dtype,
+            count=(end - begin) // dtype.itemsize,
+            offset=data_start + begin,
+        ).view(info["shape"])
+    return tensors
+
+
+def member_view(
+    zip_ref: zipfile.ZipFile, archive: memoryview, info: zipfile.ZipInfo
+) -> memoryview:
+    """
+    Returns the (decompressed) contents of a zip member. Stored members are a slice of the archive;
+    compressed ones are inflated into a single preallocated buffer.
+    """
+    if info.compress_type == zipfile.ZIP_STORED:
+        # the local header's extra field can differ from the central directory's, so read it here
+        fields = ZIP_LOCAL_HEADER.unpack_from(archive, info.header_offset)
+        name_len, extra_len = fields[-2:]
+        start = info.header_offset + ZIP_LOCAL_HEADER.size + name_len + extra_len
+        return archive[start : start + info.file_size]
+    buffer = bytearray(info.file_size)
+    with zip_ref.open(info) as member:
+        view = memoryview(buffer)
+        pos = 0
+        while pos < info.file_size:
+            n = member.readinto(view[pos:])
+            if not n:
+                break
+            pos += n
+    return memoryview(buffer)
+
+
+def open_archive(archive: Any) -> memoryview:
+    """memoryview over a path, mmap, BytesIO or bytes-like archive"""
+    if isinstance(archive, io.BytesIO):
+        return archive.getbuffer()
+    if isinstance(archive, (str, os.PathLike)):
+        with open(archive, "rb") as f:
+            # copy-on-write keeps the buffer writable (torch.frombuffer warns otherwise) without reading the file
+            archive = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    elif isinstance(archive, bytes):
+        archive = bytearray(archive)
+    return memoryview(archive)
+
+
+def read_lora_archive(archive: Any) -> dict[str, Any]:
+    """
+    Reads a LoRA zip from a path, mmap (e.g. from Downloader), BytesIO or bytes-like object.
+    Returns {filename: contents}, where weight files (.bin/.safetensors) are already loaded into
+    cpu state dicts and everything else (e.g. adapter_config.json) is bytes.
+    """
+    view = open_archive(archive)
+    data = {}
+    with zipfile.ZipFile(MemoryviewReader(view)) as zip_ref:
+        for info in zip_ref.infolist():
+            if info.is_dir():
+                continue
+            contents = member_view(zip_ref, view, info)
+            if info.filename.endswith(".safetensors"):
+                data[info.filename] = load_safetensors(contents)
+            elif info.filename.endswith(".bin"):
+                data[info.filename] = torch.load(
+                    MemoryviewReader(contents), map_location="cpu"
+                )
+            else:
+                data[info.filename] = contents.tobytes()
+    return data
@@ -164,83 +164,74 @@ def maybe_download_with_pget(
 
 
 class StreamingTextStopSequenceHandler:
+    """
+    Streams text through, holding back anything that could be the start of a stop sequence and
+    yielding eos_token once one is complete. Matching runs an Aho-Corasick automaton over the
+    stop sequences one character at a time, so each token costs O(len(token)) no matter how long
+    the generation is or how many stop sequences there are.
+    """
+
     def __init__(self, stop_sequences: tp.List[str] = None, eos_token: str = None):
-        self.stop_sequences = stop_sequences
+        self.stop_sequences = [seq for seq in stop_sequences or [] if seq]
         self.eos_token = eos_token
+        # held back text, i.e. the longest suffix of the output that's a prefix of a stop sequence
         self.cache = []
 
-        if stop_sequences:
-            self.stop_sequence_tracker = [0] * len(self.stop_sequences)
-            self.stop_sequence_lens = [len(seq) for seq in self.stop_sequences]
-
-    def get_match_length(self, text: str, stop_sequence: str):
-        """
-        Checks if the end of the provided text matches the beginning of the stop sequence.
-        Returns the length of the matched stop sequence if it exists, otherwise returns 0.
-        """
-        matched_len = 0
-        for i in range(1, len(stop_sequence) + 1):
-            # Check if the end of the text matches the start of the stop_sequence
-            if stop_sequence[:i] in text:
-                matched_len = i
-
-        if matched_len:
-            return matched_len
-        return 0
+        # trie of the stop sequences: node -> {char: child}, with each node's depth (prefix length),
+        # failure link (longest proper suffix that's also a trie node) and the length of the longest
+        # stop sequence that ends at it
+        self.goto: tp.List[tp.Dict[str, int]] = [{}]
+        self.depth = [0]
+        for seq in self.stop_sequences:
+            node = 0
+            for char in seq:
+                if char not in self.goto[node]:
+                    self.goto.append({})
+                    self.depth.append(self.depth[node] + 1)
+                    self.goto[node][char] = len(self.goto) - 1
+                node = self.goto[node][char]
+        self.match_len = [0] * len(self.goto)
+        for seq in self.stop_sequences:
+            node = 0
+            for char in seq:
+                node = self.goto[node][char]
+            self.match_len[node] = max(self.match_len[node], len(seq))
+
+        # breadth-first, so failure links always point at nodes that are already done
+        self.fail = [0] * len(self.goto)
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for char, child in self.goto[node].items():
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                if not self.match_len[child]:
+                    self.match_len[child] = self.match_len[self.fail[child]]
+                queue.append(child)
+        self.state = 0
 
     def process(self, token):
-        partial_match = False
-        stop_sequence_tracker = self.stop_sequence_tracker.copy()
-
-        # Iterate through each stop sequence
         text = "".join(self.cache) + token
-        for idx, stop_sequence in enumerate(self.stop_sequences):
-            # If token matches the next token in the stop sequence
-            match_length = self.get_match_length(text, stop_sequence)
-            if match_length:
-                # If we've completed the stop sequence
-                if match_length == self.stop_sequence_lens[idx]:
-                    self.cache.append(token)
-                    text_before_stop_sequence = "".join(self.cache).split(
-                        stop_sequence, maxsplit=1
-                    )[0]
-                    if text_before_stop_sequence:
-                        self.cache = [text_before_stop_sequence]
-                    else:
-                        self.cache.clear()
-
-                    # self.cache.clear()
-                    stop_sequence_tracker = [0] * len(self.stop_sequences)
-                    yield self.eos_token
-                else:
-                    partial_match = True
-                    # If we've matched more characters than before, update the tracker
-                    if match_length > stop_sequence_tracker[idx]:
-                        stop_sequence_tracker[idx] = match_length
-                    else:
-                        # Reset the tracker for that sequence
-                        stop_sequence_tracker[idx] = 0
-
-            # If token doesn't match the next token in the stop sequence
-            else:
-                # Reset the tracker for that stop token sequence
-                stop_sequence_tracker[idx] = 0
-
-        if not partial_match:
-            # If token doesn't match a stop sequence, yield all cached tokens and the current token
-            self.cache.clear()
-            yield text
-
-        else:
-            # If we've reset a stop token counter, we need to yield cached tokens and then clear the cache
-            for i, j in zip(stop_sequence_tracker, self.stop_sequence_tracker):
-                if i < j:
-                    yield "".join(self.cache)
-                    self.cache.clear()
-
-            # Then we need to update the tracker and cache the current token
-            self.stop_sequence_tracker = stop_sequence_tracker
-            self.cache.append(token)
+        offset = len(text) - len(token)
+        goto, fail, state = self.goto, self.fail, self.state
+        for i, char in enumerate(token):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if self.match_len[state]:
+                # keep the text before the stop sequence for finalize
+                text_before_stop_sequence = text[: offset + i + 1 - self.match_len[state]]
+                self.cache = [text_before_stop_sequence] if text_before_stop_sequence else []
+                self.state = 0
+                yield self.eos_token
+                return
+
+        self.state = state
+        held = self.depth[state]
+        if len(text) > held:
+            yield text[: len(text) - held]
+        self.cache = [text[len(text) - held :]] if held else []
 
     def __call__(self, token):
         if self.stop_sequences:
@@ -253,6 +244,64 @@ class StreamingTextStopSequenceHandler:
         if self.cache:
             yield from self.cache
             self.cache.clear()
+        self.state = 0
+
+
+def truncate_at_stop_sequences(
+    text: str, stop_sequences: tp.Optional[tp.List[str]] = None
+) -> str:
+    """cuts a finished generation off at the first stop sequence, for non-streaming (batch) generation"""
+    end = len(text)
+    for seq in stop_sequences or []:
+        idx = text.find(seq) if seq else -1
+        if idx != -1:
+            end = min(end, idx)
+    return text[:end]
+
+
+class IncrementalDetokenizer:
+    """
+    Turns a stream of token ids into a stream of text, decoding only a small window of recent ids per token.
+    Each step decodes the window with and without the new token and emits the difference, so sentencepiece's
+    leading-space handling sees the same context either way. Tokens that end partway through a UTF-8
+    character (byte-fallback pieces of an emoji, say) emit nothing until the character is complete.
+    """
+
+    def __init__(
+        self,
+        decode: tp.Callable[[tp.List[int]], str],
+        prompt_ids: tp.Optional[tp.List[int]] = None,
+        context_tokens: int = 6,
+    ):
+        self.decode = decode
+        self.context_tokens = context_tokens
+        # a few prompt tokens give the first generated token the context it'd have in a full decode
+        self.ids = list(prompt_ids[-context_tokens:]) if prompt_ids else []
+        # ids[prefix_offset:read_offset] has been emitted already and is only kept as context
+        self.prefix_offset = 0
+        self.read_offset = len(self.ids)
+
+    def __call__(self, token_id: int) -> str:
+        self.ids.append(token_id)
+        prefix_text = self.decode(self.ids[self.prefix_offset : self.read_offset])
+        new_text = self.decode(self.ids[self.prefix_offset :])
+        if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+            return ""
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.ids)
+        if self.prefix_offset > self.context_tokens:
+            # drop ids that are neither context nor pending, so the window doesn't grow with the output
+            del self.ids[: self.prefix_offset]
+            self.read_offset -= self.prefix_offset
+            self.prefix_offset = 0
+        return new_text[len(prefix_text) :]
+
+    def flush(self) -> str:
+        """whatever is still pending, e.g. an incomplete character at the end of the generation"""
+        prefix_text = self.decode(self.ids[self.prefix_offset : self.read_offset])
+        new_text = self.decode(self.ids[self.prefix_offset :])
+        self.prefix_offset = self.read_offset = len(self.ids)
+        return new_text[len(prefix_text) :]
 
 
 @contextlib.contextmanager
@@ -0,0 +1,76 @@
+import mmap
+import time
+
+import torch
+from transformers import AutoConfig, AutoModelForCausalLM, PreTrainedModel
+from transformers.modeling_utils import no_init_weights
+
+from .download import BackgroundDownload
+from .lora_loader import load_safetensors
+
+# Builds a model while its weights are still downloading: the (uninitialized) model is allocated as
+# soon as config.json lands, and each safetensors shard is copied into it as soon as that shard lands,
+# so by the time the last shard arrives nearly all of the loading is already done.
+
+
+def load_shard(path: str) -> dict[str, torch.Tensor]:
+    """cpu tensors backed by an mmap of the shard, nothing is read until they're copied"""
+    with open(path, "rb") as f:
+        # copy-on-write keeps the buffer writable (torch.frombuffer warns otherwise) without reading the file
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    return load_safetensors(memoryview(buf))
+
+
+def load_model_streaming(
+    download: BackgroundDownload,
+    device: str = "cuda",
+    dtype: torch.dtype = torch.bfloat16,
+) -> PreTrainedModel:
+    shards = [f for f in download.filenames if f.endswith(".safetensors")]
+    if not shards:
+        # e.g. pytorch_model.bin checkpoints, which can't be read lazily
+        return AutoModelForCausalLM.from_pretrained(
+            download.wait(), torch_dtype=dtype
+        ).to(device)
+
+    start = time.time()
+    download.wait_for("config.json")
+    config = AutoConfig.from_pretrained(download.path)
+    with no_init_weights(), torch.device(device):
+        model = AutoModelForCausalLM.from_config(config, torch_dtype=dtype)
+    model.eval()
+    print(f"built model in {time.time() - start:.3f}s")
+
+    state_dict = model.state_dict()
+    missing = set(state_dict)
+    waited = 0.0
+    with torch.no_grad():
+        for shard in shards:
+            st = time.time()
+            path = download.wait_for(shard)
+            waited += time.time() - st
+            st = time.time()
+            tensors = load_shard(path)
+            for name, tensor in tensors.items():
+                if name not in state_dict:
+                    print(f"unexpected weight {name} in {shard}")
+                    continue
+                state_dict[name].copy_(tensor)
+                missing.discard(name)
+            del tensors
+            print(f"loaded {shard} in {time.time() - st:.3f}s")
+    download.wait()
+    model.tie_weights()
+    # tied weights (e.g. lm_head) and non-persistent buffers aren't in the checkpoint
+    missing = {
+        name
+        for name in missing
+        if not any(name.endswith(key) for key in model._tied_weights_keys or [])
+    }
+    if missing:
+        raise ValueError(f"weights missing from checkpoint: {sorted(missing)[:10]}")
+    print(
+        f"loaded weights in {time.time() - start:.3f}s, "
+        f"{waited:.3f}s of it waiting on the download"
+    )
+    return model
@@ -0,0 +1,74 @@
+import pytest
+import torch
+
+import sys
+
+sys.path.append(".")
+sys.path.append("llama_recipes")
+
+from policies.anyprecision_optimizer import AnyPrecisionAdamW
+
+
+def make_params(dtype, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    shapes = [(64, 32), (32,), (7, 3, 5), (1,)]
+    return [
+        torch.nn.Parameter(torch.randn(shape, generator=generator).to(dtype))
+        for shape in shapes
+    ]
+
+
+def run_steps(params, num_steps=5, **kwargs):
+    optimizer = AnyPrecisionAdamW(params, lr=1e-2, weight_decay=0.1, **kwargs)
+    generator = torch.Generator().manual_seed(1)
+    for _ in range(num_steps):
+        for p in params:
+            p.grad = torch.randn(p.shape, generator=generator).to(p.dtype)
+        optimizer.step()
+    return optimizer
+
+
+@pytest.mark.parametrize("use_kahan_summation", [False, True])
+@pytest.mark.parametrize("dtype", [torch.bfloat16, torch.float32])
+def test_foreach_step_matches_single_tensor_step(dtype, use_kahan_summation):
+    kwargs = dict(
+        use_kahan_summation=use_kahan_summation,
+        momentum_dtype=dtype,
+        variance_dtype=dtype,
+        compensation_buffer_dtype=dtype,
+    )
+    single, multi = make_params(dtype), make_params(dtype)
+    single_optimizer = run_steps(single, foreach=False, **kwargs)
+    multi_optimizer = run_steps(multi, foreach=True, **kwargs)
+
+    for p, q in zip(single, multi):
+        torch.testing.assert_close(p, q, rtol=0, atol=0)
+        for key, value in single_optimizer.state[p].items():
+            torch.testing.assert_close(value, multi_optimizer.state[q][key], rtol=0, atol=0)
+
+
+def test_kahan_scratch_buffer_is_reused():
+    params = make_params(torch.bfloat16)
+    optimizer = run_steps(params, num_steps=1, foreach=True, use_kahan_summation=True)
+    scratch = optimizer.kahan_scratch[(torch.device("cpu"), torch.bfloat16)]
+    optimizer.step()
+    assert optimizer.kahan_scratch[(torch.device("cpu"), torch.bfloat16)] is scratch
+
+
+@pytest.mark.parametrize("use_kahan_summation", [False, True])
+def test_fused_step_matches_single_tensor_step(use_kahan_summation):
+    # in float32, so the fused kernel's float32 intermediates round the same as the single tensor ops
+    kwargs = dict(
+        use_kahan_summation=use_kahan_summation,
+        momentum_dtype=torch.float32,
+        variance_dtype=torch.float32,
+        compensation_buffer_dtype=torch.float32,
+    )
+    single, fused = make_params(torch.float32), make_params(torch.float32)
+    single_optimizer = run_steps(single, foreach=False, **kwargs)
+    fused_optimizer = run_steps(fused, fused=True, **kwargs)
+
+    for p, q in zip(single, fused):
+        torch.testing.assert_close(p, q)
+        for key, value in single_optimizer.state[p].items():
+            torch.testing.assert_close(value, fused_optimizer.state[q][key])
@@ -0,0 +1,170 @@
+import os
+import threading
+
+import pytest
+import torch
+import torch.distributed as dist
+from peft import LoraConfig, get_peft_model
+from transformers import LlamaConfig, LlamaForCausalLM
+
+import sys
+
+sys.path.append(".")
+sys.path.append("llama_recipes")
+
+from configs import train_config
+from model_checkpointing import (
+    AsyncCheckpointWriter,
+    latest_training_state,
+    load_training_state,
+    save_peft_adapter,
+    save_training_state,
+    snapshot_state_dict,
+)
+from utils.train_utils import get_rng_state
+
+
+def test_writer_bounds_checkpoints_in_flight():
+    writer = AsyncCheckpointWriter(max_in_flight=2)
+    release = threading.Event()
+    written = []
+
+    def write(i):
+        release.wait()
+        written.append(i)
+
+    writer.submit(write, 0)
+    writer.submit(write, 1)
+    # a third checkpoint has to wait for the first write
+    third = threading.Thread(target=writer.submit, args=(write, 2))
+    third.start()
+    third.join(timeout=0.2)
+    assert third.is_alive()
+
+    release.set()
+    third.join()
+    writer.close()
+    assert written == [0, 1, 2]
+
+
+def test_writer_raises_failed_writes():
+    writer = AsyncCheckpointWriter()
+
+    def fail():
+        raise OSError("disk full")
+
+    writer.submit(fail)
+    with pytest.raises(OSError, match="disk full"):
+        writer.wait()
+    writer.close()
+
+
+def test_snapshot_is_unaffected_by_training():
+    param = torch.ones(4)
+    state = {"model": {"weight": param}, "optim": [{"step": torch.tensor(3.0), "lr": 0.1}]}
+    snapshot, _ = snapshot_state_dict(state)
+    param.add_(1)
+    state["optim"][0]["step"] += 1
+    assert torch.equal(snapshot["model"]["weight"], torch.ones(4))
+    assert snapshot["optim"][0]["step"].item() == 3.0
+    assert snapshot["optim"][0]["lr"] == 0.1
+
+
+def test_snapshot_of_sharded_tensor():
+    from torch.distributed._shard.metadata import ShardMetadata
+    from torch.distributed._shard.sharded_tensor import Shard, init_from_local_shards
+
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = "29523"
+    dist.init_process_group("gloo", rank=0, world_size=1)
+    try:
+        tensor = torch.arange(12.0).view(3, 4)
+        sharded = init_from_local_shards(
+            [Shard(tensor, ShardMetadata([0, 0], [3, 4], "rank:0/cpu"))], [3, 4]
+        )
+        writer = AsyncCheckpointWriter(distributed=True)
+        snapshot, _ = snapshot_state_dict({"weight": sharded}, writer.process_group)
+        tensor.zero_()
+        assert torch.equal(
+            snapshot["weight"].local_tensor(), torch.arange(12.0).view(3, 4)
+        )
+        writer.close()
+    finally:
+        dist.destroy_process_group()
+
+
+def test_save_peft_adapter_matches_save_pretrained(tmp_path):
+    config = LlamaConfig(
+        vocab_size=100,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+    )
+    torch.manual_seed(0)
+    model = get_peft_model(
+        LlamaForCausalLM(config),
+        LoraConfig(r=4, target_modules=["q_proj", "v_proj"], task_type="CAUSAL_LM"),
+    )
+    for name, param in model.named_parameters():
+        if "lora_B" in name:
+            torch.nn.init.normal_(param)
+
+    model.save_pretrained(tmp_path / "save_pretrained")
+    writer = AsyncCheckpointWriter()
+    save_peft_adapter(model, str(tmp_path / "adapter"), 0, writer)
+    writer.close()
+
+    expected = torch.load(tmp_path / "save_pretrained" / "adapter_model.bin")
+    saved = torch.load(tmp_path / "adapter" / "adapter_model.bin")
+    assert saved.keys() == expected.keys() and len(saved) == 8
+    for key in expected:
+        assert torch.equal(saved[key], expected[key])
+    assert (tmp_path / "adapter" / "adapter_config.json").read_text() == (
+        tmp_path / "save_pretrained" / "adapter_config.json"
+    ).read_text()
+
+
+def test_training_state_round_trip(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cfg = train_config()
+    cfg.enable_fsdp = False
+    cfg.use_peft = False
+    cfg.max_training_states = 2
+
+    def make():
+        torch.manual_seed(0)
+        model = torch.nn.Linear(4, 4)
+        return model, torch.optim.AdamW(model.parameters(), lr=0.1)
+
+    model, optimizer = make()
+    for num_steps in range(1, 4):
+        model(torch.ones(4)).sum().backward()
+        optimizer.step()
+        save_training_state(
+            model,
+            optimizer,
+            {
+                "epoch": 0,
+                "step": num_steps,
+                "optimizer_steps": num_steps,
+                "rng": get_rng_state(),
+            },
+            0,
+            cfg,
+        )
+    assert sorted(p.name for p in (tmp_path / cfg.training_state_dir).iterdir()) == [
+        "step-2",
+        "step-3",
+    ]
+    assert latest_training_state(cfg.training_state_dir).name == "step-3"
+
+    resumed_model, resumed_optimizer = make()
+    trainer_state = load_training_state(resumed_model, resumed_optimizer, 0, cfg)
+    assert trainer_state["step"] == 3
+    assert torch.equal(trainer_state["rng"]["torch"], torch.get_rng_state())
+    assert torch.equal(resumed_model.weight, model.weight)
+    assert torch.equal(
+        resumed_optimizer.state_dict()["state"][0]["exp_avg"],
+        optimizer.state_dict()["state"][0]["exp_avg"],
+    )
@@ -199,3 +199,60 @@ def test_tokenize_data_without_packing(formatted_dataset, tokenizer, dataset_con
     for i, example in enumerate(decoded_data):
         assert example.startswith("Write a response to the following message")
         assert example + tokenizer.eos_token == formatted_dataset[i]["text"]
+
+
+@pytest.mark.parametrize("extension", ["parquet", "arrow"])
+def test__load_data_columnar_formats(dataset_config, dataset, tmp_path, extension):
+    path = str(tmp_path / f"train.{extension}")
+    if extension == "parquet":
+        dataset.to_parquet(path)
+    else:
+        import pyarrow as pa
+
+        table = dataset.data.table
+        with pa.OSFile(path, "wb") as sink, pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+
+    dataset_config.data_path = path
+    try:
+        dataset_config.run_validation = True
+        train_dataset = load_data(dataset_config, split="train")
+        val_dataset = load_data(dataset_config, split="val")
+    finally:
+        dataset_config.data_path = "tests/data/200_samples.jsonl"
+    assert len(train_dataset) == 100 and len(val_dataset) == 100
+    assert train_dataset[0]["text"] == dataset[0]["text"]
+    assert val_dataset[0]["text"] == dataset[100]["text"]
+
+
+def test_tokenize_data_with_best_fit_packing(
+    formatted_dataset, tokenizer, dataset_config
+):
+    dataset_config.pack_sequences = True
+    dataset_config.best_fit_packing = True
+    dataset_config.chunk_size: int = 512
+
+    try:
+        tokenized_data = tokenize_data(formatted_dataset, tokenizer, dataset_config)
+    finally:
+        dataset_config.best_fit_packing = False
+
+    recovered_data = []
+    for tokenized_example in tokenized_data:
+        documents = tokenized_example["attention_mask"]
+        # examples longer than a chunk get a sequence to themselves
+        if max(documents) > 1:
+            assert len(documents) <= dataset_config.chunk_size
+        for document in range(1, max(documents) + 1):
+            input_ids = [
+                token
+                for token, d in zip(tokenized_example["input_ids"], documents)
+                if d == document
+            ]
+            recovered_data.append(tokenizer.decode(input_ids, skip_special_tokens=True))
+
+    assert len(tokenized_data) < len(formatted_dataset)
+    assert sorted(recovered_data) == sorted(
+        tokenizer.decode(tokenizer(example["text"])["input_ids"], skip_special_tokens=True)
+        for example in formatted_dataset
+    )
@@ -0,0 +1,79 @@
+import dataclasses
+import functools
+
+import pytest
+
+import sys
+
+sys.path.append(".")
+sys.path.append("llama_recipes")
+
+from configs.datasets import completion
+from utils import dataset_utils
+from utils.dataset_utils import get_dataset_cache_key, get_preprocessed_dataset
+
+
+@pytest.fixture(scope="session")
+def tokenizer():
+    from transformers import LlamaTokenizer
+
+    tokenizer = LlamaTokenizer.from_pretrained(
+        "tests/assets/llama_tokenizer", legacy=False
+    )
+    tokenizer.add_special_tokens({"pad_token": "<PAD>"})
+    return tokenizer
+
+
+@pytest.fixture
+def dataset_config():
+    return completion(
+        data_path="tests/data/200_samples.jsonl", run_validation=False, chunk_size=100
+    )
+
+
+def test_cache_key_follows_config(tokenizer, dataset_config):
+    key = get_dataset_cache_key(tokenizer, dataset_config, "train")
+    assert key == get_dataset_cache_key(tokenizer, dataset_config, "train")
+    # worker count doesn't change the result
+    assert key == get_dataset_cache_key(
+        tokenizer, dataclasses.replace(dataset_config, num_proc=4), "train"
+    )
+    assert key != get_dataset_cache_key(tokenizer, dataset_config, "val")
+    assert key != get_dataset_cache_key(
+        tokenizer, dataclasses.replace(dataset_config, chunk_size=200), "train"
+    )
+
+
+def test_cache_key_follows_data_contents_not_paths(tmp_path, tokenizer, dataset_config):
+    with open(dataset_config.data_path, "rb") as f:
+        data = f.read()
+    for name in ["a.jsonl", "b.jsonl", "c/train.jsonl", "d/train.jsonl"]:
+        (tmp_path / name).parent.mkdir(exist_ok=True)
+        (tmp_path / name).write_bytes(data)
+
+    def key(data_path):
+        return get_dataset_cache_key(
+            tokenizer, dataclasses.replace(dataset_config, data_path=str(data_path)), "train"
+        )
+
+    assert key(tmp_path / "a.jsonl") == key(tmp_path / "b.jsonl")
+    assert key(tmp_path / "c") == key(tmp_path / "d")
+    (tmp_path / "b.jsonl").write_bytes(data[:-10])
+    assert key(tmp_path / "a.jsonl") != key(tmp_path / "b.jsonl")
+
+
+def test_preprocessed_dataset_is_cached(tmp_path, monkeypatch, tokenizer, dataset_config):
+    cache_dir = str(tmp_path / "cache")
+    dataset = get_preprocessed_dataset(tokenizer, dataset_config, cache_dir=cache_dir)
+    assert len(list((tmp_path / "cache").iterdir())) == 1
+
+    builder = dataset_utils.DATASET_PREPROC["completion"]
+
+    @functools.wraps(builder)
+    def build(*args):
+        raise AssertionError("dataset should have come from the cache")
+
+    monkeypatch.setitem(dataset_utils.DATASET_PREPROC, "completion", build)
+    cached = get_preprocessed_dataset(tokenizer, dataset_config, cache_dir=cache_dir)
+    assert cached["input_ids"] == dataset["input_ids"]
+    assert cached["labels"] == dataset["labels"]
@@ -0,0 +1,181 @@
+import asyncio
+import base64
+import hashlib
+import mmap
+import os
+import threading
+
+import pytest
+from aiohttp import web
+
+import sys
+
+sys.path.append(".")
+
+import src.download
+from src.download import BackgroundDownload, ChecksumError, Downloader, content_md5
+
+CHUNK_SIZE = mmap.ALLOCATIONGRANULARITY
+DATA = os.urandom(CHUNK_SIZE * 4 + 123)
+
+
+class RangeServer:
+    """serves DATA with range support, optionally failing requests for some offsets"""
+
+    def __init__(self, etag=None):
+        self.etag = etag
+        self.md5_headers = {}
+        self.failing_starts = set()
+        self.requested_starts = []
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    async def handle(self, request):
+        headers = {"ETag": self.etag} if self.etag else {}
+        if request.method == "HEAD":
+            headers["Content-Length"] = str(len(DATA))
+            headers.update(self.md5_headers)
+            return web.Response(headers=headers)
+        start, end = map(int, request.headers["Range"].removeprefix("bytes=").split("-"))
+        self.requested_starts.append(start)
+        if start in self.failing_starts:
+            raise web.HTTPInternalServerError()
+        return web.Response(body=DATA[start : end + 1], status=206, headers=headers)
+
+    def start(self):
+        app = web.Application()
+        app.router.add_route("*", "/{name:.*}", self.handle)
+        self.runner = web.AppRunner(app)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+        return f"http://127.0.0.1:{self.port}"
+
+    async def _start(self):
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(src.download, "RESUMABLE_CHUNK_SIZE", CHUNK_SIZE)
+    server = RangeServer(etag=f'"{hashlib.md5(DATA).hexdigest()}"')
+    server.url = server.start()
+    yield server
+    server.stop()
+
+
+def test_resumable_download_only_fetches_missing_chunks(tmp_path, server):
+    path = str(tmp_path / "model.safetensors")
+    downloader = Downloader(concurrency=2)
+    server.failing_starts = {CHUNK_SIZE, CHUNK_SIZE * 3}
+
+    with pytest.raises(ValueError):
+        downloader.sync_download_file_resumable(f"{server.url}/model.safetensors", path)
+    assert not os.path.exists(path)
+    assert os.path.exists(path + ".partial") and os.path.exists(path + ".journal")
+
+    server.failing_starts = set()
+    server.requested_starts = []
+    downloader.sync_download_file_resumable(f"{server.url}/model.safetensors", path)
+    assert sorted(server.requested_starts) == [CHUNK_SIZE, CHUNK_SIZE * 3]
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+    assert not os.path.exists(path + ".partial")
+    assert not os.path.exists(path + ".journal")
+
+
+def test_resumable_download_restarts_when_etag_changes(tmp_path, server):
+    path = str(tmp_path / "model.safetensors")
+    downloader = Downloader(concurrency=2)
+    server.failing_starts = {0}
+    with pytest.raises(ValueError):
+        downloader.sync_download_file_resumable(f"{server.url}/model.safetensors", path)
+
+    server.etag = '"some-new-version-1"'
+    server.failing_starts = set()
+    server.requested_starts = []
+    downloader.sync_download_file_resumable(f"{server.url}/model.safetensors", path)
+    assert len(server.requested_starts) == 5
+
+
+def test_resumable_download_verifies_sha256(tmp_path, server):
+    path = str(tmp_path / "model.safetensors")
+    downloader = Downloader(concurrency=2)
+    url = f"{server.url}/model.safetensors"
+    with pytest.raises(ChecksumError):
+        downloader.sync_download_file_resumable(url, path, sha256="0" * 64)
+    # corrupt downloads aren't kept around to resume from
+    assert not os.listdir(tmp_path)
+
+    downloader.sync_download_file_resumable(
+        url, path, sha256=hashlib.sha256(DATA).hexdigest()
+    )
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+
+
+def test_resumable_download_ignores_etags_that_look_like_md5s(tmp_path, server):
+    # CDNs and encrypted objects send opaque 32 hex digit ETags that aren't the md5 of the content
+    server.etag = f'"{"0" * 32}"'
+    path = str(tmp_path / "model.safetensors")
+    Downloader(concurrency=2).sync_download_file_resumable(f"{server.url}/model.safetensors", path)
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+
+
+def test_resumable_download_verifies_content_md5(tmp_path, server):
+    path = str(tmp_path / "model.safetensors")
+    downloader = Downloader(concurrency=2)
+    url = f"{server.url}/model.safetensors"
+    server.md5_headers = {"Content-MD5": base64.b64encode(b"\0" * 16).decode()}
+    with pytest.raises(ChecksumError):
+        downloader.sync_download_file_resumable(url, path)
+    assert not os.listdir(tmp_path)
+
+    server.md5_headers = {
+        "x-goog-hash": f"crc32c=AAAAAA==,md5={base64.b64encode(hashlib.md5(DATA).digest()).decode()}"
+    }
+    downloader.sync_download_file_resumable(url, path)
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+
+
+def test_content_md5():
+    digest = hashlib.md5(b"abc").digest()
+    assert content_md5({"Content-MD5": base64.b64encode(digest).decode()}) == digest.hex()
+    assert content_md5({"x-goog-hash": "crc32c=n03x6A=="}) is None
+    assert content_md5({"ETag": f'"{digest.hex()}"'}) is None
+
+
+def test_download_files_to_disk_reports_stats(tmp_path, server):
+    downloader = Downloader(concurrency=2)
+    (tmp_path / "config.json").write_bytes(b"{}")
+    filenames = ["config.json", "model.safetensors", "params/params_shard_0.bin"]
+
+    stats = downloader.sync_maybe_download_files(
+        str(tmp_path), server.url, filenames, resumable=True
+    )
+    assert sorted(stats) == ["model.safetensors", "params/params_shard_0.bin"]
+    for name in stats:
+        assert stats[name]["downloaded"] == stats[name]["size"] == len(DATA)
+        assert stats[name]["elapsed"] is not None
+        with open(tmp_path / name, "rb") as f:
+            assert f.read() == DATA
+
+
+def test_background_download_thread_exits_when_done(tmp_path, server):
+    download = BackgroundDownload(
+        Downloader(concurrency=2), str(tmp_path), server.url, ["model.safetensors"]
+    )
+    with open(download.wait_for("model.safetensors"), "rb") as f:
+        assert f.read() == DATA
+    download.wait()
+    for thread in list(download.executor._threads):
+        thread.join(timeout=5)
+        assert not thread.is_alive()
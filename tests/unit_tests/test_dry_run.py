@@ -0,0 +1,91 @@
+import dataclasses
+import json
+import shutil
+
+import pytest
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+import sys
+
+sys.path.append(".")
+sys.path.append("llama_recipes")
+
+import configs
+from configs import datasets
+from llama_finetuning import main
+from utils.dry_run_utils import project_training_run
+
+
+@pytest.fixture
+def restore_configs():
+    # main updates the config classes in place
+    classes = [configs.train_config, configs.fsdp_config, configs.lora_config, datasets.completion]
+    saved = [dict(vars(cls)) for cls in classes]
+    yield
+    for cls, attributes in zip(classes, saved):
+        for field in dataclasses.fields(cls):
+            setattr(cls, field.name, attributes[field.name])
+
+
+def test_projection_scales_median_step_time():
+    report = project_training_run(
+        [1.0, 3.0, 2.0],
+        [300, 300, 300],
+        [400, 400, 400],
+        steps_per_epoch=900,
+        num_epochs=2,
+        world_size=4,
+        gpu_hourly_cost=2.0,
+    )
+    assert report["total_steps"] == 1800
+    assert report["projected_hours"] == pytest.approx(1.0)
+    assert report["projected_gpu_hours"] == pytest.approx(4.0)
+    assert report["projected_cost"] == pytest.approx(8.0)
+    assert report["tokens_per_sec"] == pytest.approx(150)
+    assert report["padding_efficiency"] == pytest.approx(0.75)
+
+
+def test_dry_run_of_a_tiny_llama_on_cpu(tmp_path, monkeypatch, restore_configs):
+    model_dir = tmp_path / "model"
+    shutil.copytree("tests/assets/llama_tokenizer", model_dir)
+    torch.manual_seed(0)
+    LlamaForCausalLM(
+        LlamaConfig(
+            vocab_size=32000,
+            hidden_size=32,
+            intermediate_size=64,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+        )
+    ).save_pretrained(model_dir)
+    data_path = str(tmp_path / "train.jsonl")
+    shutil.copy("tests/data/200_samples.jsonl", data_path)
+    monkeypatch.chdir(tmp_path)
+
+    report = main(
+        model_name=str(model_dir),
+        data_path=data_path,
+        use_peft=True,
+        peft_method="lora",
+        lora_rank=4,
+        pack_sequences=False,
+        batch_size_training=4,
+        gradient_accumulation_steps=2,
+        num_validation_samples=20,
+        num_workers_dataloader=0,
+        dataset_cache_dir=None,
+        num_epochs=3,
+        dry_run_steps=2,
+        dry_run_samples=90,
+        gpu_hourly_cost=1.0,
+    )
+
+    # 90 of the 180 training samples, in batches of 4 over 2 accumulation steps
+    assert report["data_fraction"] == 0.5
+    assert report["steps_per_epoch"] == 22
+    assert report["total_steps"] == 66
+    assert 0 < report["padding_efficiency"] < 1
+    assert report["tokens_per_sec"] > 0
+    assert report["projected_cost"] == pytest.approx(report["projected_gpu_hours"])
+    assert json.loads((tmp_path / "training_diagnostics" / "dry_run.json").read_text()) == report
@@ -0,0 +1,127 @@
+import io
+import zipfile
+
+import pytest
+import torch
+
+import sys
+
+sys.path.append(".")
+
+from src.lora_cache import ClockCache, LoRACache
+
+
+def make_archive(value: int) -> bytes:
+    weights = io.BytesIO()
+    torch.save({"lora_A": torch.full((25,), value, dtype=torch.float32)}, weights)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zip_ref:
+        zip_ref.writestr("adapter_config.json", b"{}")
+        zip_ref.writestr("adapter_model.bin", weights.getvalue())
+    return buffer.getvalue()
+
+
+class FakeDownloader:
+    def __init__(self, archives):
+        self.archives = archives
+
+    def sync_download_file(self, url):
+        return io.BytesIO(self.archives[url])
+
+
+class FakeEngine:
+    def __init__(self, can_offload=True):
+        self.can_offload = can_offload
+        self.loads = 0
+        self.restores = 0
+
+    def load_lora(self, data):
+        self.loads += 1
+        return ("gpu", data["adapter_model.bin"]["lora_A"])
+
+    def offload_lora(self, lora):
+        if not self.can_offload:
+            return None
+        return ("host", lora[1])
+
+    def restore_lora(self, offloaded):
+        self.restores += 1
+        return ("gpu", offloaded[1])
+
+
+def test_clock_cache_gives_referenced_entries_a_second_chance():
+    evicted = []
+    cache = ClockCache("test", 30, on_evict=lambda k, v: evicted.append(k))
+    cache.put("a", 1, 10)
+    cache.put("b", 2, 10)
+    cache.put("c", 3, 10)
+    assert cache.get("a") == 1
+
+    cache.put("d", 4, 10)
+    assert evicted == ["b"]
+    assert "a" in cache and "c" in cache and "d" in cache
+    assert cache.used_bytes == 30
+    assert cache.stats()["evictions"] == 1
+
+
+def test_clock_cache_rejects_oversized_entries():
+    evicted = []
+    cache = ClockCache("test", 10, on_evict=lambda k, v: evicted.append(k))
+    assert not cache.put("big", 1, 11)
+    assert evicted == ["big"]
+    assert len(cache) == 0
+
+
+@pytest.fixture
+def urls():
+    return {
+        f"https://example.com/lora-{i}.zip": make_archive(i)
+        for i in range(3)
+    }
+
+
+def test_lora_cache_downloads_once_and_reuses_tiers(tmp_path, urls):
+    engine = FakeEngine()
+    cache = LoRACache(
+        engine,
+        FakeDownloader(urls),
+        gpu_bytes=250,
+        host_bytes=1000,
+        disk_bytes=10_000,
+        disk_path=str(tmp_path),
+    )
+    first, second, third = urls
+
+    assert cache.get(first)[1][0] == 0
+    assert cache.get(first)[1][0] == 0
+    assert cache.downloads == 1 and engine.loads == 1
+    assert cache.gpu.hits == 1
+
+    cache.get(second)
+    cache.get(third)  # the first adapter was reused, so the second one is demoted
+    assert first in cache.gpu
+    assert second in cache.host
+
+    assert cache.get(second)[1][0] == 1
+    assert engine.restores == 1
+    assert cache.downloads == 3 and engine.loads == 3
+
+
+def test_lora_cache_falls_back_to_disk(tmp_path, urls):
+    engine = FakeEngine(can_offload=False)
+    downloader = FakeDownloader(urls)
+    kwargs = dict(gpu_bytes=150, host_bytes=0, disk_bytes=10_000)
+    cache = LoRACache(engine, downloader, disk_path=str(tmp_path), **kwargs)
+    first, second, _ = urls
+
+    cache.get(first)
+    cache.get(second)
+    cache.get(first)
+    assert cache.downloads == 2
+    assert cache.disk.hits == 1
+    assert engine.loads == 3
+
+    # archives survive a restart
+    restarted = LoRACache(engine, downloader, disk_path=str(tmp_path), **kwargs)
+    restarted.get(second)
+    assert restarted.downloads == 0
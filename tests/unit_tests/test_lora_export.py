@@ -0,0 +1,124 @@
+import json
+import zipfile
+
+import pytest
+import torch
+
+import sys
+
+sys.path.append(".")
+
+from src.lora_export import ZIP_ALIGNMENT, export_adapter, truncate_lora_rank
+from src.lora_loader import read_lora_archive
+
+RANK = 8
+ALPHA = 16
+PREFIX = "base_model.model.model.layers.0.self_attn"
+
+
+def low_rank_adapter(true_rank, seed=0):
+    """LoRA pairs of rank RANK whose updates only have true_rank significant directions"""
+    generator = torch.Generator().manual_seed(seed)
+    state_dict = {}
+    for module in ("q_proj", "v_proj"):
+        a = torch.randn(true_rank, 64, generator=generator)
+        b = torch.randn(48, true_rank, generator=generator)
+        mix = torch.randn(true_rank, RANK, generator=generator)
+        state_dict[f"{PREFIX}.{module}.lora_A.weight"] = mix.T @ a
+        state_dict[f"{PREFIX}.{module}.lora_B.weight"] = b @ torch.linalg.pinv(mix.T)
+    return state_dict
+
+
+def update(state_dict, module, rank):
+    a = state_dict[f"{PREFIX}.{module}.lora_A.weight"]
+    b = state_dict[f"{PREFIX}.{module}.lora_B.weight"]
+    return ALPHA / rank * (b.double() @ a.double())
+
+
+def write_adapter(path, state_dict):
+    path.mkdir()
+    (path / "adapter_config.json").write_text(
+        json.dumps({"r": RANK, "lora_alpha": ALPHA, "peft_type": "LORA"})
+    )
+    (path / "README.md").write_text("model card")
+    torch.save(state_dict, path / "adapter_model.bin")
+
+
+def test_truncation_keeps_the_update():
+    state_dict = low_rank_adapter(true_rank=3)
+    truncated, rank, retained = truncate_lora_rank(state_dict, RANK, 0.999)
+    assert rank == 3
+    assert min(retained.values()) > 0.999
+    for module in ("q_proj", "v_proj"):
+        assert truncated[f"{PREFIX}.{module}.lora_A.weight"].shape == (3, 64)
+        expected = update(state_dict, module, RANK)
+        torch.testing.assert_close(
+            update(truncated, module, rank),
+            expected,
+            rtol=1e-4,
+            atol=1e-5 * expected.abs().max(),
+        )
+
+
+def test_full_energy_keeps_the_rank():
+    state_dict = {
+        k: torch.randn(v.shape) for k, v in low_rank_adapter(true_rank=3).items()
+    }
+    _, rank, _ = truncate_lora_rank(state_dict, RANK, 1.0)
+    assert rank == RANK
+
+
+@pytest.mark.parametrize("dtype", ["float16", "bfloat16"])
+def test_export_is_an_aligned_stored_safetensors_zip(tmp_path, dtype):
+    state_dict = low_rank_adapter(true_rank=2)
+    write_adapter(tmp_path / "adapter", state_dict)
+    # anything else left next to the adapter isn't packaged
+    (tmp_path / "adapter" / "training_metrics.jsonl").write_text("{}")
+    (tmp_path / "adapter" / "logs").mkdir()
+    (tmp_path / "adapter" / "logs" / "memory_timeline.json").write_text("{}")
+    out_path = tmp_path / "training_output.zip"
+    manifest = export_adapter(
+        str(tmp_path / "adapter"), str(out_path), dtype=dtype, energy_threshold=0.999
+    )
+    assert manifest["rank"] == 2 and manifest["original_rank"] == RANK
+
+    with zipfile.ZipFile(out_path) as zip_ref:
+        infos = {info.filename: info for info in zip_ref.infolist()}
+        assert set(infos) == {
+            "manifest.json",
+            "adapter_config.json",
+            "README.md",
+            "adapter_model.safetensors",
+        }
+        assert all(info.compress_type == zipfile.ZIP_STORED for info in infos.values())
+        with open(out_path, "rb") as f:
+            for info in infos.values():
+                f.seek(info.header_offset + 26)
+                name_len = int.from_bytes(f.read(2), "little")
+                extra_len = int.from_bytes(f.read(2), "little")
+                assert (info.header_offset + 30 + name_len + extra_len) % ZIP_ALIGNMENT == 0
+
+    data = read_lora_archive(str(out_path))
+    assert json.loads(data["adapter_config.json"])["r"] == 2
+    assert json.loads(data["manifest.json"])["files"]["README.md"]["size"] == 10
+    exported = data["adapter_model.safetensors"]
+    assert all(v.dtype == getattr(torch, dtype) for v in exported.values())
+    for module in ("q_proj", "v_proj"):
+        expected = update(state_dict, module, RANK)
+        torch.testing.assert_close(
+            update(exported, module, 2),
+            expected,
+            rtol=0.02,
+            atol=0.02 * expected.abs().max(),
+        )
+
+
+def test_export_without_truncation(tmp_path):
+    state_dict = low_rank_adapter(true_rank=2)
+    write_adapter(tmp_path / "adapter", state_dict)
+    out_path = tmp_path / "training_output.zip"
+    manifest = export_adapter(str(tmp_path / "adapter"), str(out_path))
+    assert manifest["rank"] == RANK
+    exported = read_lora_archive(str(out_path))["adapter_model.safetensors"]
+    for k, v in state_dict.items():
+        assert torch.equal(exported[k], v.half())
@@ -0,0 +1,68 @@
+import io
+import zipfile
+
+import pytest
+import torch
+from safetensors.torch import save
+
+import sys
+
+sys.path.append(".")
+
+from src.lora_loader import read_lora_archive
+
+
+@pytest.fixture(scope="session")
+def state_dict():
+    return {
+        "base_model.model.layers.0.self_attn.q_proj.lora_A.weight": torch.randn(8, 64),
+        "base_model.model.layers.0.self_attn.q_proj.lora_B.weight": torch.randn(
+            64, 8
+        ).to(torch.bfloat16),
+    }
+
+
+def make_archive(path, name, payload, compression):
+    with zipfile.ZipFile(path, "w", compression=compression) as zip_ref:
+        zip_ref.writestr("adapter_config.json", b'{"r": 8}')
+        zip_ref.writestr(name, payload)
+
+
+def assert_equal(loaded, state_dict):
+    assert loaded.keys() == state_dict.keys()
+    for k, v in state_dict.items():
+        assert loaded[k].dtype == v.dtype
+        assert torch.equal(loaded[k], v)
+
+
+@pytest.mark.parametrize("compression", [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+def test_read_safetensors_archive(tmp_path, state_dict, compression):
+    path = tmp_path / "lora.zip"
+    make_archive(path, "adapter_model.safetensors", save(state_dict), compression)
+
+    data = read_lora_archive(str(path))
+    assert data["adapter_config.json"] == b'{"r": 8}'
+    assert_equal(data["adapter_model.safetensors"], state_dict)
+
+
+@pytest.mark.parametrize("compression", [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+def test_read_bin_archive(tmp_path, state_dict, compression):
+    weights = io.BytesIO()
+    torch.save(state_dict, weights)
+    path = tmp_path / "lora.zip"
+    make_archive(path, "adapter_model.bin", weights.getvalue(), compression)
+
+    with open(path, "rb") as f:
+        data = read_lora_archive(io.BytesIO(f.read()))
+    assert_equal(data["adapter_model.bin"], state_dict)
+
+
+def test_stored_safetensors_are_not_copied(state_dict):
+    buffer = io.BytesIO()
+    make_archive(buffer, "adapter_model.safetensors", save(state_dict), zipfile.ZIP_STORED)
+    archive = bytearray(buffer.getvalue())
+    start = torch.frombuffer(archive, dtype=torch.uint8).data_ptr()
+
+    data = read_lora_archive(archive)
+    for tensor in data["adapter_model.safetensors"].values():
+        assert start <= tensor.data_ptr() < start + len(archive)
@@ -0,0 +1,39 @@
+import csv
+import json
+
+import sys
+
+sys.path.append(".")
+sys.path.append("llama_recipes")
+
+from utils.memory_utils import MemoryTrace
+
+
+def test_memory_trace_samples_without_spinning(tmp_path):
+    path = tmp_path / "memory.csv"
+    with MemoryTrace(interval=0.01, timeline_path=str(path)) as memtrace:
+        # the monitor sleeps between samples, so this thread gets the GIL
+        while len(memtrace.samples) < 5:
+            pass
+        data = bytearray(256 * 2**20)
+        data[::4096] = b"x" * len(data[::4096])
+        del data
+
+    # the peak is caught even though no sample landed while the buffer was alive
+    assert memtrace.cpu_peak - memtrace.cpu_end >= 200 * 2**20
+    with open(path) as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == len(memtrace.samples) >= 5
+    assert float(rows[-1]["time_s"]) >= float(rows[0]["time_s"])
+    assert not memtrace.peak_monitor_thread.is_alive()
+
+
+def test_memory_trace_exports_chrome_trace(tmp_path):
+    path = tmp_path / "memory.json"
+    with MemoryTrace(interval=0.01, timeline_path=str(path)):
+        pass
+    with open(path) as f:
+        trace = json.load(f)
+    events = trace["traceEvents"]
+    assert events and all(event["ph"] == "C" for event in events)
+    assert set(events[0]["args"]) == {"cpu_rss", "cuda_allocated", "cuda_reserved"}
@@ -0,0 +1,176 @@
+import random
+
+import datasets
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM, LlamaTokenizer
+
+import sys
+
+sys.path.append(".")
+sys.path.append("llama_recipes")
+
+import llama_recipes.ft_datasets.utils as ft_utils
+from llama_recipes.ft_datasets.utils import (
+    ConcatDataset,
+    Concatenator,
+    best_fit_decreasing,
+    pack_best_fit,
+)
+from utils.packing_utils import DataCollatorForPackedSequences, enable_document_attention
+
+
+def make_batch(lengths, start=0):
+    input_ids = []
+    for length in lengths:
+        input_ids.append(list(range(start, start + length)))
+        start += length
+    return {
+        "input_ids": input_ids,
+        "attention_mask": [[1] * len(ids) for ids in input_ids],
+        "labels": [list(ids) for ids in input_ids],
+    }
+
+
+def test_concat_keeps_samples_whole():
+    concatenator = Concatenator(chunk_size=10)
+    packed = concatenator(make_batch([4, 5, 3, 12, 2])).to_pydict()
+    assert packed["input_ids"] == [list(range(0, 9)), list(range(9, 12)), list(range(12, 24))]
+    assert packed["labels"] == packed["input_ids"]
+    assert concatenator.residual["input_ids"].tolist() == [24, 25]
+
+    # the residual is packed with the start of the next batch
+    packed = concatenator(make_batch([8, 1], start=26)).to_pydict()
+    assert packed["input_ids"] == [list(range(24, 34))]
+    assert concatenator.residual["input_ids"].tolist() == [34]
+
+
+def test_wrap_concat_fills_chunks():
+    concatenator = Concatenator(chunk_size=4, wrap_packed_sequences=True)
+    packed = concatenator(make_batch([3, 3, 3])).to_pydict()
+    assert packed["input_ids"] == [[0, 1, 2, 3], [4, 5, 6, 7]]
+    assert packed["attention_mask"] == [[1] * 4] * 2
+    assert concatenator.residual["input_ids"].tolist() == [8]
+
+    # not enough for a chunk yet
+    assert concatenator(make_batch([2], start=9)).num_rows == 0
+    packed = concatenator(make_batch([1], start=11)).to_pydict()
+    assert packed["input_ids"] == [[8, 9, 10, 11]]
+
+
+def test_concat_dataset():
+    batch = make_batch([3, 5, 4])
+    samples = [{k: v[i] for k, v in batch.items()} for i in range(3)]
+    dataset = ConcatDataset(samples, chunk_size=4)
+    # the final, exactly full, chunk is dropped
+    assert len(dataset) == 2
+    assert dataset[1] == {
+        "input_ids": [4, 5, 6, 7],
+        "attention_mask": [1] * 4,
+        "labels": [4, 5, 6, 7],
+    }
+
+
+def test_best_fit_decreasing():
+    rng = random.Random(0)
+    lengths = [rng.randint(1, 100) for _ in range(1000)] + [150]
+    bins = best_fit_decreasing(lengths, 100)
+    assert sorted(idx for b in bins for idx in b) == list(range(len(lengths)))
+    assert [b for b in bins if sum(lengths[i] for i in b) > 100] == [[1000]]
+
+    greedy_bins, room = 0, 0
+    for length in lengths:
+        if length > room:
+            greedy_bins += 1
+            room = 100
+        room -= length
+    assert len(bins) < greedy_bins
+
+
+def test_pack_best_fit():
+    dataset = datasets.Dataset.from_dict(make_batch([6, 3, 5, 2, 4]))
+    packed = pack_best_fit(dataset, chunk_size=8)
+    assert len(packed) == 3
+    for sample in packed:
+        assert len(sample["input_ids"]) <= 8
+        documents = torch.tensor(sample["attention_mask"])
+        positions = torch.tensor(sample["position_ids"])
+        starts = torch.nonzero(positions == 0).flatten()
+        # each document restarts its positions, and its first token isn't predicted from the one before
+        assert documents[starts].tolist() == list(range(1, len(starts) + 1))
+        assert all(sample["labels"][i] == -100 for i in starts)
+        for i in range(len(positions)):
+            if i not in starts:
+                assert sample["labels"][i] == sample["input_ids"][i]
+    tokens = sorted(t for sample in packed for t in sample["input_ids"])
+    assert tokens == list(range(20))
+
+
+def test_pack_best_fit_reads_in_slices(tmp_path, monkeypatch):
+    rng = random.Random(0)
+    dataset = datasets.Dataset.from_dict(make_batch([rng.randint(1, 8) for _ in range(50)]))
+    expected = pack_best_fit(dataset, chunk_size=8).to_dict()
+
+    # from memory-mapped files, through an indices mapping, a few samples and sequences at a time
+    dataset.save_to_disk(str(tmp_path / "dataset"))
+    on_disk = datasets.load_from_disk(str(tmp_path / "dataset")).shuffle(seed=0)
+    on_disk = on_disk.select(sorted(range(len(on_disk)), key=lambda i: on_disk[i]["input_ids"][0]))
+    monkeypatch.setattr(ft_utils, "SAMPLES_PER_SLICE", 7)
+    monkeypatch.setattr(ft_utils, "PACKED_SEQUENCES_PER_TABLE", 3)
+    packed = pack_best_fit(on_disk, chunk_size=8)
+    assert packed.cache_files
+    assert packed.to_dict() == expected
+
+
+def test_pack_best_fit_counts_documents_past_int8():
+    batch = make_batch([4] * 400)
+    features = datasets.Features(
+        {
+            "input_ids": datasets.Sequence(datasets.Value("int32")),
+            "attention_mask": datasets.Sequence(datasets.Value("int8")),
+            "labels": datasets.Sequence(datasets.Value("int32")),
+        }
+    )
+    packed = pack_best_fit(datasets.Dataset.from_dict(batch, features=features), chunk_size=2048)
+    assert len(packed) == 1
+    documents = packed[0]["attention_mask"]
+    assert documents == [i // 4 + 1 for i in range(1600)]
+
+
+def test_document_attention_matches_separate_documents():
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=32001,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+    )
+    model = LlamaForCausalLM(config).eval()
+    enable_document_attention(model)
+    tokenizer = LlamaTokenizer.from_pretrained("tests/assets/llama_tokenizer", legacy=False)
+    tokenizer.add_special_tokens({"pad_token": "<PAD>"})
+
+    documents = [[5, 6, 7, 8], [9, 10, 11], [12, 13]]
+    features = [
+        {
+            "input_ids": documents[0] + documents[1],
+            "attention_mask": [1] * 4 + [2] * 3,
+            "labels": documents[0] + [-100] + documents[1][1:],
+            "position_ids": [0, 1, 2, 3, 0, 1, 2],
+        },
+        {
+            "input_ids": documents[2],
+            "attention_mask": [1] * 2,
+            "labels": [-100] + documents[2][1:],
+            "position_ids": [0, 1],
+        },
+    ]
+    batch = DataCollatorForPackedSequences(tokenizer=tokenizer, padding="longest")(features)
+    assert batch["position_ids"].tolist() == [[0, 1, 2, 3, 0, 1, 2], [0, 1, 0, 0, 0, 0, 0]]
+
+    with torch.no_grad():
+        packed_logits = model(**batch).logits
+        separate_logits = [model(torch.tensor([document])).logits[0] for document in documents]
+    torch.testing.assert_close(packed_logits[0, :4], separate_logits[0])
+    torch.testing.assert_close(packed_logits[0, 4:], separate_logits[1])
+    torch.testing.assert_close(packed_logits[1, :2], separate_logits[2])
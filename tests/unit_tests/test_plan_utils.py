@@ -0,0 +1,100 @@
+import pytest
+import torch
+from torch.distributed.algorithms._checkpoint.checkpoint_wrapper import CheckpointWrapper
+from peft import LoraConfig, get_peft_model
+from transformers import LlamaConfig, LlamaForCausalLM
+
+import sys
+
+sys.path.append(".")
+sys.path.append("llama_recipes")
+
+from policies import apply_fsdp_checkpointing
+from utils.plan_utils import (
+    decoder_layer_activation_bytes,
+    estimate_training_memory,
+    measure_saved_bytes,
+    plan_batch_size,
+)
+
+
+def make_config(num_hidden_layers):
+    return LlamaConfig(
+        vocab_size=500,
+        hidden_size=128,
+        intermediate_size=344,
+        num_hidden_layers=num_hidden_layers,
+        num_attention_heads=4,
+    )
+
+
+def saved_bytes(num_hidden_layers, lora_kwargs):
+    torch.manual_seed(0)
+    model = LlamaForCausalLM(make_config(num_hidden_layers)).to(torch.bfloat16)
+    if lora_kwargs:
+        model = get_peft_model(
+            model,
+            LoraConfig(
+                r=lora_kwargs["lora_r"],
+                target_modules=lora_kwargs["lora_target_modules"],
+                lora_dropout=lora_kwargs["lora_dropout"],
+                task_type="CAUSAL_LM",
+            ),
+        ).to(torch.bfloat16)
+    input_ids = torch.randint(0, 500, (2, 96))
+    _, saved = measure_saved_bytes(
+        lambda: model(input_ids=input_ids, labels=input_ids).loss,
+        exclude=list(model.parameters()),
+    )
+    return saved
+
+
+@pytest.mark.parametrize(
+    "lora_kwargs",
+    [
+        {},
+        dict(lora_r=8, lora_target_modules=["q_proj", "v_proj"], lora_dropout=0.05),
+        dict(
+            lora_r=4,
+            lora_target_modules=["q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj"],
+            lora_dropout=0.0,
+        ),
+    ],
+)
+def test_layer_activations_match_what_autograd_saves(lora_kwargs):
+    # the difference between two layers and one is what a decoder layer saves
+    measured = saved_bytes(2, lora_kwargs) - saved_bytes(1, lora_kwargs)
+    estimated = decoder_layer_activation_bytes(make_config(1), 2, 96, **lora_kwargs)
+    assert estimated == pytest.approx(measured, rel=0.05)
+
+
+def test_plan_prefers_largest_micro_batch_then_fewest_checkpointed_layers():
+    config = make_config(8)
+    kwargs = dict(lora_r=8, lora_target_modules=["q_proj", "v_proj"])
+    # too little for a micro-batch of 8 even with every layer checkpointed
+    budget = estimate_training_memory(config, 8, 512, checkpointed_layers=8, **kwargs) - 1
+    plan = plan_batch_size(config, 512, global_batch_size=8, budget_bytes=budget, **kwargs)
+    assert (plan.batch_size, plan.gradient_accumulation_steps) == (4, 2)
+    assert 0 < plan.checkpointed_layers < 8
+    assert plan.estimated_bytes <= budget
+    assert (
+        estimate_training_memory(config, 4, 512, plan.checkpointed_layers - 1, **kwargs)
+        > budget
+    )
+
+    plan = plan_batch_size(config, 512, global_batch_size=8, budget_bytes=budget * 10, **kwargs)
+    assert (plan.batch_size, plan.gradient_accumulation_steps, plan.checkpointed_layers) == (8, 1, 0)
+
+    with pytest.raises(ValueError):
+        plan_batch_size(config, 512, global_batch_size=8, budget_bytes=1, **kwargs)
+
+
+def test_checkpointing_is_applied_to_evenly_spread_layers():
+    model = LlamaForCausalLM(make_config(4))
+    apply_fsdp_checkpointing(model, 2)
+    assert [isinstance(layer, CheckpointWrapper) for layer in model.model.layers] == [
+        True,
+        False,
+        True,
+        False,
+    ]
@@ -0,0 +1,70 @@
+import numpy as np
+
+import sys
+
+sys.path.append(".")
+sys.path.append("llama_recipes")
+
+from utils.sampler_utils import LengthGroupedBatchSampler, ResumableBatchSampler
+
+LENGTHS = np.random.default_rng(0).integers(10, 2000, 1000)
+
+
+def test_batches_cover_dataset_and_cut_padding():
+    sampler = LengthGroupedBatchSampler(LENGTHS, batch_size=8)
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == 125
+    assert sorted(i for batch in batches for i in batch) == list(range(1000))
+    assert sampler.padding_ratio() < sampler.random_padding_ratio() / 4
+    # the longest sample comes first
+    assert LENGTHS.argmax() in batches[0]
+
+
+def test_shuffles_deterministically_per_epoch():
+    sampler = LengthGroupedBatchSampler(LENGTHS, batch_size=8, seed=1)
+    other = LengthGroupedBatchSampler(LENGTHS, batch_size=8, seed=1)
+    first_epoch = list(sampler)
+    assert first_epoch == list(other)
+    sampler.set_epoch(1)
+    assert list(sampler) != first_epoch
+    other.set_epoch(1)
+    assert list(sampler) == list(other)
+
+
+def test_ranks_split_every_group():
+    samplers = [
+        LengthGroupedBatchSampler(LENGTHS, batch_size=8, num_replicas=3, rank=rank)
+        for rank in range(3)
+    ]
+    epochs = [list(sampler) for sampler in samplers]
+    assert len(set(map(len, epochs))) == 1
+    seen = [i for batches in epochs for batch in batches for i in batch]
+    assert len(seen) == len(set(seen))
+    # ranks step through batches of similar lengths
+    for batches in zip(*epochs):
+        maxima = [LENGTHS[batch].max() for batch in batches]
+        assert max(maxima) - min(maxima) < 200
+
+
+def test_token_budget():
+    sampler = LengthGroupedBatchSampler(LENGTHS, batch_size=8, max_tokens=4096)
+    batches = list(sampler)
+    assert sorted(i for batch in batches for i in batch) == list(range(1000))
+    for batch in batches:
+        assert len(batch) * LENGTHS[batch].max() <= 4096
+    assert len({len(batch) for batch in batches}) > 1
+
+
+def test_resumable_batch_sampler_skips_batches_once():
+    sampler = ResumableBatchSampler(
+        LengthGroupedBatchSampler(np.arange(1, 41), batch_size=4, seed=0)
+    )
+    batches = list(sampler)
+    sampler.skip(3)
+    assert list(sampler) == batches[3:]
+    # only the epoch being resumed starts part way through
+    assert list(sampler) == batches
+    assert len(sampler) == len(batches)
+
+    sampler.set_epoch(1)
+    assert sampler.epoch == 1 and list(sampler) != batches
@@ -0,0 +1,92 @@
+import contextlib
+
+import pytest
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+import sys
+
+sys.path.append(".")
+sys.path.append("llama_recipes")
+
+from configs import train_config
+from utils.train_utils import (
+    get_max_eval_batches,
+    get_diagnostics_path,
+    gradient_sync_context,
+    token_loss_and_accuracy,
+)
+
+
+class NoSyncModel(torch.nn.Linear):
+    def __init__(self):
+        super().__init__(2, 2)
+        self.skipped_syncs = 0
+
+    @contextlib.contextmanager
+    def no_sync(self):
+        self.skipped_syncs += 1
+        yield
+
+
+def test_gradient_sync_context_only_skips_non_boundary_steps():
+    model = NoSyncModel()
+    for step in range(8):
+        with gradient_sync_context(model, sync=(step + 1) % 4 == 0):
+            model(torch.ones(2)).sum().backward()
+    assert model.skipped_syncs == 6
+
+    # models that aren't distributed don't have anything to skip
+    with gradient_sync_context(torch.nn.Linear(2, 2), sync=False):
+        pass
+
+
+def test_token_loss_and_accuracy_weights_batches_by_tokens():
+    config = LlamaConfig(
+        vocab_size=50,
+        hidden_size=16,
+        intermediate_size=32,
+        num_hidden_layers=1,
+        num_attention_heads=2,
+    )
+    torch.manual_seed(0)
+    model = LlamaForCausalLM(config).eval()
+    input_ids = torch.randint(0, 50, (2, 6))
+    labels = input_ids.clone()
+    labels[0, :4] = -100
+
+    with torch.no_grad():
+        outputs = model(input_ids=input_ids, labels=labels)
+    loss_sum, tokens, correct = token_loss_and_accuracy(
+        outputs.logits, labels, outputs.loss
+    ).tolist()
+
+    log_probs = outputs.logits[:, :-1].log_softmax(-1)
+    targets = labels[:, 1:]
+    mask = targets != -100
+    token_losses = -log_probs.gather(-1, targets.clamp(min=0)[..., None])[..., 0]
+    assert tokens == mask.sum() == 7
+    assert loss_sum == pytest.approx(token_losses[mask].sum().item(), rel=1e-5)
+    predictions = outputs.logits[:, :-1].argmax(-1)
+    assert correct == ((predictions == targets) & mask).sum()
+
+
+def test_max_eval_batches_covers_eval_samples_across_ranks():
+    cfg = train_config()
+    cfg.val_batch_size = 4
+    assert get_max_eval_batches(cfg, world_size=2) is None
+    cfg.eval_samples = 20
+    assert get_max_eval_batches(cfg, world_size=2) == 3
+    assert get_max_eval_batches(cfg) == 5
+
+
+def test_diagnostics_paths_are_relative_to_diagnostics_dir(tmp_path):
+    cfg = train_config()
+    cfg.output_dir = str(tmp_path / "out")
+    cfg.diagnostics_dir = str(tmp_path / "diagnostics")
+    assert get_diagnostics_path(cfg, "metrics.jsonl") == str(tmp_path / "diagnostics" / "metrics.jsonl")
+    assert (tmp_path / "diagnostics").is_dir()
+    # nothing but the model goes into output_dir
+    assert not (tmp_path / "out").exists()
+    assert get_diagnostics_path(cfg, "/abs/metrics.jsonl") == "/abs/metrics.jsonl"
+    assert get_diagnostics_path(cfg, None) is None
@@ -0,0 +1,38 @@
+import json
+
+import pytest
+import torch
+
+import sys
+
+sys.path.append(".")
+sys.path.append("llama_recipes")
+
+from utils.metrics_utils import TrainingMetrics
+
+
+def test_metrics_are_reported_one_interval_late(tmp_path):
+    path = tmp_path / "metrics.jsonl"
+    metrics = TrainingMetrics(
+        "cpu", log_every=2, path=str(path), flops_per_token=10, peak_flops=1e6
+    )
+    batch = {
+        "input_ids": torch.zeros((2, 4), dtype=torch.long),
+        "attention_mask": torch.tensor([[1, 1, 1, 1], [1, 1, 0, 0]]),
+    }
+    metrics.start_epoch(0)
+    for loss in [1.0, 2.0, 3.0]:
+        metrics.update(torch.tensor(loss), batch)
+    # the first interval is only read back at the next flush
+    assert not path.exists()
+    metrics.update(torch.tensor(4.0), batch)
+    metrics.close()
+
+    reports = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [report["step"] for report in reports] == [2, 4]
+    assert [report["loss"] for report in reports] == [1.5, 3.5]
+    for report in reports:
+        assert report["padding_fraction"] == 0.25
+        assert report["tokens_per_sec"] == pytest.approx(3 * report["samples_per_sec"])
+        assert report["step_time_p50"] <= report["step_time_p99"]
+        assert report["mfu"] > 0
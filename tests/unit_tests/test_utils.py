@@ -4,7 +4,7 @@ import sys
 
 sys.path.append(".")
 
-from src.src.utils import StreamingTextStopSequenceHandler
+from src.utils import StreamingTextStopSequenceHandler
 
 
 @pytest.fixture(scope="session")
@@ -255,3 +255,67 @@ def test_substring_stop_sequence(tokenizer):
     assert (
         "".join(output) == " 5"
     )  # All tokens are yielded since no stop sequence was provided
+
+
+def run_handler(stop_sequences, tokens, eos_token="</s>"):
+    stop_sequence_handler = StreamingTextStopSequenceHandler(
+        stop_sequences, eos_token=eos_token
+    )
+    output = []
+    for token in tokens:
+        yielded_text = None
+        for yielded_text in stop_sequence_handler(token):
+            if yielded_text == eos_token:
+                break
+            output.append(yielded_text)
+        if yielded_text == eos_token:
+            break
+    output.extend(stop_sequence_handler.finalize())
+    return output
+
+
+def test_partial_match_in_the_middle_is_released():
+    # "<" then "en" looked like the start of "<end>", but "<ent" can't be, so it's all yielded right away
+    output = run_handler(["<end>"], ["a ", "<", "en", "t b"])
+    assert output == ["a ", "<ent b"]
+
+
+def test_overlapping_stop_sequences():
+    assert "".join(run_handler(["aab"], ["a", "a", "a", "b", "c"])) == "a"
+    assert "".join(run_handler(["abcd", "bc"], ["xab", "cd"])) == "xa"
+
+
+def test_stop_sequence_inside_one_token():
+    assert run_handler(["###"], ["hello ### world"]) == ["hello "]
+
+
+def test_many_stop_sequences():
+    stop_sequences = [f"<stop{i}>" for i in range(1000)]
+    tokens = list("some text <stop1 <stop999> more")
+    assert "".join(run_handler(stop_sequences, tokens)) == "some text <stop1 "
+
+
+def test_incremental_detokenizer_matches_full_decode(tokenizer):
+    from src.utils import IncrementalDetokenizer
+
+    prompt_ids = tokenizer.encode("[INST] Say something [/INST]")
+    response = " Sure! 🦙 Llamas 你好 are\n\n  great 👍🏽, aren't they?"
+    response_ids = tokenizer.encode(response, add_special_tokens=False)
+
+    detokenizer = IncrementalDetokenizer(tokenizer.decode, prompt_ids)
+    chunks = [detokenizer(token_id) for token_id in response_ids]
+    chunks.append(detokenizer.flush())
+
+    full_text = tokenizer.decode(prompt_ids + response_ids)
+    assert "".join(chunks) == full_text[len(tokenizer.decode(prompt_ids)) :]
+    assert not any("�" in chunk for chunk in chunks)
+    # the window stays small no matter how long the generation gets
+    assert len(detokenizer.ids) <= 2 * detokenizer.context_tokens
+
+
+def test_truncate_at_stop_sequences():
+    from src.utils import truncate_at_stop_sequences
+
+    assert truncate_at_stop_sequences("a ### b <end> c", ["<end>", "###"]) == "a "
+    assert truncate_at_stop_sequences("no stops here", ["<end>"]) == "no stops here"
+    assert truncate_at_stop_sequences("no stops here", None) == "no stops here"
@@ -0,0 +1,68 @@
+import asyncio
+import threading
+
+import pytest
+import torch
+from aiohttp import web
+from transformers import LlamaConfig, LlamaForCausalLM
+
+import sys
+
+sys.path.append(".")
+
+from src.download import Downloader
+from src.weights_loader import load_model_streaming
+
+
+@pytest.fixture(scope="module")
+def checkpoint(tmp_path_factory):
+    path = tmp_path_factory.mktemp("remote")
+    config = LlamaConfig(
+        vocab_size=128,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+    )
+    torch.manual_seed(0)
+    model = LlamaForCausalLM(config).to(torch.bfloat16)
+    model.save_pretrained(path, safe_serialization=True, max_shard_size="20KB")
+    return path, model
+
+
+@pytest.fixture(scope="module")
+def server(checkpoint):
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    app = web.Application()
+    app.router.add_static("/", checkpoint[0])
+    runner = web.AppRunner(app)
+
+    async def start():
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        return site._server.sockets[0].getsockname()[1]
+
+    port = asyncio.run_coroutine_threadsafe(start(), loop).result()
+    yield f"http://127.0.0.1:{port}"
+    asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+
+
+def test_load_model_streaming_matches_checkpoint(tmp_path, checkpoint, server):
+    remote_path, model = checkpoint
+    filenames = sorted(
+        (f.name for f in remote_path.iterdir()),
+        key=lambda f: f.endswith(".safetensors"),
+    )
+    assert sum(f.endswith(".safetensors") for f in filenames) > 1
+
+    download = Downloader(concurrency=2).start_background_download(
+        str(tmp_path), server, filenames
+    )
+    loaded = load_model_streaming(download, device="cpu", dtype=torch.bfloat16)
+
+    expected = model.state_dict()
+    for name, tensor in loaded.state_dict().items():
+        assert torch.equal(tensor, expected[name]), name
@@ -1,8 +1,10 @@
 import argparse
 import asyncio
+import hashlib
 import os
 import shutil
 import subprocess
+from typing import Optional
 from zipfile import ZipFile
 import psutil
 
@@ -17,6 +19,7 @@ from config import (
     MODEL_NAME,
 )
 
+from src.lora_export import EXPORT_DTYPES, export_adapter
 from src.utils import maybe_download_with_pget, download_file_with_pget
 
 
@@ -24,10 +27,30 @@ MODEL_OUT = "/src/tuned_weights.tensors"
 CHECKPOINT_DIR = "checkpoints"
 SAVE_STRATEGY = "epoch"
 OUTPUT_DIR = "training_output"
+# training metrics, memory timelines and dry run reports, kept out of OUTPUT_DIR so they aren't packaged with the weights
+DIAGNOSTICS_DIR = "training_diagnostics"
+# states to resume interrupted trainings from, in a directory per run keyed on its data and arguments
+TRAINING_STATE_DIR = "training_state"
 
 
 class TrainingOutput(BaseModel):
     weights: Path
+    diagnostics: Optional[Path] = None
+
+
+def get_run_key(args: list[str]) -> str:
+    """hash of the training arguments, with the contents of the data files rather than their paths"""
+    h = hashlib.sha256()
+    for arg in args:
+        name, _, value = arg.partition("=")
+        if name in ("--data_path", "--validation_data_path") and os.path.isfile(value):
+            data_hash = hashlib.sha256()
+            with open(value, "rb") as f:
+                while block := f.read(1 << 23):
+                    data_hash.update(block)
+            arg = f"{name}={data_hash.hexdigest()}"
+        h.update(arg.encode() + b"\0")
+    return h.hexdigest()[:16]
 
 
 def train(
@@ -50,6 +73,10 @@ def train(
         default=1,
         ge=1,
     ),
+    auto_batch_size: bool = Input(
+        description="If 'True', split each train_batch_size * gradient_accumulation_steps batch into the largest micro-batches estimated to fit in GPU memory, and only checkpoint activations of as many layers as needed.",
+        default=False,
+    ),
     num_validation_samples: int = Input(
         description=(
             "Number of samples to use for validation."
@@ -85,6 +112,14 @@ def train(
         description="If 'pack_sequences' is 'True', this will wrap packed sequences across examples, ensuring a constant sequence length but breaking prompt formatting.",
         default=False,
     ),
+    best_fit_packing: bool = Input(
+        description="If 'pack_sequences' is 'True', this will pack whole examples into as few sequences as possible, and keep each example from attending to the others in its sequence. Overrides 'wrap_packed_sequences'.",
+        default=False,
+    ),
+    group_by_length: bool = Input(
+        description="If 'pack_sequences' is 'False', this will batch examples of similar length together, which reduces padding.",
+        default=False,
+    ),
     chunk_size: int = Input(
         description="If 'pack_sequences' is 'True', this will chunk sequences into chunks of this size.",
         default=2048,
@@ -126,6 +161,41 @@ def train(
     lora_dropout: float = Input(
         description="Dropout for lora training", default=0.05, ge=0.0, le=1.0
     ),
+    adapter_dtype: str = Input(
+        description="dtype the trained LoRA weights are exported in.",
+        default="float16",
+        choices=list(EXPORT_DTYPES),
+    ),
+    lora_energy_threshold: float = Input(
+        description="If set, lower the exported LoRA's rank to the smallest one keeping this fraction of each layer's update (sum of squared singular values), e.g. 0.99. Leave blank to keep lora_rank.",
+        default=None,
+        gt=0.0,
+        le=1.0,
+    ),
+    save_state_every_n_steps: int = Input(
+        description="If set, save the LoRA, optimizer, scheduler and data position every this many optimizer steps, so an interrupted training can pick up from there with 'resume_from_training_state'.",
+        default=None,
+        ge=1,
+    ),
+    resume_from_training_state: bool = Input(
+        description="If 'True', resume from the latest state saved by an interrupted training with the same data and settings, if there is one.",
+        default=False,
+    ),
+    dry_run_steps: int = Input(
+        description="If set, don't train: profile this many steps on a sample of train_data and return a JSON report of the throughput, padding efficiency and projected training time instead of weights.",
+        default=None,
+        ge=1,
+    ),
+    dry_run_samples: int = Input(
+        description="Number of samples of train_data a dry run tokenizes and profiles.",
+        default=1000,
+        ge=1,
+    ),
+    gpu_hourly_cost: float = Input(
+        description="Cost of one GPU hour, to project the cost of training in a dry run.",
+        default=None,
+        ge=0.0,
+    ),
     # lora_target_modules: str = Input(description="Comma-separated list of lora modules to target, i.e. 'q_proj,v_proj'. Leave blank for default.", default="q_proj,v_proj")
 ) -> TrainingOutput:
     if fake_output:
@@ -155,9 +225,7 @@ def train(
     root_path = os.getcwd()
 
     output_dir = OUTPUT_DIR
-    if os.path.exists(output_dir):
-        shutil.rmtree(output_dir)
-    os.makedirs(output_dir)
+    diagnostics_dir = DIAGNOSTICS_DIR
 
     num_gpus = torch.cuda.device_count()
 
@@ -198,16 +266,20 @@ def train(
             f"--model_name={model_path}",
             "--pure_bf16",
             f"--output_dir={output_dir}",
+            f"--diagnostics_dir={diagnostics_dir}",
             # User specified arguments -----
             # Preprocessing arguments
             f"--pack_sequences={pack_sequences}",
             f"--wrap_packed_sequences={wrap_packed_sequences}",
+            f"--best_fit_packing={best_fit_packing}",
+            f"--group_by_length={group_by_length}",
             f"--chunk_size={chunk_size}",
             # Train arguments
             f"--data_path={train_data}",
             f"--num_epochs={num_train_epochs}",
             f"--batch_size_training={train_batch_size}",
             f"--gradient_accumulation_steps={gradient_accumulation_steps}",
+            f"--auto_batch_size={auto_batch_size}",
             f"--lr={learning_rate}",
             f"--lora_rank={lora_rank}",
             f"--lora_alpha={lora_alpha}",
@@ -224,6 +296,45 @@ def train(
         ]
     )
 
+    # written to diagnostics_dir
+    dry_run_file = "dry_run.json"
+    if dry_run_steps:
+        args.extend(
+            [
+                f"--dry_run_steps={dry_run_steps}",
+                f"--dry_run_samples={dry_run_samples}",
+                f"--dry_run_file={dry_run_file}",
+            ]
+        )
+        if gpu_hourly_cost is not None:
+            args.append(f"--gpu_hourly_cost={gpu_hourly_cost}")
+
+    # only an interrupted run with the same data and arguments can be resumed, and other runs' states are dropped.
+    # Dry runs don't train, so they leave them alone
+    training_state_dir = os.path.join(TRAINING_STATE_DIR, get_run_key(args))
+    resuming = False
+    if not dry_run_steps:
+        resuming = resume_from_training_state and os.path.isdir(training_state_dir)
+        if os.path.isdir(TRAINING_STATE_DIR):
+            for name in os.listdir(TRAINING_STATE_DIR):
+                path = os.path.join(TRAINING_STATE_DIR, name)
+                if path != training_state_dir or not resuming:
+                    shutil.rmtree(path)
+        args.extend(
+            [
+                f"--training_state_dir={training_state_dir}",
+                f"--resume_from_training_state={resuming}",
+            ]
+        )
+        if save_state_every_n_steps:
+            args.append(f"--save_state_every_n_steps={save_state_every_n_steps}")
+
+    # a resumed run carries on the diagnostics of the run it resumes
+    for directory in (output_dir, diagnostics_dir):
+        if os.path.exists(directory) and not (resuming and directory == diagnostics_dir):
+            shutil.rmtree(directory)
+        os.makedirs(directory, exist_ok=True)
+
     print(f"Train.py Arguments: \n{args}")
 
     p = None
@@ -235,15 +346,42 @@ def train(
             raise Exception(
                 f"Training failed with exit code {return_code}! Check logs for details"
             )
+        if dry_run_steps:
+            return TrainingOutput(weights=Path(os.path.join(diagnostics_dir, dry_run_file)))
+        # the run is over, so there's nothing left to resume
+        shutil.rmtree(training_state_dir, ignore_errors=True)
+
         out_path = "training_output.zip"
 
         directory = Path(output_dir)
-        with ZipFile(out_path, "w") as zip:
-            for file_path in directory.rglob("*"):
-                print(file_path)
-                zip.write(file_path, arcname=file_path.relative_to(directory))
+        if (directory / "adapter_config.json").exists():
+            manifest = export_adapter(
+                output_dir,
+                out_path,
+                dtype=adapter_dtype,
+                energy_threshold=lora_energy_threshold,
+            )
+            print(
+                f"Exported LoRA with rank {manifest['rank']} (trained with {manifest['original_rank']}) "
+                f"as {adapter_dtype} safetensors: {os.path.getsize(out_path) / 2**20:.1f} MB"
+            )
+        else:
+            with ZipFile(out_path, "w") as zip:
+                for file_path in directory.rglob("*"):
+                    print(file_path)
+                    zip.write(file_path, arcname=file_path.relative_to(directory))
 
-        return TrainingOutput(weights=Path(out_path))
+        diagnostics_path = None
+        if os.listdir(diagnostics_dir):
+            diagnostics_path = "training_diagnostics.zip"
+            with ZipFile(diagnostics_path, "w") as zip:
+                for file_path in Path(diagnostics_dir).rglob("*"):
+                    zip.write(file_path, arcname=file_path.relative_to(diagnostics_dir))
+
+        return TrainingOutput(
+            weights=Path(out_path),
+            diagnostics=Path(diagnostics_path) if diagnostics_path else None,
+        )
     finally:
         if p and p.poll() is None:
             top = psutil.Process(p.pid)